@@ -1,10 +1,13 @@
 # ===============================================================
 #  SCRIPT TO BUILD ENRON GRAPHS EACH YEAR (1999–2002, INTERNAL ONLY)
 # ===============================================================
-import pandas as pd, json
+import pandas as pd, json, sys
 from pathlib import Path
 import numpy as np
 
+sys.path.append(str(Path(__file__).resolve().parents[2] / "emails" / "data_prep"))
+from emails_dataset import load_emails
+
 folders = ["all", "1999", "2000", "2001", "2002"]
 
 def dominant_label(df, label_col, score_col, neutral_label=None, top_frac=0.1, min_threshold=0.1):
@@ -43,20 +46,22 @@ for folder in folders:
     comms_path = IN_DIR / "Communities_internal.parquet"
     risks_path = "data/risk_expanded_results/RiskScores_zeroshot_full.parquet"
     sent_path  = "data/sentiment_results/Email_SentimentScores_internal_multi_9902_both.parquet"
-    emails_path= "data/Emails_clean_9902.parquet"
+    emails_path= None   # data/Emails_clean (year=/month= dataset) if present, else data/Emails_clean_9902.parquet
 
     edges  = pd.read_parquet(edge_path)
     nodes  = pd.read_parquet(nodes_path)
     comms  = pd.read_parquet(comms_path)
     risks  = pd.read_parquet(risks_path)
     sent   = pd.read_parquet(sent_path)
-    emails = pd.read_parquet(emails_path)
-
-    if folder != "all":
-        emails = emails[emails["year"] == int(folder)]
+    # only this year's partitions and the columns used below (no body text)
+    emails = load_emails(years=None if folder == "all" else [int(folder)],
+                         columns=["email_id", "person_id", "person_key", "x_from"], path=emails_path)
 
     print(f"Loaded edges={len(edges):,}, nodes={len(nodes):,}, comms={len(comms):,}, emails={len(emails):,}")
 
+    # Group/merge on int person keys when every input has them; strings only appear in the JSON
+    KEY = "person_key" if all("person_key" in d.columns for d in (nodes, comms, emails)) else "person_id"
+
     # Merge all e-mail info
     merged = (
         emails
@@ -67,7 +72,7 @@ for folder in folders:
 
     # Aggregate per actor (sentiment + risk info)
     agg_rows = []
-    for pid, sub in merged.groupby("person_id"):
+    for pid, sub in merged.groupby(KEY):
         dom_risk, risk_intensity = dominant_label(
             sub, "risk_label", "final_score",
             neutral_label="This email appears routine, compliant, and shows no indication of risk or wrongdoing.", top_frac = 0.025
@@ -81,7 +86,7 @@ for folder in folders:
             neutral_label="neutral", top_frac=1.0, min_threshold=0.0
         )
         agg_rows.append({
-            "person_id": pid,
+            KEY: pid,
             "dom_risk_label": dom_risk,
             "risk_intensity": risk_intensity,
             "dom_sentiment_label": dom_sent,
@@ -95,7 +100,7 @@ for folder in folders:
 
     # Alias map
     xfrom_map = (
-        emails.groupby("person_id")["x_from"]
+        emails.groupby(KEY)["x_from"]
         .agg(lambda x: sorted(set(a for a in x if pd.notna(a))))
         .reset_index()
     )
@@ -104,9 +109,9 @@ for folder in folders:
 
     # Merge with node + community info
     nodes = (
-        nodes.merge(agg_person, on="person_id", how="left")
-             .merge(comms[["person_id", "community_id"]], on="person_id", how="left")
-             .merge(xfrom_map, on="person_id", how="left")
+        nodes.merge(agg_person, on=KEY, how="left")
+             .merge(comms[[KEY, "community_id"]], on=KEY, how="left")
+             .merge(xfrom_map, on=KEY, how="left")
     )
 
     fill_0 = ["risk_intensity","sentiment_intensity","emotion_intensity"]
@@ -2,7 +2,8 @@
 #  SCRIPT TO BUILD THREAD JSONS (1999–2002, INTERNAL ONLY)
 # ===============================================================
 
-import pandas as pd, json, numpy as np, ast
+import pandas as pd, json, numpy as np, ast, sys
+from pathlib import Path
 
 risk = pd.read_parquet("data/risk_expanded_results/RiskScores_zeroshot_threads_full.parquet")
 print(f"Loaded {len(risk):,} thread risk rows.")
@@ -96,16 +97,23 @@ with open(out_path, "w", encoding="utf-8") as f:
 print(f"threads.json created with {len(threads):,} threads (non-singleton only, with participants)")
 
 
-# Load parquet
-thread_text = pd.read_parquet("data/threads/ThreadText_internal_multi_9902.parquet")
-print(f"Loaded {len(thread_text):,} rows with columns: {thread_text.columns.tolist()}")
+# Thread text: rendered from ThreadEmails + the body store (ThreadText no longer stores body_concat)
+sys.path.append(str(Path(__file__).resolve().parents[2] / "emails" / "data_prep" / "threads"))
+from thread_text import ThreadTextView
 
-# Convert to list of dicts
-records = thread_text.to_dict(orient="records")
+view = ThreadTextView("data/threads/ThreadEmails_internal_multi_9902.parquet")
+print(f"Rendering text for {len(view):,} threads")
 
-# Save as formatted JSON (one file)
+# Save as formatted JSON (one file), written batch by batch
 out_path = "data/threads/ThreadText_internal_multi_9902.json"
+n_records = 0
 with open(out_path, "w", encoding="utf-8") as f:
-    json.dump(records, f, ensure_ascii=False, indent=2)
-
-print(f"Saved {out_path} with {len(records):,} thread records.")
+    f.write("[")
+    for batch in view.iter_batches():
+        for rec in batch.to_dict(orient="records"):
+            f.write(",\n" if n_records else "\n")
+            f.write(json.dumps(rec, ensure_ascii=False, indent=2))
+            n_records += 1
+    f.write("\n]" if n_records else "]")
+
+print(f"Saved {out_path} with {n_records:,} thread records.")
@@ -1,6 +1,12 @@
+import sys
+from pathlib import Path
 import pandas as pd
 
+sys.path.append(str(Path(__file__).resolve().parents[2] / "emails" / "data_prep" / "threads"))
+from thread_text import ThreadTextView
+
 df = pd.read_parquet("data/threads/ThreadText_internal_9902.parquet")
 print(df.info())
-sample = df["body_concat"].iloc[10]
+view = ThreadTextView("data/threads/ThreadEmails_internal_9902.parquet")
+sample = view[df["thread_id"].iloc[10]]
 print(sample)  # print first 500 chars
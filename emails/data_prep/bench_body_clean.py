@@ -0,0 +1,83 @@
+# bench_body_clean.py
+# Times the shared body cleaner (body_clean.py) against the per-stage regex chains it replaced:
+#   clean_body       vs nlp_prep.py's 7-pass clean_body
+#   clean_email_text vs sentiment_pipeline.py's clean_email_text
+#   clean_join_batch vs the iterrows + _clean_join loop of the transformer sentiment script
+# on body_raw from the cleaned emails, and checks the outputs are identical.
+#
+#   python emails/data_prep/bench_body_clean.py [--limit 50000]
+
+import re, time, argparse
+import pandas as pd
+import pyarrow.dataset as ds
+from body_clean import clean_body, clean_email_text, clean_body_batch, clean_email_text_batch, clean_join_batch
+from nlp_prep import INPUT_CLEAN
+
+# ------------ previous implementations (baseline) ------------
+def old_clean_body(text: str) -> str:
+    if pd.isna(text): return ""
+    t = text.replace("\r\n", "\n").replace("\r", "\n")
+    t = "\n".join([ln for ln in t.splitlines() if not ln.strip().startswith(">")])
+    t = re.split(r"(?im)^on .{1,200} wrote:$", t)[0]
+    t = re.sub(r"(?is)\n(--\s*$|best regards|kind regards|regards,|cheers,|thanks,).*$", "", t)
+    t = re.sub(r"(?is)(this e-mail.*confidential|disclaimer:.*)$", "", t)
+    t = re.sub(r"\n{3,}", "\n\n", t)
+    t = re.sub(r"[ \t]+", " ", t)
+    return t.strip()
+
+def old_clean_email_text(text: str) -> str:
+    if not isinstance(text, str):
+        text = "" if pd.isna(text) else str(text)
+    text = re.sub(r"-{2,}\s*original message\s*-{2,}.*", "", text, flags=re.I | re.S)
+    text = re.sub(r"from:.*?\n|\bsubject:.*?\n|\bdate:.*?\n|\bto:.*?\n", "", text, flags=re.I)
+    return text.strip()
+
+def old_clean_join(a, b=None):
+    if b is None or b == "":
+        t = str(a)
+    else:
+        t = f"{a}. {b}"
+    return re.sub(r"\s+", " ", str(t)).strip()
+
+def timed(fn):
+    t0 = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - t0
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--input", default=str(INPUT_CLEAN))
+    ap.add_argument("--limit", type=int, default=None, help="only the first N emails")
+    args = ap.parse_args()
+
+    table = ds.dataset(args.input, format="parquet").head(args.limit, columns=["subject", "body_raw"]) \
+        if args.limit else ds.dataset(args.input, format="parquet").to_table(columns=["subject", "body_raw"])
+    bodies, subjects = table.column("body_raw"), table.column("subject")
+    df = table.to_pandas()
+    mb = sum(len(b) for b in df["body_raw"].dropna()) / 1e6
+    print(f"Loaded {len(df):,} bodies ({mb:,.1f} MB)")
+
+    rows = []
+    old, t_old = timed(lambda: df["body_raw"].apply(old_clean_body).tolist())
+    new, t_new = timed(lambda: clean_body_batch(bodies).to_pylist())
+    assert old == new, "clean_body mismatch"
+    rows.append(("clean_body (nlp_prep)", t_old, t_new))
+
+    old, t_old = timed(lambda: [old_clean_email_text(t) for t in df["body_raw"]])
+    new, t_new = timed(lambda: clean_email_text_batch(bodies).to_pylist())
+    assert old == new, "clean_email_text mismatch"
+    rows.append(("clean_email_text (VADER)", t_old, t_new))
+
+    two = df[["subject", "body_raw"]].fillna("")
+    old, t_old = timed(lambda: [old_clean_join(r["subject"], r["body_raw"]) for _, r in two.iterrows()])
+    new, t_new = timed(lambda: clean_join_batch(subjects, bodies).to_pylist())
+    assert old == new, "clean_join mismatch"
+    rows.append(("clean_join (transformers)", t_old, t_new))
+
+    print(f"{'':28s} {'old s':>8s} {'new s':>8s} {'speed-up':>9s}")
+    for name, a, b in rows:
+        print(f"{name:28s} {a:8.2f} {b:8.2f} {a / max(b, 1e-9):8.1f}x")
+    print("(outputs identical)")
+
+if __name__ == "__main__":
+    main()
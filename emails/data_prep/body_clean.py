@@ -0,0 +1,193 @@
+# body_clean.py
+# One body-cleaning engine for every text stage. Output matches the older per-stage cleaners:
+#   clean_body       - nlp_prep.py (quoted lines, "On ... wrote:", signatures, disclaimers, whitespace)
+#   clean_email_text - sentiment_pipeline.py ("-- Original Message --" tail, From:/To:/Subject:/Date: lines)
+#   clean_join       - transformer sentiment script (subject + body, whitespace collapsed)
+#   normalize_subject - nlp_prep.py subject_norm (re:/fwd: tags, [list] prefixes, whitespace)
+# and the *_batch variants run the same code over Arrow string arrays (nulls -> "").
+#
+# clean_body used to make seven full-text passes (splitlines + join, split, three subs, ...).
+# Here one regex scan finds every line-level event (quoted line, reply header, signature start,
+# "--" line) and the result is sliced together from those positions, so Python only does work
+# per event rather than per line. The disclaimer phrases are only searched for in the few
+# bodies that can contain them.
+
+import re
+import pyarrow as pa
+
+# ------------ clean_body (nlp_prep) ------------
+# Characters str.splitlines() treats as line breaks, other than "\n" / "\r\n"
+_LINE_SEPS = re.compile("[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
+# Line-start events, scanned over "\n" + text: the literal "\n" prefix lets the regex engine
+# jump from line to line instead of trying every position.
+_LINE_EVENTS = re.compile(
+    r"\n(?:(?P<quote>[^\S\n]*>)"                                     # "> quoted" line
+    r"|(?P<wrote>on [^\n]{1,200} wrote:$)"                           # "On <date>, <who> wrote:"
+    r"|(?P<sig>best regards|kind regards|regards,|cheers,|thanks,)"  # sign-off
+    r"|(?P<dash>--))",                                               # "--" signature marker
+    re.I | re.M,
+)
+# Disclaimer phrases (anywhere in a line). Only run when the lowercased text contains "e-ma" or
+# "mer:"; no other characters case-fold to e/m/a/r under re.I, so the pre-check never misses one.
+_DISCLAIMER = re.compile(r"(?P<this>this e-mail)|(?P<disc>disclaimer:)", re.I)
+_CONF_END = re.compile(r"confidential", re.I)
+_NL_RUNS = re.compile(r"\n{3,}")
+_SPACE_RUNS = re.compile(r" {2,}")          # after tabs -> spaces: same result as [ \t]+ -> " "
+
+def clean_body(text) -> str:
+    """Cleans email body text — removes quoted replies, signatures, disclaimers, and extra whitespace."""
+    if not isinstance(text, str):
+        return ""
+    # Same lines as splitlines(): every line break becomes "\n", one trailing break is dropped
+    t = text.replace("\r\n", "\n") if "\r" in text else text
+    if not t.isascii() or any(c in t for c in "\r\x0b\x0c\x1c\x1d\x1e"):
+        t = _LINE_SEPS.sub("\n", t)
+    if t.endswith("\n"):
+        t = t[:-1]
+
+    pieces, last, removed = [], 0, 0          # text kept so far is pieces + t[last:...]
+    quote_end = -1                            # events inside a removed quoted line are ignored
+    last_quoted = False
+    cut = None                                # "On ... wrote:" position in t
+    sig, disc = [], []                        # (position in the kept text, kind)
+    events = [(m.start(), m.lastgroup) for m in _LINE_EVENTS.finditer("\n" + t)]
+    low = t.lower()
+    if "e-ma" in low or "mer:" in low:
+        events = sorted(events + [(m.start(), m.lastgroup) for m in _DISCLAIMER.finditer(t)])
+    for p, kind in events:
+        if p < quote_end:
+            continue
+        if kind == "quote":
+            e = t.find("\n", p)
+            if e < 0:                         # last line: its leading "\n" goes too (below)
+                e, last_quoted = len(t), True
+            else:
+                e += 1
+            pieces.append(t[last:p])
+            removed += e - p
+            last = quote_end = e
+        elif kind == "wrote":
+            cut = p
+            break
+        elif kind in ("sig", "dash"):
+            sig.append((p - removed, kind))
+        else:
+            disc.append((p - removed, kind))
+
+    if cut is not None:
+        pieces.append(t[last:cut])
+        kept = "".join(pieces)
+    else:
+        pieces.append(t[last:])
+        kept = "".join(pieces)
+        if last_quoted and kept:
+            kept = kept[:-1]
+
+    # Signature: cut from the "\n" before the first sign-off line (never the first line);
+    # a "--" line only counts when nothing but whitespace follows it.
+    for pos, kind in sig:
+        if pos == 0:
+            continue
+        if kind == "sig" or not kept[pos + 2:].strip():
+            kept = kept[:pos - 1]
+            break
+
+    # Disclaimer: "disclaimer:..." to the end, or "this e-mail..." when the text ends with
+    # "confidential" (optionally followed by one "\n", which is kept)
+    for pos, kind in disc:
+        if pos + 11 > len(kept):             # both phrases are 11 characters
+            break
+        if kind == "disc":
+            kept = kept[:pos]
+            break
+        n = len(kept)
+        if n - 12 >= pos + 11 and _CONF_END.match(kept, n - 12):
+            kept = kept[:pos]
+            break
+        if n - 13 >= pos + 11 and kept[-1] == "\n" and _CONF_END.match(kept, n - 13):
+            kept = kept[:pos] + "\n"
+            break
+
+    if "\n\n\n" in kept:
+        kept = _NL_RUNS.sub("\n\n", kept)
+    if "\t" in kept:
+        kept = kept.replace("\t", " ")
+    if "  " in kept:
+        kept = _SPACE_RUNS.sub(" ", kept)
+    return kept.strip()
+
+# ------------ clean_email_text (VADER sentiment) ------------
+_ORIGINAL_MESSAGE = re.compile(r"-{2,}\s*original message\s*-{2,}", re.I)
+_HEADER_LINES = re.compile(r"from:.*?\n|\bsubject:.*?\n|\bdate:.*?\n|\bto:.*?\n", re.I)
+
+def _drop_header_lines(text: str) -> str:
+    """_HEADER_LINES.sub("", text), but the pattern is only tried where it can start.
+
+    Every match is from/date/to/subject immediately before a ":", so candidate starts are
+    2, 4 or 7 characters before each colon; trying them left to right and skipping any inside a
+    previous match gives exactly the matches re.sub would make.
+    """
+    c = text.find(":")
+    if c < 0:
+        return text
+    starts = set()
+    while c >= 0:
+        starts.update(c - k for k in (2, 4, 7) if c >= k)
+        c = text.find(":", c + 1)
+    pieces, last = [], 0
+    for s in sorted(starts):
+        if s < last:
+            continue
+        m = _HEADER_LINES.match(text, s)
+        if m:
+            pieces.append(text[last:s])
+            last = m.end()
+    if not pieces:
+        return text
+    pieces.append(text[last:])
+    return "".join(pieces)
+
+def clean_email_text(text) -> str:
+    """Drops the quoted "Original Message" tail and From:/Subject:/Date:/To: header lines."""
+    if not isinstance(text, str):
+        text = "" if text is None or (isinstance(text, float) and text != text) else str(text)
+    m = _ORIGINAL_MESSAGE.search(text)
+    if m:
+        text = text[:m.start()]
+    return _drop_header_lines(text).strip()
+
+# ------------ clean_join (transformer sentiment) ------------
+def clean_join(a, b=None) -> str:
+    """"subject. body" (or just a) with whitespace runs collapsed to single spaces."""
+    t = str(a) if b is None or b == "" else f"{a}. {b}"
+    return " ".join(t.split())
+
+# ------------ normalize_subject (nlp_prep subject_norm) ------------
+def normalize_subject(subj) -> str:
+    """Standardises subject lines by removing reply/forward tags, brackets, and extra spaces."""
+    if subj is None or (isinstance(subj, float) and subj != subj): return ""
+    s = subj.lower().strip()
+    s = re.sub(r'^\s*(re|fwd)\s*:\s*', '', s)
+    s = re.sub(r'^\[[^\]]{1,40}\]\s*', '', s)
+    s = re.sub(r'\s+', ' ', s)
+    return s.strip()
+
+# ------------ Arrow batches ------------
+def _texts(arr):
+    if isinstance(arr, (pa.Array, pa.ChunkedArray)):
+        return arr.to_pylist()
+    return list(arr)
+
+def clean_body_batch(arr) -> pa.Array:
+    """clean_body over an Arrow string array / chunked array (or any iterable); nulls -> ""."""
+    return pa.array([clean_body(t) for t in _texts(arr)], pa.string())
+
+def clean_email_text_batch(arr) -> pa.Array:
+    return pa.array([clean_email_text(t) for t in _texts(arr)], pa.string())
+
+def clean_join_batch(a, b=None) -> pa.Array:
+    """clean_join row by row over two string arrays (nulls -> "", as fillna("") did before)."""
+    a = ["" if x is None else x for x in _texts(a)]
+    b = [""] * len(a) if b is None else ["" if x is None else x for x in _texts(b)]
+    return pa.array([clean_join(x, y) for x, y in zip(a, b)], pa.string())
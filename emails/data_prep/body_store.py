@@ -0,0 +1,196 @@
+# body_store.py
+# Email bodies kept out of the metadata tables, in a content-addressed blob store:
+#
+#   data/BodyStore/blobs.zst   every distinct body, zstd-compressed on its own, appended back to back
+#   data/BodyStore/blobs.npy   one row per blob: sha1, offset, compressed length, raw length
+#   data/BodyStore/emails.npy  email_id -> blob number, sorted by email_id
+#
+# Identical bodies (the same mail filed under _sent_mail / sent_items / all_documents, ...) share
+# one blob. Both .npy indexes and blobs.zst are memory-mapped, so opening the store reads nothing
+# up front and BodyStore.get(email_id) touches only the index pages and that one blob.
+#
+#   python emails/data_prep/body_store.py --src data/Emails_clean_9902.parquet
+
+import argparse, hashlib, os
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+BODY_STORE_DIR = Path("data/BodyStore")
+ZSTD_LEVEL = 3
+BATCH_ROWS = 20_000
+
+# sha1 as V20, not S20: numpy strips trailing NUL bytes from S values
+BLOB_DTYPE = np.dtype([("sha1", "V20"), ("offset", "<i8"), ("length", "<i8"), ("size", "<i8")])
+_CODEC = pa.Codec("zstd", compression_level=ZSTD_LEVEL)
+
+def store_for(dataset_path) -> Path:
+    """The body store that sits next to an emails dataset / parquet file."""
+    return Path(dataset_path).parent / BODY_STORE_DIR.name
+
+def _email_dtype(width: int) -> np.dtype:
+    return np.dtype([("email_id", f"S{max(width, 1)}"), ("blob", "<i8")])
+
+def _save(path: Path, arr: np.ndarray):
+    tmp = path.with_suffix(".tmp.npy")
+    np.save(tmp, arr)
+    os.replace(tmp, path)
+
+def write_body_store(email_ids, bodies, store_dir=BODY_STORE_DIR):
+    """Adds (email_id, body) pairs to the store; bodies already stored are not written again.
+
+    An email_id that is already present is re-pointed at its new body. Null bodies map to
+    blob -1. Returns (emails in the store, blobs in the store, new blobs written).
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    blobs_path, emails_path, data_path = store_dir / "blobs.npy", store_dir / "emails.npy", store_dir / "blobs.zst"
+
+    old_blobs = np.load(blobs_path) if blobs_path.exists() else np.zeros(0, BLOB_DTYPE)
+    old_emails = np.load(emails_path) if emails_path.exists() else np.zeros(0, _email_dtype(1))
+    by_hash = {h: i for i, h in enumerate(old_blobs["sha1"].tolist())}
+
+    new_rows, refs = [], []
+    with open(data_path, "ab") as f:
+        offset = f.tell()
+        for body in bodies:
+            if body is None:
+                refs.append(-1)
+                continue
+            raw = body.encode("utf-8")
+            h = hashlib.sha1(raw).digest()
+            blob = by_hash.get(h)
+            if blob is None:
+                comp = _CODEC.compress(raw, asbytes=True)
+                f.write(comp)
+                blob = by_hash[h] = len(old_blobs) + len(new_rows)
+                new_rows.append((h, offset, len(comp), len(raw)))
+                offset += len(comp)
+            refs.append(blob)
+    blobs = np.concatenate([old_blobs, np.array(new_rows, dtype=BLOB_DTYPE)])
+
+    ids = np.array([str(e).encode("utf-8") for e in email_ids], dtype=bytes)
+    width = max(old_emails.dtype["email_id"].itemsize, ids.dtype.itemsize if len(ids) else 1)
+    added = np.zeros(len(ids), _email_dtype(width))
+    added["email_id"], added["blob"] = ids, refs
+    emails = np.concatenate([old_emails.astype(_email_dtype(width)), added])
+    # keep the last entry per email_id, sorted for searchsorted lookups
+    order = np.argsort(emails["email_id"], kind="stable")
+    emails = emails[order]
+    last = np.r_[emails["email_id"][1:] != emails["email_id"][:-1], True]
+    emails = emails[last]
+
+    _save(blobs_path, blobs)
+    _save(emails_path, emails)
+    return len(emails), len(blobs), len(new_rows)
+
+class BodyStore:
+    """Read side of the store: bodies decompressed on demand, keyed by email_id."""
+
+    def __init__(self, store_dir=BODY_STORE_DIR):
+        store_dir = Path(store_dir)
+        self.emails = np.load(store_dir / "emails.npy", mmap_mode="r")
+        self.blobs = np.load(store_dir / "blobs.npy", mmap_mode="r")
+        data_path = store_dir / "blobs.zst"
+        self.data = np.memmap(data_path, dtype=np.uint8, mode="r") if data_path.stat().st_size else np.zeros(0, np.uint8)
+        self._keys = self.emails["email_id"]
+        self._width = self._keys.dtype.itemsize
+
+    def __len__(self):
+        return len(self.emails)
+
+    def _blob_numbers(self, email_ids) -> np.ndarray:
+        """email_ids -> blob numbers (-1 for unknown ids and null bodies)."""
+        raw = [str(e).encode("utf-8") for e in email_ids]
+        keys = np.array(raw, dtype=f"S{self._width}")
+        pos = np.searchsorted(self._keys, keys)
+        found = np.zeros(len(keys), dtype=bool)
+        ok = pos < len(self._keys)
+        found[ok] = self._keys[pos[ok]] == keys[ok]
+        found &= np.array([len(r) <= self._width for r in raw], dtype=bool)   # no truncated matches
+        out = np.full(len(keys), -1, dtype=np.int64)
+        out[found] = self.emails["blob"][pos[found]]
+        return out
+
+    def _body(self, blob: int):
+        if blob < 0:
+            return None
+        offset, length, size = (int(v) for v in self.blobs[["offset", "length", "size"]][blob])
+        raw = _CODEC.decompress(self.data[offset:offset + length], decompressed_size=size, asbytes=True)
+        return raw.decode("utf-8")
+
+    def get(self, email_id, default=None):
+        blob = self._blob_numbers([email_id])[0]
+        return default if blob < 0 else self._body(blob)
+
+    def __getitem__(self, email_id):
+        blob = self._blob_numbers([email_id])[0]
+        if blob < 0 and email_id not in self:
+            raise KeyError(email_id)
+        return self._body(blob)
+
+    def __contains__(self, email_id):
+        keys = np.array([str(email_id).encode("utf-8")], dtype=f"S{self._width}")
+        pos = int(np.searchsorted(self._keys, keys)[0])
+        return (pos < len(self._keys) and self._keys[pos] == keys[0]
+                and len(str(email_id).encode("utf-8")) <= self._width)
+
+    def get_many(self, email_ids) -> list:
+        """Bodies for a list of email_ids (None where unknown); each distinct blob is decompressed once."""
+        blobs = self._blob_numbers(email_ids)
+        cache = {}
+        return [cache[b] if b in cache else cache.setdefault(b, self._body(b)) for b in blobs.tolist()]
+
+    def lazy(self, email_ids) -> "LazyBodies":
+        return LazyBodies(self, email_ids)
+
+    def attach(self, batch: pa.RecordBatch) -> pa.RecordBatch:
+        """Appends a body_raw column to a batch that has email_id."""
+        bodies = pa.array(self.get_many(batch.column("email_id").to_pylist()), pa.string())
+        return pa.RecordBatch.from_arrays(batch.columns + [bodies], names=batch.schema.names + ["body_raw"])
+
+class LazyBodies:
+    """Sequence view of bodies for a fixed list of email_ids; nothing is read until indexed."""
+
+    def __init__(self, store: BodyStore, email_ids):
+        self.store = store
+        self.email_ids = list(email_ids)
+        self._blobs = None
+
+    def __len__(self):
+        return len(self.email_ids)
+
+    def __getitem__(self, i):
+        if self._blobs is None:
+            self._blobs = self.store._blob_numbers(self.email_ids)
+        if isinstance(i, slice):
+            return [self.store._body(b) for b in self._blobs[i].tolist()]
+        return self.store._body(int(self._blobs[i]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def main():
+    ap = argparse.ArgumentParser(description="Build / extend the content-addressed body store.")
+    ap.add_argument("--src", default="data/Emails_clean_9902.parquet",
+                    help="parquet file or dataset directory with email_id and body_raw")
+    ap.add_argument("--out", default=str(BODY_STORE_DIR))
+    args = ap.parse_args()
+
+    dataset = ds.dataset(args.src, format="parquet")
+    n_rows = raw_bytes = 0
+    for batch in dataset.to_batches(columns=["email_id", "body_raw"], batch_size=BATCH_ROWS):
+        bodies = batch.column("body_raw").to_pylist()
+        n_emails, n_blobs, _ = write_body_store(batch.column("email_id").to_pylist(), bodies, args.out)
+        n_rows += batch.num_rows
+        raw_bytes += sum(len(b.encode("utf-8")) for b in bodies if b is not None)
+        print(f"  ... {n_rows:,} emails", end="\r")
+
+    stored = os.path.getsize(Path(args.out) / "blobs.zst")
+    print(f"\nBodyStore {args.out}: {n_emails:,} emails -> {n_blobs:,} distinct bodies, "
+          f"{raw_bytes / 1e6:,.1f} MB raw -> {stored / 1e6:,.1f} MB stored")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# emails_dataset.py
+# Cleaned emails as a Hive-partitioned Arrow dataset: data/Emails_clean/year=YYYY/month=M/*.parquet,
+# rows sorted by dt_utc. load_emails() pushes year filters and column projections down to the
+# scan, so a per-year run only opens that year's files and never touches body_raw unless asked.
+# With a body store (body_store.py) body_raw is moved out of the parquet files altogether and
+# load_emails() fills it back in from the store only when the column is requested.
+#
+#   python emails/data_prep/emails_dataset.py                         # convert data/Emails_clean_9902.parquet
+#   python emails/data_prep/emails_dataset.py --src new_data/Emails_clean_new.parquet --years 1999 2002
+
+import argparse
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from body_store import BodyStore, write_body_store, store_for
+
+DATASET_DIR = Path("data/Emails_clean")                # year=/month= partitions
+LEGACY_FILE = Path("data/Emails_clean_9902.parquet")   # single-file layout, still readable
+PARTITIONING = ds.partitioning(pa.schema([("year", pa.int16()), ("month", pa.int8())]), flavor="hive")
+BODY_COLUMNS = ["body_raw"]
+ROW_GROUP_SIZE = 50_000
+
+def add_year_month(table: pa.Table) -> pa.Table:
+    """(Re)computes year/month partition columns from dt_utc (UTC)."""
+    dt = table.column("dt_utc")
+    if not pa.types.is_timestamp(dt.type):
+        dt = pa.chunked_array([pa.array(pd.to_datetime(dt.to_pandas(), utc=True, errors="coerce"))])
+    if dt.type.tz is not None:
+        # values are stored as UTC already; dropping the zone avoids a tz-database lookup
+        dt = dt.cast(pa.timestamp(dt.type.unit))
+    for name, fn, typ in (("year", pc.year, pa.int16()), ("month", pc.month, pa.int8())):
+        col = fn(dt).cast(typ)
+        if name in table.column_names:
+            table = table.set_column(table.column_names.index(name), name, col)
+        else:
+            table = table.append_column(name, col)
+    return table
+
+def write_emails_dataset(data, out_dir=DATASET_DIR, years=None, body_store=None):
+    """Writes a DataFrame/Table as the partitioned dataset (replacing partitions it touches).
+
+    years:      optional (first, last) inclusive range to keep.
+    body_store: optional body store directory; body_raw goes there (keyed by email_id) and is
+                left out of the parquet files.
+    """
+    table = data if isinstance(data, pa.Table) else pa.Table.from_pandas(data, preserve_index=False)
+    table = add_year_month(table)
+    if years:
+        first, last = years
+        table = table.filter(pc.and_(pc.greater_equal(table["year"], first), pc.less_equal(table["year"], last)))
+    table = table.sort_by([("dt_utc", "ascending")])
+    if body_store is not None and "body_raw" in table.column_names:
+        write_body_store(table.column("email_id").to_pylist(), table.column("body_raw").to_pylist(), body_store)
+        table = table.drop_columns(BODY_COLUMNS)
+    ds.write_dataset(
+        table, out_dir, format="parquet", partitioning=PARTITIONING,
+        existing_data_behavior="delete_matching", preserve_order=True,
+        basename_template="part-{i}.parquet",
+        min_rows_per_group=ROW_GROUP_SIZE, max_rows_per_group=ROW_GROUP_SIZE,
+    )
+    return table.num_rows
+
+def open_emails_dataset(path=None) -> ds.Dataset:
+    """The partitioned dataset if it exists, else the legacy single parquet file."""
+    path = Path(path) if path else (DATASET_DIR if DATASET_DIR.exists() else LEGACY_FILE)
+    if path.is_dir():
+        return ds.dataset(path, format="parquet", partitioning=PARTITIONING)
+    return ds.dataset(path, format="parquet")
+
+def meta_columns(dataset: ds.Dataset) -> list:
+    """Every column except the (large) body text."""
+    return [c for c in dataset.schema.names if c not in BODY_COLUMNS]
+
+def year_filter(years):
+    return ds.field("year").isin([int(y) for y in years]) if years else None
+
+def load_emails(years=None, columns=None, path=None, filter=None) -> pd.DataFrame:
+    """Reads emails for the given years with only the requested columns.
+
+    years:   iterable of ints (None = all years); pushed down as a partition filter.
+    columns: column names to read (None = meta_columns). Names missing from the dataset are
+             skipped so callers can ask for optional columns (e.g. person_key) unconditionally.
+    filter:  extra pyarrow.dataset expression ANDed with the year filter.
+
+    body_raw, when asked for but not in the parquet files, comes from the body store next to
+    the dataset (only the selected rows' bodies are decompressed).
+    """
+    dataset = open_emails_dataset(path)
+    names = set(dataset.schema.names)
+    store_dir = store_for(path or (DATASET_DIR if DATASET_DIR.exists() else LEGACY_FILE))
+    hydrate = (columns is not None and "body_raw" in columns and "body_raw" not in names
+               and (store_dir / "emails.npy").exists())
+    if hydrate:
+        out_cols = [c for c in columns if c in names or c == "body_raw"]
+    columns = meta_columns(dataset) if columns is None else [c for c in columns if c in names]
+    read_cols = list(dict.fromkeys(columns + ["email_id"])) if hydrate else columns
+    expr = year_filter(years)
+    if filter is not None:
+        expr = filter if expr is None else (expr & filter)
+    df = dataset.to_table(columns=read_cols, filter=expr).to_pandas()
+    if hydrate:
+        df["body_raw"] = BodyStore(store_dir).get_many(df["email_id"])
+        df = df[out_cols]
+    return df
+
+def load_bodies(email_ids, path=None) -> list:
+    """body_raw for the given email_ids, in that order (None where unknown).
+
+    Served from the body store when there is one, otherwise read with an email_id filter pushed
+    down to the scan.
+    """
+    ids = pd.Index(email_ids)
+    store_dir = store_for(path or (DATASET_DIR if DATASET_DIR.exists() else LEGACY_FILE))
+    if (store_dir / "emails.npy").exists():
+        return BodyStore(store_dir).get_many(ids.tolist())
+    got = load_emails(columns=["email_id", "body_raw"], path=path,
+                      filter=ds.field("email_id").isin(pa.array(ids.unique(), pa.string())))
+    got = got.drop_duplicates("email_id").set_index("email_id")["body_raw"]
+    return got.reindex(ids).tolist()
+
+def main():
+    ap = argparse.ArgumentParser(description="Write Emails_clean as a year=/month= partitioned dataset.")
+    ap.add_argument("--src", default=str(LEGACY_FILE), help="cleaned emails parquet (file or directory)")
+    ap.add_argument("--out", default=str(DATASET_DIR))
+    ap.add_argument("--years", nargs=2, type=int, metavar=("FIRST", "LAST"), help="keep only this year range")
+    ap.add_argument("--body-store", default=None, help="body store directory (default: BodyStore next to --out)")
+    ap.add_argument("--keep-bodies", action="store_true", help="keep body_raw inside the parquet files")
+    args = ap.parse_args()
+
+    table = ds.dataset(args.src, format="parquet").to_table()
+    print(f"Loaded {table.num_rows:,} rows from {args.src}")
+    store = None if args.keep_bodies else (args.body_store or store_for(args.out))
+    n = write_emails_dataset(table, args.out, years=args.years, body_store=store)
+    print(f"Wrote {n:,} rows -> {args.out} (year=/month= partitions)")
+    if store:
+        print(f"Bodies -> {store} ({len(BodyStore(store)):,} emails)")
+
+if __name__ == "__main__":
+    main()
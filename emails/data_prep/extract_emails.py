@@ -1,14 +1,46 @@
 # extract_emails.py
-import os, hashlib
-import pandas as pd
+import os, re, hashlib, argparse, tarfile, shutil
+from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from email import policy
-from email.parser import BytesParser
+from email.parser import BytesParser, BytesHeaderParser
 from email.utils import parsedate_to_datetime
 from datetime import timezone
+from untar_fix import sanitize
 
 DATA_DIR = "C:/Users/Hai/Downloads/maildir_fixed/maildir"      # <- cleaned tree
 OUTPUT   = "Emails.parquet"
 LIMIT    = None              # set to None for full run after testing
+WORKERS  = os.cpu_count() or 1   # processes used for parsing (1 = parse in this process)
+ROW_GROUP_SIZE = 5000        # rows per Parquet row group
+FILE_BATCH = 2000            # message files handed to a worker at a time
+TAR_BATCH = 2000             # archive members handed to a worker at a time (--tar mode)
+HEAD_CHUNK = 16 * 1024       # bytes read at a time while looking for the end of the headers
+# email_id = md5(key + Message-ID); the key depends on the scheme (--id-scheme):
+#   "path":     absolute path of the message file (the original scheme, default)
+#   "relative": path relative to the maildir root, same wherever the tree/archive lives (opt-in)
+ID_SCHEMES = {"path": "md5(abspath(path) + Message-ID)", "relative": "md5(mail_key + Message-ID)"}
+ID_SCHEME = "path"
+
+# ---- Output schema (same columns/types as the old pandas export, plus the reply headers) ----
+COLS = [
+    "email_id","msg_id","in_reply_to","references","from_raw","x_from","x_to",
+    "to_list","cc_list","bcc_list",
+    "dt_utc","subject","body_raw","employee_dir","folder","path"
+]
+LIST_COLS = {"to_list", "cc_list", "bcc_list", "references"}
+SCHEMA = pa.schema([
+    (c, pa.list_(pa.string()) if c in LIST_COLS else pa.string()) for c in COLS
+])
+# --headers-only: same columns, but body_raw is replaced by where the body sits in the file
+HEADER_SCHEMA = pa.schema(
+    [f for f in SCHEMA if f.name != "body_raw"]
+    + [("body_offset", pa.int64()), ("body_length", pa.int64())]
+)
 
 def parse_list(field: str):
     if not field:
@@ -18,6 +50,16 @@ def parse_list(field: str):
         parts.extend([p.strip().lower() for p in chunk.split(";") if p.strip()])
     return parts
 
+_MSG_ID = re.compile(r"<[^<>\s]+>")
+
+def parse_msg_ids(field) -> list:
+    """"<a@b> <c@d>" -> ["<a@b>", "<c@d>"]; a bare id without brackets is kept as-is."""
+    if not field:
+        return []
+    field = str(field)
+    ids = _MSG_ID.findall(field)
+    return ids if ids else field.split()[:1]
+
 def parse_dt_utc(date_str: str):
     if not date_str:
         return None
@@ -39,70 +81,430 @@ def owner_from_root(root: str):
                 return parts[i + 1]
     return None
 
-rows, ok, skip = [], 0, 0
+def _str_or_none(v):
+    return None if v is None else str(v)
 
-if not os.path.isdir(DATA_DIR):
-    raise SystemExit(f"DATA_DIR not found: {DATA_DIR}")
+def mail_key(path: str, root: str) -> str:
+    """Path of a message relative to the maildir root, "/"-separated ("allen-p/inbox/1")."""
+    return os.path.relpath(path, root).replace(os.sep, "/")
 
-for root, _, files in os.walk(DATA_DIR):
-    folder = os.path.basename(root).lower()
-    owner  = owner_from_root(root)
+def id_key(path: str, root: str, scheme: str = ID_SCHEME) -> str:
+    """What gets hashed into email_id for the message at `path` (see ID_SCHEMES)."""
+    return os.path.abspath(path) if scheme == "path" else mail_key(path, root)
 
-    for fname in files:
-        path = os.path.join(root, fname)
+def parse_file(path: str, key: str, owner, folder: str):
+    """Parses one message file into an output record (None if it can't be parsed)."""
+    # open file normally (names are cleaned now)
+    try:
+        with open(path, "rb") as fp:
+            raw = fp.read()
+    except Exception:
+        return None
+    return parse_bytes(raw, os.path.abspath(path), key, owner, folder)
 
-        # open file normally (names are cleaned now)
-        try:
-            with open(path, "rb") as fp:
-                msg = BytesParser(policy=policy.default).parse(fp)
-        except Exception:
-            skip += 1
-            continue
+def parse_bytes(raw: bytes, path: str, key: str, owner, folder: str):
+    """Parses one raw message; `key` (id_key) is hashed into email_id, `path` is stored."""
+    try:
+        msg = BytesParser(policy=policy.default).parsebytes(raw)
+    except Exception:
+        return None
 
-        try:
-            part = msg.get_body(preferencelist=("plain", "html"))
-            body = part.get_content() if part else msg.get_content()
-
-            rec = {
-                "email_id": hashlib.md5((os.path.abspath(path) + str(msg.get("Message-ID"))).encode("utf-8")).hexdigest(),
-                "msg_id": msg.get("Message-ID"),
-                "from_raw": (msg.get("From") or "").lower(),
-                "x_from": (msg.get("X-From") or "").strip(),   # <-- NEW
-                "x_to": (msg.get("X-To") or "").strip(),       # <-- NEW
-                "to_list": parse_list(msg.get("To")),
-                "cc_list": parse_list(msg.get("Cc")),
-                "bcc_list": parse_list(msg.get("Bcc")),
-                "dt_utc": parse_dt_utc(msg.get("Date")),
-                "subject": msg.get("Subject"),
-                "body_raw": body,
-                "employee_dir": owner,
-                "folder": folder,
-                "path": os.path.abspath(path),
-            }
+    try:
+        body = message_body(msg)
+        if body is None:
+            return None
+
+        rec = header_fields(msg, path, key, owner, folder)
+        rec["body_raw"] = body
+        return rec
+    except Exception:
+        return None
+
+def message_body(msg):
+    """Decoded text body (plain, else html; transfer encoding and charset applied), or None."""
+    part = msg.get_body(preferencelist=("plain", "html"))
+    body = part.get_content() if part else msg.get_content()
+    return body if isinstance(body, str) else None
+
+def email_id(key: str, msg_id) -> str:
+    return hashlib.md5((key + str(msg_id)).encode("utf-8")).hexdigest()
+
+def header_fields(msg, path: str, key: str, owner, folder: str) -> dict:
+    """Every output column except the body."""
+    return {
+        "email_id": email_id(key, msg.get("Message-ID")),
+        "msg_id": _str_or_none(msg.get("Message-ID")),
+        "in_reply_to": (parse_msg_ids(msg.get("In-Reply-To")) or [None])[0],
+        "references": parse_msg_ids(msg.get("References")),
+        "from_raw": (msg.get("From") or "").lower(),
+        "x_from": (msg.get("X-From") or "").strip(),
+        "x_to": (msg.get("X-To") or "").strip(),
+        "to_list": parse_list(msg.get("To")),
+        "cc_list": parse_list(msg.get("Cc")),
+        "bcc_list": parse_list(msg.get("Bcc")),
+        "dt_utc": parse_dt_utc(msg.get("Date")),
+        "subject": _str_or_none(msg.get("Subject")),
+        "employee_dir": owner,
+        "folder": folder,
+        "path": path,
+    }
+
+_BLANK_LINE = re.compile(rb"\r?\n\r?\n")
+
+def parse_headers(path: str, key: str, owner, folder: str):
+    """Headers-only parse: reads up to the first blank line and records where the body starts.
+
+    No MIME body decoding happens here; use load_body() to fetch a body later.
+    """
+    try:
+        with open(path, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            head = fp.read(HEAD_CHUNK)
+            m = _BLANK_LINE.search(head)
+            while m is None and len(head) < size:
+                chunk = fp.read(HEAD_CHUNK)
+                if not chunk:
+                    break
+                head += chunk
+                m = _BLANK_LINE.search(head)
+        offset = m.end() if m else len(head)
+        msg = BytesHeaderParser(policy=policy.default).parsebytes(head[:offset])
+        rec = header_fields(msg, os.path.abspath(path), key, owner, folder)
+    except Exception:
+        return None
+    rec["body_offset"] = offset
+    rec["body_length"] = size - offset
+    return rec
+
+def load_body(path: str, offset: int, length: int):
+    """Lazily loads a body recorded by --headers-only.
+
+    The headers (bytes up to offset) are read along with the body, so Content-Transfer-Encoding,
+    charset and MIME parts are applied exactly as in a full run: the result equals body_raw
+    (None where a full run would have skipped the message).
+    """
+    with open(path, "rb") as fp:
+        raw = fp.read(offset + length)
+    try:
+        return message_body(BytesParser(policy=policy.default).parsebytes(raw))
+    except Exception:
+        return None
+
+def employee_tasks(data_dir: str):
+    """One task per employee_dir under the maildir (plus loose top-level files, if any)."""
+    tasks = []
+    with os.scandir(data_dir) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    if any(e.is_file() for e in entries):
+        tasks.append((data_dir, False))
+    tasks.extend((e.path, True) for e in entries if e.is_dir())
+    return tasks
+
+def iter_file_batches(tasks, data_root: str, batch_size: int = FILE_BATCH, scheme: str = ID_SCHEME):
+    """Walks the mailboxes in task order (folders and files sorted) and yields batches of
+    (path, key, owner, folder), so a worker never holds more than batch_size parsed messages
+    (the largest mailboxes have ~30k)."""
+    batch = []
+    for top, recursive in tasks:
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            folder = os.path.basename(root).lower()
+            owner  = owner_from_root(root)
+            for fname in sorted(files):
+                path = os.path.join(root, fname)
+                batch.append((path, id_key(path, data_root, scheme), owner, folder))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if not recursive:
+                break
+    if batch:
+        yield batch
+
+def parse_file_batch(batch, parse_fn=parse_file, schema=SCHEMA):
+    """Worker: parses a batch of message files and returns (table, ok, skipped)."""
+    rows = []
+    for path, key, owner, folder in batch:
+        rec = parse_fn(path, key, owner, folder)
+        if rec is not None:
             rows.append(rec)
-            ok += 1
-            if ok % 5000 == 0:
+    return pa.Table.from_pylist(rows, schema=schema), len(rows), len(batch) - len(rows)
+
+def iter_tar_batches(tar_path: str, batch_size: int = TAR_BATCH, root=None, scheme: str = ID_SCHEME):
+    """Streams the maildir members of the Enron archive in batches, without extracting anything.
+
+    Member paths go through untar_fix.sanitize(), so employee_dir/folder come out exactly as they
+    would from the extracted tree. root: the maildir directory the archive would be extracted to
+    (the --data-dir of that tree); path and email_id are then the same as a --data-dir parse of it.
+    Without it, paths are rooted at <archive>/maildir.
+    """
+    root = os.path.abspath(root or os.path.join(tar_path, "maildir"))
+    batch = []
+    with tarfile.open(tar_path, "r|gz") as tf:     # stream mode: one pass, no member index
+        for m in tf:
+            if not m.isfile() or not m.name.startswith("maildir/"):
+                continue
+            clean_rel = sanitize(m.name)
+            if not clean_rel:
+                continue
+            f = tf.extractfile(m)
+            if f is None:
+                continue
+            parent = os.path.dirname(clean_rel)
+            path = os.path.join(root, os.path.relpath(clean_rel, "maildir"))
+            batch.append((f.read(), path, id_key(path, root, scheme),
+                          owner_from_root(parent), os.path.basename(parent).lower()))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def parse_tar_batch(batch):
+    """Worker: parses a batch of in-memory archive members and returns (table, ok, skipped)."""
+    rows = []
+    for raw, path, key, owner, folder in batch:
+        rec = parse_bytes(raw, path, key, owner, folder)
+        if rec is not None:
+            rows.append(rec)
+    return pa.Table.from_pylist(rows, schema=SCHEMA), len(rows), len(batch) - len(rows)
+
+def run_tasks(fn, tasks, workers: int):
+    """Yields fn(task) in task order, keeping at most 2*workers tasks in flight."""
+    if workers <= 1:
+        for t in tasks:
+            yield fn(t)
+        return
+    ex = ProcessPoolExecutor(max_workers=workers)
+    try:
+        pending = deque()
+        for t in tasks:
+            pending.append(ex.submit(fn, t))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        ex.shutdown(wait=True, cancel_futures=True)
+
+def write_tables(results, output: str, limit=None, schema=SCHEMA):
+    """Streams (table, ok, skipped) results into one Parquet file, row group by row group."""
+    ok = skip = 0
+    last_report = 0
+    with pq.ParquetWriter(output, schema) as writer:
+        for table, n_ok, n_skip in results:
+            if limit and ok + table.num_rows > limit:
+                table = table.slice(0, limit - ok)
+            if table.num_rows:
+                writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+            ok += table.num_rows
+            skip += n_skip
+            if ok - last_report >= 5000:
                 print(f"Parsed {ok} emails… (skipped {skip})")
-            if LIMIT and ok >= LIMIT:
+                last_report = ok
+            if limit and ok >= limit:
                 break
-        except Exception:
-            skip += 1
+    return ok, skip
+
+# ---- Incremental mode (--incremental) ----
+# Emails.parquet -> Emails/<employee_dir>.parquet partitions + Emails.manifest.parquet, which
+# records path/size/mtime/sha1 per file. Re-runs only parse new or changed files, tombstone
+# deleted ones (deleted=True) and rewrite just the partitions they touch. email_id is the same
+# as a full run with the same --id-scheme, so downstream joins are unaffected. The manifest
+# records the id scheme (none recorded: "path"); one written with another scheme is discarded
+# with its partitions.
+MANIFEST_SCHEMA = pa.schema([
+    ("path", pa.string()), ("partition", pa.string()),
+    ("size", pa.int64()), ("mtime_ns", pa.int64()), ("sha1", pa.string()),
+    ("email_id", pa.string()), ("deleted", pa.bool_()),
+])
+
+def incremental_paths(output: str):
+    stem = os.path.splitext(output)[0]
+    return stem, stem + ".manifest.parquet"
+
+def load_manifest(path: str, scheme: str = ID_SCHEME):
+    """{path: entry}, or None if the manifest was written with another email_id scheme."""
+    if not os.path.exists(path):
+        return {}
+    table = pq.read_table(path, schema=MANIFEST_SCHEMA)
+    recorded = (pq.read_schema(path).metadata or {}).get(b"email_id", ID_SCHEMES["path"].encode())
+    if recorded != ID_SCHEMES[scheme].encode():
+        return None
+    return {r["path"]: r for r in table.to_pylist()}
+
+def scan_files(task, data_root: str, scheme: str = ID_SCHEME):
+    """Stats every file of one task: [(path, key, owner, folder, size, mtime_ns)]."""
+    top, recursive = task
+    out = []
+    for root, _, files in os.walk(top):
+        folder = os.path.basename(root).lower()
+        owner  = owner_from_root(root)
+        for fname in files:
+            path = os.path.abspath(os.path.join(root, fname))
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            out.append((path, id_key(path, data_root, scheme), owner, folder, st.st_size, st.st_mtime_ns))
+        if not recursive:
+            break
+    return out
+
+def parse_changed(task):
+    """Worker: re-hashes files whose size/mtime moved and parses the ones whose content changed.
+
+    Returns (partition, table, manifest entries, paths whose old rows must be replaced).
+    """
+    key, files = task
+    rows, entries, replaced = [], [], set()
+    for path, mkey, owner, folder, size, mtime_ns, old_sha1, old_email_id in files:
+        try:
+            with open(path, "rb") as fp:
+                raw = fp.read()
+        except OSError:
             continue
-    if LIMIT and ok >= LIMIT:
-        break
+        sha1 = hashlib.sha1(raw).hexdigest()
+        entry = {"path": path, "partition": key, "size": size, "mtime_ns": mtime_ns,
+                 "sha1": sha1, "email_id": old_email_id, "deleted": False}
+        if sha1 != old_sha1:                # new file, or same file with new content
+            rec = parse_bytes(raw, path, mkey, owner, folder)
+            if rec is not None:
+                rows.append(rec)
+            entry["email_id"] = rec["email_id"] if rec else None
+            replaced.add(path)
+        entries.append(entry)
+    return key, pa.Table.from_pylist(rows, schema=SCHEMA), entries, replaced
 
-print(f"Finished: parsed={ok}, skipped={skip}")
+def merge_partition(parts_dir: str, key: str, new_rows: pa.Table, drop_paths: set):
+    """Rewrites one partition: old rows minus drop_paths, plus new_rows."""
+    fpath = os.path.join(parts_dir, key + ".parquet")
+    if os.path.exists(fpath):
+        old = pq.read_table(fpath, schema=SCHEMA)
+        if drop_paths:
+            gone = pc.is_in(old["path"], value_set=pa.array(sorted(drop_paths), pa.string()))
+            old = old.filter(pc.invert(gone))
+        new_rows = pa.concat_tables([old, new_rows])
+    if new_rows.num_rows == 0:
+        if os.path.exists(fpath):
+            os.remove(fpath)
+        return 0
+    tmp = fpath + ".tmp"
+    pq.write_table(new_rows, tmp, row_group_size=ROW_GROUP_SIZE)
+    os.replace(tmp, fpath)
+    return new_rows.num_rows
 
-# ---- Save to Parquet ----
-df = pd.DataFrame(rows)
-cols = [
-    "email_id","msg_id","from_raw","x_from","x_to",
-    "to_list","cc_list","bcc_list",
-    "dt_utc","subject","body_raw","employee_dir","folder","path"
-]
-for c in cols:
-    if c not in df.columns:
-        df[c] = None
-df = df[cols]
-df.to_parquet(OUTPUT, index=False)
-print(f"Saved {len(df)} emails -> {OUTPUT}")
+def run_incremental(data_dir: str, output: str, workers: int, scheme: str = ID_SCHEME):
+    parts_dir, manifest_path = incremental_paths(output)
+    manifest = load_manifest(manifest_path, scheme)
+    if manifest is None:
+        print(f"{manifest_path} was written with another email_id scheme than {ID_SCHEMES[scheme]}; "
+              "re-parsing everything.")
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        manifest = {}
+    os.makedirs(parts_dir, exist_ok=True)
+
+    tasks, seen, n_files = [], set(), 0
+    for task in employee_tasks(data_dir):
+        key = os.path.basename(task[0]) if task[1] else "_root"
+        todo = []
+        for path, mkey, owner, folder, size, mtime_ns in scan_files(task, data_dir, scheme):
+            seen.add(path)
+            old = manifest.get(path)
+            live = old is not None and not old["deleted"]
+            if live and old["size"] == size and old["mtime_ns"] == mtime_ns:
+                continue
+            todo.append((path, mkey, owner, folder, size, mtime_ns,
+                         old["sha1"] if live else None, old["email_id"] if live else None))
+        n_files += len(todo)
+        if todo:
+            tasks.append((key, todo))
+
+    # tombstone files that disappeared since the last run
+    deleted = {}
+    for path, old in manifest.items():
+        if not old["deleted"] and path not in seen:
+            deleted.setdefault(old["partition"], set()).add(path)
+            manifest[path] = {**old, "deleted": True}
+    n_deleted = sum(len(v) for v in deleted.values())
+    print(f"Manifest: {len(seen):,} files on disk, {n_files:,} new/touched, {n_deleted:,} deleted")
+
+    ok = 0
+    for key, table, entries, replaced in run_tasks(parse_changed, tasks, workers):
+        for e in entries:
+            manifest[e["path"]] = e
+        drop = replaced | deleted.pop(key, set())
+        if table.num_rows or drop:
+            merge_partition(parts_dir, key, table, drop)
+        ok += table.num_rows
+    for key, drop in deleted.items():
+        merge_partition(parts_dir, key, SCHEMA.empty_table(), drop)
+
+    schema = MANIFEST_SCHEMA.with_metadata({"email_id": ID_SCHEMES[scheme]})
+    pq.write_table(pa.Table.from_pylist(list(manifest.values()), schema=schema), manifest_path)
+    print(f"Finished: re-parsed={ok}, tombstoned={n_deleted}")
+    print(f"Partitions -> {parts_dir}/  manifest -> {manifest_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse the Enron maildir into Emails.parquet")
+    parser.add_argument("--data-dir", dest="data_dir", default=DATA_DIR,
+                        help="Cleaned maildir tree (output of untar_fix.py)")
+    parser.add_argument("--out", dest="out_path", default=OUTPUT,
+                        help=f"Output parquet path (default: {OUTPUT})")
+    parser.add_argument("--tar", dest="tar_path", default=None,
+                        help="Read messages straight from the Enron .tar.gz instead of --data-dir "
+                             "(no untar_fix.py step)")
+    parser.add_argument("--tar-root", dest="tar_root", default=None,
+                        help="With --tar: the maildir directory the archive would be extracted to "
+                             "(--data-dir of that tree), so path/email_id match a --data-dir parse")
+    parser.add_argument("--id-scheme", dest="id_scheme", default=ID_SCHEME, choices=sorted(ID_SCHEMES),
+                        help="email_id key: 'path' = absolute file path (default, as before); "
+                             "'relative' = path relative to the maildir root, the same wherever "
+                             "the tree or archive lives")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help=f"Parser processes; work is split into batches of {FILE_BATCH} files (1 = no pool)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only parse new/changed files (manifest-based) into a partitioned "
+                             "output directory next to --out")
+    parser.add_argument("--headers-only", dest="headers_only", action="store_true",
+                        help="Skip body parsing (enough for the SNA/graph scripts); stores "
+                             "body_offset/body_length instead of body_raw, see load_body()")
+    parser.add_argument("--limit", type=int, default=LIMIT,
+                        help="Stop after this many parsed emails (for test runs)")
+    args = parser.parse_args()
+    if args.incremental and (args.tar_path or args.limit or args.headers_only):
+        parser.error("--incremental works on a full --data-dir parse only")
+    if args.tar_root and not args.tar_path:
+        parser.error("--tar-root only applies to --tar")
+    if args.headers_only and args.tar_path:
+        parser.error("--headers-only needs --data-dir (body offsets point into the files)")
+
+    if args.incremental:
+        if not os.path.isdir(args.data_dir):
+            raise SystemExit(f"DATA_DIR not found: {args.data_dir}")
+        run_incremental(args.data_dir, args.out_path, args.workers, args.id_scheme)
+        return
+
+    if args.tar_path:
+        if not os.path.isfile(args.tar_path):
+            raise SystemExit(f"Archive not found: {args.tar_path}")
+        print(f"Streaming {args.tar_path} with {args.workers} worker(s)…")
+        batches = iter_tar_batches(args.tar_path, root=args.tar_root, scheme=args.id_scheme)
+        results = run_tasks(parse_tar_batch, batches, args.workers)
+    else:
+        if not os.path.isdir(args.data_dir):
+            raise SystemExit(f"DATA_DIR not found: {args.data_dir}")
+        tasks = employee_tasks(args.data_dir)
+        print(f"Parsing {len(tasks)} mailboxes with {args.workers} worker(s)…")
+        worker = parse_file_batch
+        if args.headers_only:
+            worker = partial(parse_file_batch, parse_fn=parse_headers, schema=HEADER_SCHEMA)
+        results = run_tasks(worker, iter_file_batches(tasks, args.data_dir, scheme=args.id_scheme), args.workers)
+    schema = HEADER_SCHEMA if args.headers_only else SCHEMA
+    ok, skip = write_tables(results, args.out_path, args.limit, schema)
+
+    print(f"Finished: parsed={ok}, skipped={skip}")
+    print(f"Saved {ok} emails -> {args.out_path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,17 @@
 from pathlib import Path
 import pandas as pd
+from emails_dataset import open_emails_dataset, load_emails, meta_columns, year_filter
 
-INPUT = Path("data/all/Emails_clean_9902.parquet")
+INPUT = None   # data/Emails_clean (year=/month= dataset) if present, else data/Emails_clean_9902.parquet
 OUT_DIR = Path("data")
 
-emails = pd.read_parquet(INPUT, engine="pyarrow", memory_map=False)
+dataset = open_emails_dataset(INPUT)
+emails = load_emails(columns=meta_columns(dataset), path=INPUT)
 print(f"Loaded {len(emails):,} emails")
 print(emails.info())
 print(emails["year"].value_counts())
 
 for year in ["1999","2000","2001","2002"]:
-    print(emails[emails["year"] == int(year)].info())
-
+    # pushed-down year filter: only that year's partitions are opened
+    print(f"{year}: {dataset.count_rows(filter=year_filter([int(year)])):,} emails")
+    print(load_emails(years=[int(year)], path=INPUT).info())
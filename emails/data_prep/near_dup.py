@@ -0,0 +1,139 @@
+# near_dup.py
+# MinHash + LSH near-duplicate clustering for emails.
+# The same message filed under _sent_mail / sent_items / all_documents, or lightly re-forwarded,
+# ends up in one cluster. Every email gets a dup_cluster_id = email_id of the cluster's canonical
+# member (earliest dt_utc, then smallest email_id), so downstream models can score one row per
+# cluster and copy the result to the other members.
+# Clusters are built on the text the models see (model_text: subject_norm + body_clean, whole).
+# Texts shorter than SHINGLE words have no shingles; they only cluster with identical texts.
+
+import re
+import numpy as np
+import pandas as pd
+from body_clean import clean_body_batch, normalize_subject
+
+NUM_PERM   = 64        # MinHash permutations
+BANDS      = 16        # LSH bands (NUM_PERM / BANDS rows per band)
+SHINGLE    = 5         # word n-gram size
+THRESHOLD  = 0.8       # min estimated Jaccard for two candidates to be merged
+CHUNK      = 20000     # documents hashed per chunk (bounds memory)
+
+_MERSENNE = np.uint64((1 << 31) - 1)
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+_word_re = re.compile(r"\w+")
+
+def _shingle_hashes(texts):
+    """Word SHINGLE-gram hashes for a batch of texts -> (hashes < 2^31 - 1, count per text).
+
+    Tokens are hashed once; each shingle hash is a rolling combination of its token hashes,
+    so no shingle strings are ever built. Texts shorter than SHINGLE words give none.
+    """
+    toks = [_word_re.findall(t.lower()) if isinstance(t, str) else [] for t in texts]
+    lens = np.fromiter(map(len, toks), dtype=np.int64, count=len(toks))
+    flat = np.array([w for ts in toks for w in ts], dtype=object)
+    if not len(flat):
+        return np.zeros(0, dtype=np.uint64), np.zeros(len(toks), dtype=np.int64)
+    th = pd.util.hash_array(flat)
+    pos = np.arange(len(flat))
+    lens_rep = np.repeat(lens, lens)
+    doc_end = np.repeat(np.cumsum(lens), lens)
+    doc_start = doc_end - lens_rep
+
+    sh = np.zeros(len(flat), dtype=np.uint64)
+    for j in range(SHINGLE):
+        idx = pos + j
+        ok = idx < doc_end
+        sh[ok] = sh[ok] * _MIX + th[idx[ok]]          # wraps mod 2^64 on purpose
+    valid = (pos - doc_start) <= lens_rep - SHINGLE
+    counts = np.bincount(np.repeat(np.arange(len(toks)), lens)[valid], minlength=len(toks))
+    return sh[valid] % _MERSENNE, counts
+
+def minhash_signatures(texts, num_perm: int = NUM_PERM, seed: int = 1):
+    """Returns (signatures uint64[n, num_perm], has_shingles bool[n])."""
+    rng = np.random.default_rng(seed)
+    # (a*h + b) mod p with a, b, h < p = 2^31 - 1 stays exact in uint64
+    a = rng.integers(1, int(_MERSENNE), size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, int(_MERSENNE), size=num_perm, dtype=np.uint64)
+
+    texts = list(texts)
+    sigs = np.full((len(texts), num_perm), _MERSENNE, dtype=np.uint64)
+    has = np.zeros(len(texts), dtype=bool)
+    for start in range(0, len(texts), CHUNK):
+        h, counts = _shingle_hashes(texts[start:start + CHUNK])
+        nonempty = np.flatnonzero(counts)
+        if not len(nonempty):
+            continue
+        offsets = np.concatenate([[0], np.cumsum(counts[nonempty])[:-1]])
+        for k in range(num_perm):
+            perm = (a[k] * h + b[k]) % _MERSENNE
+            sigs[start + nonempty, k] = np.minimum.reduceat(perm, offsets)
+        has[start + nonempty] = True
+    return sigs, has
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def lsh_clusters(sigs, has, bands: int = BANDS, threshold: float = THRESHOLD):
+    """Groups rows whose signatures collide in any band and agree on >= threshold of slots.
+
+    Returns a root index per row (rows without shingles stay on their own).
+    """
+    n, num_perm = sigs.shape
+    rows = num_perm // bands
+    need = int(np.ceil(threshold * num_perm))
+    parent = np.arange(n)
+    idx = np.flatnonzero(has)
+    for band in range(bands):
+        block = np.ascontiguousarray(sigs[idx, band * rows:(band + 1) * rows])
+        keys = pd.util.hash_array(block.view(np.dtype((np.void, block.dtype.itemsize * rows))).ravel())
+        order = np.argsort(keys, kind="stable")
+        k_sorted = keys[order]
+        starts = np.flatnonzero(np.r_[True, k_sorted[1:] != k_sorted[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        multi = (ends - starts) >= 2
+        for s, e in zip(starts[multi], ends[multi]):
+            leader = idx[order[s]]
+            members = idx[order[s + 1:e]]
+            agree = (sigs[members] == sigs[leader]).sum(axis=1)
+            for j in members[agree >= need]:
+                ra, rb = _find(parent, leader), _find(parent, j)
+                if ra != rb:
+                    parent[rb] = ra
+    return np.array([_find(parent, i) for i in range(n)])
+
+def model_text(df: pd.DataFrame) -> list:
+    """subject_norm + " " + body_clean per row, as nlp_prep.py writes them to TextBase."""
+    subj = df["subject"] if "subject" in df.columns else [None] * len(df)
+    body = clean_body_batch(df["body_raw"].tolist()).to_pylist()
+    return [f"{normalize_subject(s)} {b}".strip() for s, b in zip(subj, body)]
+
+def assign_dup_clusters(df: pd.DataFrame) -> pd.DataFrame:
+    """Adds dup_cluster_id (email_id of the canonical member) and dup_canonical to df."""
+    df = df.copy()
+    if "body_raw" not in df.columns or df.empty:
+        df["dup_cluster_id"] = df["email_id"]
+        df["dup_canonical"] = True
+        return df
+
+    texts = model_text(df)
+    sigs, has = minhash_signatures(texts)
+    roots = lsh_clusters(sigs, has)
+    # too short for MinHash: group identical texts only
+    short = np.flatnonzero(~has)
+    if len(short):
+        first = pd.Series(short).groupby(pd.Series([texts[i] for i in short])).transform("first")
+        roots[short] = first.to_numpy()
+
+    # canonical member per cluster: earliest dt_utc, then smallest email_id
+    order = pd.DataFrame({
+        "root": roots,
+        "dt": pd.to_datetime(df["dt_utc"], utc=True, errors="coerce").values,
+        "email_id": df["email_id"].values,
+    }).sort_values(["root", "dt", "email_id"], na_position="last")
+    canonical = order.drop_duplicates("root").set_index("root")["email_id"]
+    df["dup_cluster_id"] = canonical.reindex(roots).values
+    df["dup_canonical"] = df["email_id"].values == df["dup_cluster_id"].values
+    return df
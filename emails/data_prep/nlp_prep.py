@@ -1,109 +1,205 @@
 # ==== Preparing the NLP Corpus from the CLEAN file (OneDrive \ maildir) ====
-
-import os, re
+#
+# Chunked + parallel: the cleaned emails are read batch by batch (row groups), each batch is
+# cleaned and sentence-split in a worker process, and TextBase / Sentence / DocIndex are
+# streamed out one row group per batch, so memory stays flat however big the corpus is.
+#
+#   python emails/data_prep/nlp_prep.py [--workers N] [--chunk-rows 5000]
+
+import os, sys, time, argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import nltk
 from nltk.tokenize import sent_tokenize
+from body_clean import clean_body, clean_body_batch, normalize_subject   # shared single-pass cleaner
+from body_store import BodyStore, store_for
 
 # Use your OneDrive maildir folder path
 # MAILDIR = r"C:\Users\petermak11\OneDrive - Swinburne University\Documents\Master of IT\2025 Semester 2\COS70008 - Technology Innovation Research and Project\enron_mail_20150507.tar\enron_mail_20150507\maildir"
 
 # Path to Emails_clean.parquet  (⚠️ double-check the exact filename in Explorer!)
+# (the data/Emails_clean year=/month= dataset from emails_dataset.py works here too)
 INPUT_CLEAN = Path("data/Emails_clean_9902.parquet")
 OUT_DIR = Path("data/nlp_inputs")
 
-Path(OUT_DIR).mkdir(parents=True, exist_ok=True)
-
-# Quick path check just to make sure the cleaned file exists
-assert os.path.exists(INPUT_CLEAN), f"Not found: {INPUT_CLEAN}\nCheck filename and path."
+WORKERS    = os.cpu_count() or 1
+CHUNK_ROWS = 5000         # emails per batch / output row group
 
-# Download the NLTK tokenizer (used for splitting sentences)
-nltk.download("punkt", quiet=True)
+# Output columns (optional ones are kept only if present in the input)
+TEXT_COLS = ["email_id", "subject_norm", "body_clean", "text_len_chars", "text_len_tokens", "has_text",
+             "dup_cluster_id"]
+DOC_COLS  = ["email_id", "person_id", "from_norm", "dt_utc",
+             "domain_sender", "internal_sender", "mass_mail",
+             "employee_dir", "folder", "path", "subject", "dup_cluster_id"]
+SENT_SCHEMA = pa.schema([
+    ("sentence_id", pa.string()), ("email_id", pa.string()),
+    ("sent_idx", pa.int64()), ("sentence_text", pa.string()),
+])
 
 # ------------ Helper functions ------------
-def normalize_subject(subj: str) -> str:
-    """Standardises subject lines by removing reply/forward tags, brackets, and extra spaces."""
-    if pd.isna(subj): return ""
-    s = subj.lower().strip()
-    s = re.sub(r'^\s*(re|fwd)\s*:\s*', '', s)
-    s = re.sub(r'^\[[^\]]{1,40}\]\s*', '', s)
-    s = re.sub(r'\s+', ' ', s)
-    return s.strip()
-
-def clean_body(text: str) -> str:
-    """Cleans email body text — removes quoted replies, signatures, disclaimers, and extra whitespace."""
-    if pd.isna(text): return ""
-    t = text.replace("\r\n", "\n").replace("\r", "\n")
-    t = "\n".join([ln for ln in t.splitlines() if not ln.strip().startswith(">")])
-    t = re.split(r"(?im)^on .{1,200} wrote:$", t)[0]
-    t = re.sub(r"(?is)\n(--\s*$|best regards|kind regards|regards,|cheers,|thanks,).*$", "", t)
-    t = re.sub(r"(?is)(this e-mail.*confidential|disclaimer:.*)$", "", t)
-    t = re.sub(r"\n{3,}", "\n\n", t)
-    t = re.sub(r"[ \t]+", " ", t)
-    return t.strip()
-
-# ------------ Load the cleaned dataset ------------
-df = pd.read_parquet(INPUT_CLEAN)
-print("Loaded cleaned dataset:", df.shape)
-
-# ------------ NLP prep transforms ------------
-# Here I’m creating standardised subject and cleaned body fields, 
-# plus some useful metadata for length and text presence.
-df["subject_norm"]    = df["subject"].apply(normalize_subject)
-df["body_clean"]      = df["body_raw"].apply(clean_body)
-df["text_len_chars"]  = df["body_clean"].str.len()
-df["text_len_tokens"] = df["body_clean"].str.split().str.len()
-df["has_text"]        = (df["text_len_tokens"].fillna(0) >= 3)
-
-# ------------ Sentence-level table ------------
-# This breaks each email body into individual sentences and assigns IDs to each one.
-sent_rows = []
-for _, row in df[df["has_text"]].iterrows():
-    for i, s in enumerate(sent_tokenize(row["body_clean"])):
-        s = s.strip()
-        if s:
-            sent_rows.append({
-                "sentence_id": f"{row['email_id']}|s{i}",
-                "email_id": row["email_id"],
-                "sent_idx": i,
-                "sentence_text": s
-            })
-sent_df = pd.DataFrame(sent_rows)
-
-# ------------ Email-level text table ------------
-# Keeps only the main text columns I need for NLP models.
-textbase = df[[
-    "email_id", "subject_norm", "body_clean", "text_len_chars", "text_len_tokens", "has_text"
-]].copy()
-
-# ------------ Metadata / document index ------------
-# Here I’m keeping metadata fields to help with joins and filtering later on.
-doc_cols = [c for c in [
-    "email_id", "person_id", "from_norm", "dt_utc",
-    "domain_sender", "internal_sender", "mass_mail",
-    "employee_dir", "folder", "path", "subject"
-] if c in df.columns]
-docindex = df[doc_cols].copy()
-docindex["reply_flag"]   = df["subject"].str.lower().str.startswith("re:")
-docindex["forward_flag"] = df["subject"].str.lower().str.startswith("fwd:")
-
-# ------------ save ------------
-textbase.to_parquet(os.path.join(OUT_DIR, "TextBase_9902.parquet"), index=False)
-sent_df.to_parquet(os.path.join(OUT_DIR, "Sentence_9902.parquet"), index=False)
-docindex.to_parquet(os.path.join(OUT_DIR, "DocIndex_9902.parquet"), index=False)
-
-print("Saved output files to:", OUT_DIR)
-
-# ------------ Quick quality check ------------
-# Just summarising how many emails and sentences were processed successfully.
-n_total = len(df)
-n_text  = int(df["has_text"].sum())
-n_sent  = len(sent_df)
-median_tokens = int(df.loc[df["has_text"], "text_len_tokens"].median() if n_text else 0)
-
-print("\n QA:")
-print(f"  Emails total: {n_total:,}")
-print(f"  With text   : {n_text:,}")
-print(f"  Sentences   : {n_sent:,}")
-print(f"  Median tokens/email (has_text): {median_tokens}")
+def output_schemas(in_schema: pa.Schema):
+    """Fixed Arrow schemas for TextBase / DocIndex so every row group matches."""
+    def typ(c):
+        return in_schema.field(c).type if c in in_schema.names else pa.string()
+    text_types = {"text_len_chars": pa.int64(), "text_len_tokens": pa.int64(), "has_text": pa.bool_(),
+                  "dup_cluster_id": typ("dup_cluster_id")}
+    text = pa.schema([(c, text_types.get(c, pa.string())) for c in TEXT_COLS
+                      if c != "dup_cluster_id" or c in in_schema.names])
+    doc = pa.schema([(c, typ(c)) for c in DOC_COLS if c in in_schema.names]
+                    + [("reply_flag", pa.bool_()), ("forward_flag", pa.bool_())])
+    return text, doc
+
+# ------------ Per-chunk transform (runs in the worker processes) ------------
+def process_chunk(batch: pa.RecordBatch, text_schema: pa.Schema, doc_schema: pa.Schema):
+    """One batch of cleaned emails -> (TextBase, Sentence, DocIndex) Arrow tables."""
+    # Here I’m creating standardised subject and cleaned body fields,
+    # plus some useful metadata for length and text presence.
+    df = batch.to_pandas()
+    df["subject_norm"]    = df["subject"].apply(normalize_subject)
+    df["body_clean"]      = clean_body_batch(batch.column("body_raw")).to_numpy(zero_copy_only=False)
+    df["text_len_chars"]  = df["body_clean"].str.len()
+    df["text_len_tokens"] = df["body_clean"].str.split().str.len()
+    df["has_text"]        = (df["text_len_tokens"].fillna(0) >= 3)
+
+    # Sentence-level table: each email body broken into sentences with IDs
+    ids, idxs, texts = [], [], []
+    for eid, body in zip(df.loc[df["has_text"], "email_id"], df.loc[df["has_text"], "body_clean"]):
+        for i, s in enumerate(sent_tokenize(body)):
+            s = s.strip()
+            if s:
+                ids.append(eid); idxs.append(i); texts.append(s)
+    sent = pa.table({
+        "sentence_id": [f"{eid}|s{i}" for eid, i in zip(ids, idxs)],
+        "email_id": ids, "sent_idx": idxs, "sentence_text": texts,
+    }, schema=SENT_SCHEMA)
+
+    # Metadata / document index for joins and filtering later on
+    docindex = df[[c for c in doc_schema.names if c in df.columns]].copy()
+    docindex["reply_flag"]   = df["subject"].str.lower().str.startswith("re:")
+    docindex["forward_flag"] = df["subject"].str.lower().str.startswith("fwd:")
+
+    textbase = pa.Table.from_pandas(df[text_schema.names], schema=text_schema, preserve_index=False)
+    docindex = pa.Table.from_pandas(docindex, schema=doc_schema, preserve_index=False)
+    n_tokens = df.loc[df["has_text"], "text_len_tokens"].to_numpy()
+    return textbase, sent, docindex, n_tokens
+
+def iter_results(batches, fn, workers: int):
+    """Yields fn(batch) in input order, keeping at most 2*workers batches in flight."""
+    if workers <= 1:
+        for b in batches:
+            yield fn(b)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        pending = deque()
+        for b in batches:
+            pending.append(ex.submit(fn, b))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def peak_rss_mb():
+    """(main process, largest worker) peak RSS in MB, or None where `resource` is unavailable (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024      # ru_maxrss: bytes on macOS, KB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return own, kids
+
+def main():
+    ap = argparse.ArgumentParser(description="Build TextBase / Sentence / DocIndex from the cleaned emails.")
+    ap.add_argument("--input", default=str(INPUT_CLEAN))
+    ap.add_argument("--out-dir", default=str(OUT_DIR))
+    ap.add_argument("--workers", type=int, default=WORKERS)
+    ap.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = ap.parse_args()
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # Quick path check just to make sure the cleaned file exists
+    assert os.path.exists(args.input), f"Not found: {args.input}\nCheck filename and path."
+
+    # Download the NLTK tokenizer (used for splitting sentences)
+    nltk.download("punkt", quiet=True)
+    nltk.download("punkt_tab", quiet=True)
+
+    # ------------ Stream the cleaned dataset ------------
+    dataset = ds.dataset(args.input, format="parquet",
+                         partitioning="hive" if os.path.isdir(args.input) else None)
+    text_schema, doc_schema = output_schemas(dataset.schema)
+    # a dataset written with a body store has no body_raw column: bodies come from the store
+    store = None if "body_raw" in dataset.schema.names else BodyStore(store_for(args.input))
+    read_cols = list(dict.fromkeys(["email_id", "subject"] + ([] if store else ["body_raw"])
+                                   + [c for c in doc_schema.names + text_schema.names if c in dataset.schema.names]))
+    print(f"Streaming {dataset.count_rows():,} emails from {args.input} "
+          f"({args.workers} workers, {args.chunk_rows:,} rows/chunk)")
+
+    batches = dataset.to_batches(columns=read_cols, batch_size=args.chunk_rows)
+    if store:
+        batches = (store.attach(b) for b in batches)
+    fn = partial(process_chunk, text_schema=text_schema, doc_schema=doc_schema)
+
+    paths = {
+        "text": out_dir / "TextBase_9902.parquet",
+        "sent": out_dir / "Sentence_9902.parquet",
+        "doc":  out_dir / "DocIndex_9902.parquet",
+    }
+    writers = {
+        "text": pq.ParquetWriter(paths["text"], text_schema),
+        "sent": pq.ParquetWriter(paths["sent"], SENT_SCHEMA),
+        "doc":  pq.ParquetWriter(paths["doc"], doc_schema),
+    }
+
+    t0 = time.perf_counter()
+    n_total = n_text = n_sent = 0
+    tokens = []
+    try:
+        for textbase, sent, docindex, n_tokens in iter_results(batches, fn, args.workers):
+            writers["text"].write_table(textbase)
+            writers["sent"].write_table(sent)
+            writers["doc"].write_table(docindex)
+            n_total += textbase.num_rows
+            n_text  += len(n_tokens)
+            n_sent  += sent.num_rows
+            tokens.append(n_tokens)
+            print(f"  ... {n_total:,} emails, {n_sent:,} sentences", end="\r")
+    finally:
+        for w in writers.values():
+            w.close()
+    elapsed = time.perf_counter() - t0
+
+    print("\nSaved output files to:", out_dir)
+
+    # ------------ Quick quality check ------------
+    # Just summarising how many emails and sentences were processed successfully.
+    median_tokens = int(np.median(np.concatenate(tokens)) if n_text else 0)
+
+    print("\n QA:")
+    print(f"  Emails total: {n_total:,}")
+    print(f"  With text   : {n_text:,}")
+    print(f"  Sentences   : {n_sent:,}")
+    print(f"  Median tokens/email (has_text): {median_tokens}")
+
+    print("\n Throughput:")
+    print(f"  Elapsed     : {elapsed:,.1f} s")
+    print(f"  Emails/s    : {n_total / max(elapsed, 1e-9):,.0f}")
+    print(f"  Sentences/s : {n_sent / max(elapsed, 1e-9):,.0f}")
+    rss = peak_rss_mb()
+    if rss is None:
+        print("  Peak RSS    : n/a (resource module not available on this platform)")
+    else:
+        print(f"  Peak RSS    : main {rss[0]:,.0f} MB | largest worker {rss[1]:,.0f} MB")
+
+if __name__ == "__main__":
+    main()
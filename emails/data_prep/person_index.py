@@ -0,0 +1,57 @@
+# person_index.py
+# Persistent person_id (normalised email address) -> int32 person_key dictionary.
+# preprocess.py extends and saves it on every run; keys never change once assigned
+# (person_key == row number in PersonIndex.parquet), so int32 columns written by one run stay
+# valid for every later stage. Stages group/merge on the keys and call decode() only when
+# writing string person_ids out.
+
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+SCHEMA = pa.schema([("person_key", pa.int32()), ("person_id", pa.string())])
+
+def load_person_index(path) -> pa.Table:
+    path = Path(path)
+    if not path.exists():
+        return SCHEMA.empty_table()
+    return pq.read_table(path, schema=SCHEMA)
+
+def save_person_index(index: pa.Table, path):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(index, path)
+
+def _ids(index: pa.Table) -> pa.Array:
+    return index["person_id"].combine_chunks()
+
+def extend_person_index(index: pa.Table, addresses) -> pa.Table:
+    """Appends unseen, non-empty addresses (sorted) with the next free keys."""
+    if isinstance(addresses, pa.ChunkedArray):
+        addresses = addresses.combine_chunks()
+    distinct = pc.unique(addresses.drop_null())
+    unseen = pc.and_(pc.invert(pc.is_in(distinct, value_set=_ids(index))), pc.not_equal(distinct, ""))
+    new = distinct.filter(unseen)
+    if not len(new):
+        return index
+    new = new.take(pc.sort_indices(new)).cast(pa.string())
+    keys = pa.array(np.arange(index.num_rows, index.num_rows + len(new), dtype=np.int32))
+    return pa.concat_tables([index, pa.table([keys, new], schema=SCHEMA)])
+
+def encode(values, index: pa.Table) -> pa.Array:
+    """Addresses -> int32 person_keys (null where the address is unknown/empty)."""
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    return pc.index_in(values, value_set=_ids(index)).cast(pa.int32())
+
+def encode_lists(lists, index: pa.Table) -> pa.ListArray:
+    """list<string> addresses -> list<int32> person_keys, reusing the list offsets."""
+    if isinstance(lists, pa.ChunkedArray):
+        lists = lists.combine_chunks()
+    return pa.ListArray.from_arrays(lists.offsets, encode(lists.values, index))
+
+def decode(keys, index: pa.Table) -> np.ndarray:
+    """int person_keys (array-like) -> person_id strings."""
+    ids = _ids(index).to_numpy(zero_copy_only=False)
+    return ids[np.asarray(keys, dtype=np.int64)]
@@ -11,12 +11,22 @@ Original file is located at
 ## First round of cleaing
 """
 
-import re, hashlib, pandas as pd
+import re, pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from pathlib import Path
 from urllib.parse import unquote
+from near_dup import assign_dup_clusters
+from person_index import load_person_index, save_person_index, extend_person_index, encode, encode_lists
+from emails_dataset import write_emails_dataset
 
-IN_PATH  = Path("Emails.parquet")
+IN_PATH  = Path("Emails.parquet")    # or the Emails/ partition dir written by extract_emails.py --incremental
 OUT_PATH = Path("new_data/Emails_clean_new.parquet")
+PERSON_INDEX = OUT_PATH.parent / "PersonIndex.parquet"   # person_id -> int32 person_key, kept across runs
+OUT_DATASET = OUT_PATH.parent / "Emails_clean"           # same rows as a year=/month= dataset sorted by dt_utc
+BODY_STORE = OUT_PATH.parent / "BodyStore"               # the dataset's bodies, deduped + zstd (body_store.py)
 
 ENRON_DOMAIN = "enron.com"
 MASS_MAIL_THRESHOLD = 15
@@ -44,33 +54,73 @@ def norm_addr_list(addr_list):
             out_data.append(a)
     return out_data
 
-def simple_bodyhash(row):
-    key = f"{row.get('from_raw','')}|{row.get('subject','')}|{row.get('dt_utc','')}|{(row.get('body_raw','') or '')[:200]}"
-    return hashlib.md5(key.encode("utf-8")).hexdigest()
+def norm_addr_values(values: pa.Array) -> pa.Array:
+    """norm_addr over a string array, evaluated once per distinct value and mapped back."""
+    enc = pc.dictionary_encode(values)
+    if isinstance(enc, pa.ChunkedArray):
+        enc = enc.combine_chunks()
+    distinct = pa.array([norm_addr(a) for a in enc.dictionary.to_pylist()], pa.string())
+    return distinct.take(enc.indices).fill_null("")
+
+def norm_addr_lists(col) -> pa.ListArray:
+    """Vectorised norm_addr_list for a whole list<string> column (e.g. to_list).
+
+    Addresses are flattened, normalised per distinct string and put back under the original
+    list offsets (zero-copy). Only when some address normalises to "" are the offsets
+    recomputed, to drop those entries just like norm_addr_list does.
+    """
+    if isinstance(col, pa.ChunkedArray):
+        col = col.combine_chunks()
+    col = col.fill_null(pa.scalar([], col.type))
+    values = norm_addr_values(col.values)
+    empty = pc.equal(values, "")
+    if not pc.any(empty).as_py():
+        return pa.ListArray.from_arrays(col.offsets, values)
+
+    # drop empties: re-count the surviving entries of each list
+    flat = col.flatten()
+    start = col.offsets[0].as_py()
+    flat_vals = values.slice(start, len(flat))
+    keep = pc.invert(empty.slice(start, len(flat)))
+    parents = pc.list_parent_indices(col).to_numpy()
+    counts = np.bincount(parents[keep.to_numpy(zero_copy_only=False)], minlength=len(col))
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+    return pa.ListArray.from_arrays(pa.array(offsets), flat_vals.filter(keep))
+
+def simple_bodyhash(df: pd.DataFrame) -> pd.Series:
+    """Exact-duplicate key per row: 64-bit hash of from_raw|subject|dt_utc|first 200 body chars."""
+    def col(c):
+        return df[c].fillna("").astype(str) if c in df.columns else pd.Series("", index=df.index)
+    key = col("from_raw") + "|" + col("subject") + "|" + col("dt_utc") + "|" + col("body_raw").str.slice(0, 200)
+    return pd.util.hash_pandas_object(key, index=False)
 
 def main():
     OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    df = pd.read_parquet(IN_PATH)
-
-    df["_bodyhash"] = df.apply(simple_bodyhash, axis=1)
+    table = pq.read_table(IN_PATH)
+    df = table.to_pandas()
+
+    # Normalise addresses on the Arrow columns (each distinct address once), before dedupe
+    # so rows still line up with `table`
+    df["from_norm"] = norm_addr_values(table.column("from_raw")).to_pandas().values
+    n_recips = np.zeros(len(df), dtype="int32")
+    norm_lists = {}
+    for src, dst in (("to_list", "to_norm"), ("cc_list", "cc_norm"), ("bcc_list", "bcc_norm")):
+        lists = norm_lists[dst] = norm_addr_lists(table.column(src))
+        n_recips += pc.list_value_length(lists).to_numpy(zero_copy_only=False).astype("int32")
+        df[dst] = lists.to_pandas().values
+    df["recipient_count"] = n_recips
+    del table
+
+    df["_bodyhash"] = simple_bodyhash(df)
     # Create a dedupe key preferring msg_id
     #dedupe_key = df["msg_id"].fillna("") + "|" + df["_bodyhash"]
     #df = df.loc[~dedupe_key.duplicated()].copy()
     df = df.drop_duplicates(subset="_bodyhash").copy()
 
     # Sender normalization -> person_id
-    df["from_norm"] = df["from_raw"].fillna("").map(norm_addr)
     df["person_id"] = df["from_norm"]  # for now, use normalized sender email as ID
 
-    # Recipients normalization
-    df["to_norm"]  = df["to_list"].map(norm_addr_list)
-    df["cc_norm"]  = df["cc_list"].map(norm_addr_list)
-    df["bcc_norm"] = df["bcc_list"].map(norm_addr_list)
-
-    # Recipient count & flags
-    df["recipient_count"] = (df["to_norm"].map(len).fillna(0)
-                            + df["cc_norm"].map(len).fillna(0)
-                            + df["bcc_norm"].map(len).fillna(0)).astype("int32")
+    # Recipient flags (recipient_count is computed with the normalised lists above)
     df["domain_sender"]   = df["from_norm"].map(lambda a: a.split("@")[-1] if "@" in a else "")
     df["internal_sender"] = (df["domain_sender"] == ENRON_DOMAIN)
     df["mass_mail"]       = df["recipient_count"] >= MASS_MAIL_THRESHOLD
@@ -78,11 +128,15 @@ def main():
 
     # Keep only B-schema columns
     keep = [
-        "email_id", "msg_id", "x_from", "x_to","person_id","from_norm","to_norm","cc_norm","bcc_norm",
+        "email_id", "msg_id", "in_reply_to", "references",
+        "x_from", "x_to","person_id","from_norm","to_norm","cc_norm","bcc_norm",
         "recipient_count","dt_utc","subject","body_raw",
         "internal_sender","mass_mail","domain_sender",
         "employee_dir","folder","path"
     ]
+    # (in_reply_to / references only exist in extracts made since extract_emails.py captured them)
+    # headers-only extracts (extract_emails.py --headers-only) carry body offsets instead of body_raw
+    keep = [c for c in keep if c in df.columns] + [c for c in ("body_offset", "body_length") if c in df.columns]
 
     # keep = [
     #     "email_id", "person_id","from_norm","to_norm","cc_norm","bcc_norm",
@@ -121,7 +175,8 @@ def main():
     print("Mass mails:", df["mass_mail"].sum())
     print("\n")
 
-    print("Emails with empty body:", (df["body_raw"].str.strip() == "").sum())
+    if "body_raw" in df.columns:
+        print("Emails with empty body:", (df["body_raw"].str.strip() == "").sum())
 
 
     df = df[df["recipient_count"] > 0]
@@ -133,10 +188,32 @@ def main():
 
 
     valid_df = df.loc[df["from_norm"].fillna("").str.match(email_re)].copy()
+
+    # Near-duplicates (same mail in several folders, light re-forwards): MinHash/LSH clusters.
+    # Rows are kept; dup_cluster_id lets the NLP stages score one row per cluster.
+    valid_df = assign_dup_clusters(valid_df)
+    n_clusters = valid_df["dup_cluster_id"].nunique()
+    print(f"Near-duplicate clusters: {n_clusters:,} for {len(valid_df):,} emails "
+          f"({len(valid_df) - n_clusters:,} rows are near-copies)")
+
+    # Integer person keys: extend the persistent PersonIndex with this run's addresses and add
+    # person_key (sender) plus to_keys/cc_keys/bcc_keys (list<int32>) next to the string columns
+    rows = valid_df.index.to_numpy()                 # still the row positions of `table`
+    keyed = {c: norm_lists[c].take(pa.array(rows)) for c in norm_lists}
+    senders = pa.array(valid_df["from_norm"].tolist(), pa.string())
+    person_index = extend_person_index(load_person_index(PERSON_INDEX),
+                                       pa.concat_arrays([senders] + [keyed[c].flatten() for c in keyed]))
+    save_person_index(person_index, PERSON_INDEX)
+    valid_df["person_key"] = encode(senders, person_index).to_numpy(zero_copy_only=False).astype("int32")
+    for c in ("to_norm", "cc_norm", "bcc_norm"):
+        valid_df[c.replace("_norm", "_keys")] = encode_lists(keyed[c], person_index).to_pandas().values
+    print(f"PersonIndex: {person_index.num_rows:,} people -> {PERSON_INDEX}")
     print(valid_df.info())
 
     valid_df.to_parquet(OUT_PATH, index=False)
     print(f"Wrote {len(valid_df):,} rows to {OUT_PATH}")
+    write_emails_dataset(valid_df, OUT_DATASET, body_store=BODY_STORE)
+    print(f"Wrote year=/month= partitioned dataset to {OUT_DATASET} (bodies in {BODY_STORE})")
 
 
 if __name__ == "__main__":
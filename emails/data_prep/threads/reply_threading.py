@@ -0,0 +1,208 @@
+# reply_threading.py
+# JWZ-style threading from the reply headers, written to the same Threads / ThreadEmails /
+# ThreadText / ThreadSentence tables as thread_construction.py (plus a parent_ids reply-tree column).
+#
+#   1. Every Message-ID, In-Reply-To and References id is a node; each email is joined to its
+#      In-Reply-To and to the last id of its References, and the References chain is joined
+#      link by link (missing messages stay in as placeholder nodes, so two replies to a message
+#      we never saw still meet). A union-find over the nodes gives the threads.
+#   2. Emails with neither header fall back to the subject: a "Re:"/"Fwd:" email joins the
+#      previous email with the same subject root if it is at most THREAD_WINDOW older and the two
+#      share at least one participant.
+#
+# Union-find with path halving, so the whole corpus threads in near-linear time. Unlike the
+# subject + exact-participants key, a reply that adds a Cc stays in its conversation and
+# unrelated emails that merely share a subject and people stay apart.
+#
+#   python emails/data_prep/threads/reply_threading.py [--all-senders] [--window-days 14]
+
+import re, hashlib, argparse, time
+import numpy as np
+import pandas as pd
+
+from thread_construction import (INPUT_CLEAN, OUT_DIR, PERSON_INDEX, INTERNAL_ONLY, EMAIL_COLUMNS,
+                                 SENTENCES, out_paths, load_thread_emails, ensure_keys, subject_roots,
+                                 participant_pairs, build_tables, _lists)
+from person_index import load_person_index
+
+THREAD_WINDOW = pd.Timedelta(days=14)     # subject fallback: max gap to the previous email
+HEADER_COLUMNS = ["msg_id", "in_reply_to", "references"]
+
+_MSG_ID = re.compile(r"<[^<>\s]+>")
+_REPLY_PREFIX = re.compile(r"^\s*(re|fw|fwd)\s*:", re.I)
+
+def norm_msg_id(v):
+    """Message-ID as stored by extract_emails.py -> "<id>" (None if empty)."""
+    if not isinstance(v, str) or not v.strip():
+        return None
+    m = _MSG_ID.search(v)
+    return m.group(0) if m else v.strip()
+
+# ------------ Union-find ------------
+def _find(parent: list, x: int) -> int:
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]       # path halving
+        x = parent[x]
+    return x
+
+def union_all(n: int, a, b) -> np.ndarray:
+    """Connected components of n nodes under the edges (a[i], b[i]) -> root label per node."""
+    parent = list(range(n))
+    for x, y in zip(a, b):
+        rx, ry = _find(parent, x), _find(parent, y)
+        if rx != ry:
+            if rx < ry:
+                parent[ry] = rx
+            else:
+                parent[rx] = ry
+    return np.array([_find(parent, x) for x in range(n)], dtype=np.int64)
+
+# ------------ Links ------------
+def header_links(df: pd.DataFrame):
+    """Message-id graph: node per email, node count, edges (a, b), parent node per email (-1 if
+    none), which emails carry reply headers, older References per email (nearest first), and
+    the id -> node map. An email without a Message-ID gets a node of its own.
+    """
+    n = len(df)
+    own = [norm_msg_id(v) for v in df["msg_id"]] if "msg_id" in df.columns else [None] * n
+    irt = [norm_msg_id(v) for v in df["in_reply_to"]] if "in_reply_to" in df.columns else [None] * n
+    refs = ([[r for r in map(norm_msg_id, v) if r] if v is not None else [] for v in df["references"]]
+            if "references" in df.columns else [[] for _ in range(n)])
+
+    node_of = {}
+    def node(mid):
+        return node_of.setdefault(mid, len(node_of))
+
+    email_node = np.array([node(m) if m else node(("row", i)) for i, m in enumerate(own)], dtype=np.int64)
+    a, b = [], []
+    parent_node = np.full(n, -1, dtype=np.int64)
+    for i in range(n):
+        chain = refs[i]
+        for x, y in zip(chain, chain[1:]):            # References: oldest ... direct parent
+            a.append(node(x)); b.append(node(y))
+        direct = chain[-1] if chain else irt[i]       # References wins, as in JWZ
+        if irt[i] and irt[i] != direct:
+            a.append(node(irt[i])); b.append(email_node[i])
+        if direct and direct != own[i]:
+            parent_node[i] = node(direct)
+            a.append(parent_node[i]); b.append(email_node[i])
+    has_headers = np.array([bool(irt[i] or refs[i]) for i in range(n)], dtype=bool)
+    ancestors = [list(reversed(refs[i][:-1])) for i in range(n)]    # fallbacks if the parent is missing
+    return email_node, len(node_of), np.array(a, dtype=np.int64), np.array(b, dtype=np.int64), \
+        parent_node, has_headers, ancestors, node_of
+
+def subject_links(df: pd.DataFrame, root_codes, roots, has_headers, rows, keys, window=THREAD_WINDOW):
+    """Subject fallback -> (earlier email row, reply row) pairs for emails without reply headers."""
+    n = len(df)
+    dt = df["dt_utc"].to_numpy(dtype="datetime64[ns]")
+    order = np.lexsort((np.arange(n), dt, root_codes))               # by root, then time
+    prev, cur = order[:-1], order[1:]
+    is_reply = df["subject"].fillna("").str.match(_REPLY_PREFIX).to_numpy(dtype=bool)
+    empty_root = np.array([r == "" for r in roots], dtype=bool)[root_codes]
+    gap = dt[cur] - dt[prev]
+    ok = ((root_codes[prev] == root_codes[cur]) & ~empty_root[cur] & is_reply[cur] & ~has_headers[cur]
+          & ~np.isnat(gap) & (gap <= window.to_timedelta64()))
+    prev, cur = prev[ok], cur[ok]
+
+    # shared participant: any person_key of `cur` among the keys of `prev`
+    width = int(keys.max()) + 1 if len(keys) else 1
+    codes = rows * width + keys                                       # sorted (rows, keys are)
+    counts = np.bincount(rows, minlength=n)
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    per = counts[cur]
+    j = np.repeat(np.arange(len(cur)), per)
+    k = keys[starts[cur][j] + (np.arange(per.sum()) - np.r_[0, np.cumsum(per)[:-1]][j])]
+    probe = prev[j] * width + k
+    pos = np.minimum(np.searchsorted(codes, probe), max(len(codes) - 1, 0))
+    hit = codes[pos] == probe if len(codes) else np.zeros(0, dtype=bool)
+    shared = np.bincount(j, weights=hit, minlength=len(cur)) > 0
+    return prev[shared], cur[shared]
+
+# ------------ Threads ------------
+def reply_threads(df: pd.DataFrame, window=THREAD_WINDOW):
+    """-> (thread code per email, sorted thread_ids, parent row per email or -1, stats).
+
+    df must be sorted by dt_utc (the parent of an email is always an earlier row).
+    """
+    n = len(df)
+    root_codes, roots = subject_roots(df["subject"])
+    rows, keys = participant_pairs(df)
+    email_node, n_nodes, a, b, parent_node, has_headers, ancestors, node_of = header_links(df)
+    s_prev, s_cur = subject_links(df, root_codes, roots, has_headers, rows, keys, window)
+
+    label = union_all(n_nodes, np.r_[a, email_node[s_prev]], np.r_[b, email_node[s_cur]])[email_node]
+
+    # reply tree: parent = earliest email carrying the parent's Message-ID (or, if that message
+    # is missing, the nearest earlier References entry that is present); must be an earlier row
+    first_row = np.full(n_nodes, -1, dtype=np.int64)
+    present, first = np.unique(email_node, return_index=True)
+    first_row[present] = first
+    parent = np.full(n, -1, dtype=np.int64)
+    for i in np.flatnonzero(parent_node >= 0).tolist():
+        cand = [parent_node[i]] + [node_of[r] for r in ancestors[i]]
+        for nd in cand:
+            p = first_row[nd]
+            if 0 <= p < i:
+                parent[i] = p
+                break
+    parent[s_cur] = s_prev
+
+    # thread_id: md5 of the thread's earliest email_id (stable while that email exists)
+    uniq, comp = np.unique(label, return_inverse=True)
+    root_row = np.full(len(uniq), n, dtype=np.int64)
+    np.minimum.at(root_row, comp, np.arange(n))
+    ids = df["email_id"].to_numpy()
+    tid = np.array([hashlib.md5(str(ids[r]).encode()).hexdigest()[:16] for r in root_row.tolist()], dtype=object)
+    thread_ids, tcode = np.unique(tid[comp], return_inverse=True)
+    stats = {"with_headers": int(has_headers.sum()), "subject_links": len(s_cur),
+             "header_parents": int((parent >= 0).sum()) - len(s_cur)}
+    return tcode, thread_ids.astype(object), parent, (root_codes, roots, rows, keys), stats
+
+def main():
+    ap = argparse.ArgumentParser(description="Thread emails by Message-ID / In-Reply-To / References.")
+    ap.add_argument("--input", default=str(INPUT_CLEAN))
+    ap.add_argument("--all-senders", action="store_true", default=not INTERNAL_ONLY,
+                    help="thread the whole corpus instead of internal senders only")
+    ap.add_argument("--window-days", type=float, default=THREAD_WINDOW / pd.Timedelta(days=1),
+                    help="subject fallback: max days between an email and the reply joined to it")
+    ap.add_argument("--sentences", default=str(SENTENCES),
+                    help="email sentence table from nlp_prep.py (ThreadSentence references it)")
+    args = ap.parse_args()
+    internal_only = not args.all_senders
+    paths = out_paths(internal_only)
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    t0 = time.perf_counter()
+    df = load_thread_emails(args.input, internal_only, columns=EMAIL_COLUMNS + HEADER_COLUMNS)
+    df = df.sort_values("dt_utc", kind="stable").reset_index(drop=True)
+    print(f"Loaded {len(df):,} emails" + (" (internal senders only)" if internal_only else " (all senders)"))
+    df, person_index = ensure_keys(df, load_person_index(PERSON_INDEX))
+
+    tcode, thread_ids, parent, (root_codes, roots, rows, keys), stats = reply_threads(
+        df, pd.Timedelta(days=args.window_days))
+    df["subject_root"] = roots[root_codes]
+    df["thread_id"] = thread_ids[tcode]
+    t_keys = time.perf_counter()
+    print(f"Reply headers on {stats['with_headers']:,} emails ({stats['header_parents']:,} parents found); "
+          f"subject fallback linked {stats['subject_links']:,} more")
+
+    tables = build_tables(df, person_index, rows, keys, args.sentences)
+    threads = tables["Threads"]
+    ids = df["email_id"].to_numpy()
+    parent_ids = np.where(parent >= 0, ids[np.maximum(parent, 0)], None)
+    by_thread = np.argsort(tcode, kind="stable")
+    threads["parent_ids"] = _lists(parent_ids[by_thread], np.bincount(tcode, minlength=len(thread_ids)))
+    t_text = time.perf_counter()
+    for name, table in tables.items():
+        table.to_parquet(paths[name], index=False)
+        print(f"{paths[name].name}:", table.shape)
+
+    print("\nQA:")
+    print("  Total threads:", len(threads))
+    print("  Multi-email  :", int((threads["n_emails"] > 1).sum()))
+    print("  With text    :", tables["ThreadText"]["has_text"].sum())
+    print("  Total thread sentences:", int(tables["ThreadSentence"]["n_sents"].sum()))
+    print(f"  Timing       : load + threading {t_keys - t0:.1f} s | tables {t_text - t_keys:.1f} s")
+
+if __name__ == "__main__":
+    main()
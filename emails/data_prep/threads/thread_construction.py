@@ -1,15 +1,28 @@
-import os, re, hashlib
+import os, re, sys, hashlib, argparse, time
 from pathlib import Path
+import numpy as np
 import pandas as pd
-import nltk
-from nltk.tokenize import sent_tokenize
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
-INPUT_CLEAN = Path("data/Emails_clean_9902.parquet")    # already cleaned emails
+sys.path.append(str(Path(__file__).resolve().parents[1]))          # emails/data_prep
+from person_index import load_person_index, extend_person_index, encode, encode_lists, decode
+from emails_dataset import load_emails, open_emails_dataset, load_bodies
+from thread_text import render_threads, text_stats
+from thread_sentences import SENTENCES, REF_COLS, build_thread_sentences
+
+INPUT_CLEAN = Path("data/Emails_clean_9902.parquet")    # already cleaned emails (data/Emails_clean works too)
 OUT_DIR = Path("data/threads")
-OUT_DIR.mkdir(parents=True, exist_ok=True)
+PERSON_INDEX = Path("data/PersonIndex.parquet")         # written by preprocess.py
+INTERNAL_ONLY = True        # False / --all-senders: thread every email, not just internal senders
 
-nltk.download("punkt", quiet=True)
-nltk.download("punkt_tab", quiet=True)
+EMAIL_COLUMNS = ["email_id", "person_id", "from_norm", "to_norm", "cc_norm", "bcc_norm",
+                 "person_key", "to_keys", "cc_keys", "bcc_keys",
+                 "dt_utc", "subject", "body_raw", "internal_sender"]
+KEY_COLS = ["to_keys", "cc_keys", "bcc_keys"]
+TABLES = ["Threads", "ThreadEmails", "ThreadText", "ThreadSentence"]
 
 def normalize_subject(subj: str) -> str:
     if pd.isna(subj): return ""
@@ -19,104 +32,262 @@ def normalize_subject(subj: str) -> str:
     s = re.sub(r'\s+', ' ', s)
     return s.strip()
 
-def format_email_block(sub):
-    """Format emails within one thread in chronological order with separators."""
-    sub = sub.sort_values("dt_utc")
-    blocks = []
-    for i, row in enumerate(sub.itertuples(index=False)):
-        header = (
-            f"\n--- EMAIL {i+1}/{len(sub)} ---\n"
-            f"From: {row.from_norm}\n"
-            f"Date: {row.dt_utc}\n"
-            f"Subject: {row.subject_root}\n\n"
-        )
-        body = (row.body_raw)
-        if body.strip():
-            blocks.append(header + body)
-    return "\n\n".join(blocks).strip()
-
-
-# Load cleaned emails
-df = pd.read_parquet(INPUT_CLEAN)
-print("Loaded:", df.shape)
-
-print(f"Original length: {len(df):,} emails")
-
-if "internal_sender" in df.columns:
-    df = df[df["internal_sender"] == True].copy()
-else:
-    df = df[df["person_id"].str.endswith("@enron.com", na=False)].copy()
-
-print(f"Filtered to internal senders only: {len(df):,} emails")
-
-
-# subject normalization at email-level (helps thread grouping)
-df["subject_root"] = df["subject"].map(normalize_subject)
-
-# participants string for grouping
-df["participants"] = df.apply(
-    lambda r: sorted(set([r["from_norm"]] + list(r["to_norm"]) + list(r["cc_norm"]) + list(r["bcc_norm"]))),
-    axis=1,
-)
-df["participants_str"] = df["participants"].map(lambda lst: "|".join(lst))
-
-# stable thread_id (hash of subject_root + participants)
-df["thread_id"] = df.apply(
-    lambda r: hashlib.md5((r["subject_root"] + "|" + r["participants_str"]).encode()).hexdigest(),
-    axis=1
-)
-
-# Threads.parquet
-threads = df.groupby("thread_id").agg(
-    n_emails=("email_id", "count"),
-    participants=("participants", lambda x: sorted(set(p for sub in x for p in sub))),
-    start_dt=("dt_utc", "min"),
-    end_dt=("dt_utc", "max"),
-    subject_root=("subject_root", "first"),
-    root_email_id=("email_id", "first"),
-    email_ids=("email_id", lambda x: list(x))
-).reset_index()
-
-threads.to_parquet(OUT_DIR / "Threads_internal_9902.parquet", index=False)
-print("Threads_9902.parquet:", threads.shape)
-
-# build ThreadText.parquet
-# thread_text = df.groupby("thread_id").agg(
-#     subject_norm=("subject_root", "first"),
-#     body_concat=("body_raw", lambda x: "\n\n".join(clean_body(b) for b in x if b.strip())),
-# ).reset_index()
-
-thread_text = (
-    df.groupby("thread_id")
-      .apply(format_email_block)
-      .reset_index(name="body_concat")
-)
-
-
-thread_text["n_tokens"] = thread_text["body_concat"].map(lambda t: len(t.split()))
-thread_text["has_text"] = thread_text["n_tokens"] > 0
-
-thread_text.to_parquet(OUT_DIR / "ThreadText_internal_9902.parquet", index=False)
-print("ThreadText.parquet:", thread_text.shape)
-
-# ThreadSentence.parquet
-sent_rows = []
-for _, row in thread_text[thread_text["has_text"]].iterrows():
-    for i, s in enumerate(sent_tokenize(row["body_concat"])):
-        s = s.strip()
-        if s:
-            sent_rows.append({
-                "sentence_id": f"{row['thread_id']}|s{i}",
-                "thread_id": row["thread_id"],
-                "sent_idx": i,
-                "sentence_text": s
-            })
-sent_df = pd.DataFrame(sent_rows)
-sent_df.to_parquet(OUT_DIR / "ThreadSentence_internal_9902.parquet", index=False)
-print("ThreadSentence_9902.parquet:", sent_df.shape)
-
-print("\nQA:")
-print("  Total threads:", len(threads))
-print("  With text    :", thread_text['has_text'].sum())
-print("  Total thread sentences:", len(sent_df))
+def out_paths(internal_only: bool):
+    tag = "internal_9902" if internal_only else "9902"
+    return {name: OUT_DIR / f"{name}_{tag}.parquet" for name in TABLES}
+
+# ------------ Loading ------------
+def load_thread_emails(path, internal_only: bool, columns=EMAIL_COLUMNS) -> pd.DataFrame:
+    dataset = open_emails_dataset(path)
+    names = dataset.schema.names
+    internal = (ds.field("internal_sender") == True) if internal_only and "internal_sender" in names else None
+    df = load_emails(columns=columns, path=path, filter=internal)
+    if internal_only and internal is None:
+        df = df[df["person_id"].str.endswith("@enron.com", na=False)]
+    return df.reset_index(drop=True)
+
+def ensure_keys(df: pd.DataFrame, person_index: pa.Table):
+    """Adds person_key / *_keys from from_norm / *_norm when the input predates them."""
+    if {"person_key", *KEY_COLS} <= set(df.columns):
+        return df, person_index
+    lists = {c: pa.array([[] if v is None else list(v) for v in df[c]], pa.list_(pa.string()))
+             for c in ("to_norm", "cc_norm", "bcc_norm")}
+    senders = pa.array(df["from_norm"].tolist(), pa.string())
+    person_index = extend_person_index(person_index, pa.concat_arrays([senders] + [l.flatten() for l in lists.values()]))
+    df["person_key"] = encode(senders, person_index).to_numpy(zero_copy_only=False)
+    for c, arr in lists.items():
+        df[c.replace("_norm", "_keys")] = encode_lists(arr, person_index).to_pandas().values
+    return df, person_index
+
+# ------------ Thread keys (vectorised) ------------
+def subject_roots(subjects: pd.Series):
+    """-> (root code per email, distinct roots); normalize_subject runs once per distinct subject."""
+    codes, uniq = pd.factorize(subjects, use_na_sentinel=False)
+    root_codes, roots = pd.factorize(np.array([normalize_subject(s) for s in uniq], dtype=object))
+    return root_codes[codes], np.asarray(roots, dtype=object)
+
+def participant_pairs(df: pd.DataFrame):
+    """Distinct (email row, person_key) pairs over from + to + cc + bcc, sorted by row then key."""
+    n = len(df)
+    rows = [np.arange(n)]
+    keys = [pd.to_numeric(df["person_key"]).to_numpy(dtype=float, na_value=np.nan)]
+    for col in KEY_COLS:
+        lens = df[col].map(len).to_numpy()
+        if lens.sum():
+            rows.append(np.repeat(np.arange(n), lens))
+            keys.append(np.concatenate([np.asarray(v, dtype=float) for v in df[col].values if len(v)]))
+    rows, keys = np.concatenate(rows), np.concatenate(keys)
+    ok = ~np.isnan(keys)                     # unknown / empty addresses
+    rows, keys = rows[ok], keys[ok].astype(np.int64)
+    width = int(keys.max()) + 1 if len(keys) else 1
+    pairs = np.unique(rows * width + keys)
+    return pairs // width, pairs % width
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    """splitmix64 finaliser on uint64 arrays (wrapping arithmetic)."""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def thread_hashes(root_codes, roots, rows, keys, n: int) -> np.ndarray:
+    """64-bit thread key per email: hash(subject_root) combined with an order-free hash of the
+    participant key set, so equal (subject_root, participants) always give the same key."""
+    subj = np.array([int.from_bytes(hashlib.md5(r.encode()).digest()[:8], "little") for r in roots],
+                    dtype=np.uint64)
+    people = np.zeros(n, dtype=np.uint64)
+    if len(rows):
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        people[rows[starts]] = np.add.reduceat(_mix64(keys.astype(np.uint64) + np.uint64(1)), starts)
+    return _mix64(subj[root_codes] ^ _mix64(people))
+
+# ------------ Output tables ------------
+def _lists(values: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    offsets = np.r_[0, np.cumsum(counts)].astype(np.int32)
+    return pa.ListArray.from_arrays(pa.array(offsets), pa.array(values, pa.string())).to_pandas().values
+
+def _ids_array(person_index: pa.Table) -> np.ndarray:
+    return decode(np.arange(person_index.num_rows), person_index).astype(object)
+
+def build_threads(df, tcode, thread_ids, rows, keys, person_index) -> pd.DataFrame:
+    """Threads table, one row per thread_id (sorted), same columns as before."""
+    n_threads = len(thread_ids)
+    g = df.groupby(tcode, sort=True)
+    threads = pd.DataFrame({
+        "thread_id": thread_ids,
+        "n_emails": g["email_id"].count().to_numpy(),
+    })
+
+    # participants: distinct person_ids over the thread, in string order
+    ids = _ids_array(person_index)
+    rank = np.empty(len(ids), dtype=np.int64)
+    rank[np.argsort(ids, kind="stable")] = np.arange(len(ids))
+    width = len(ids) or 1
+    pairs = np.unique(tcode[rows].astype(np.int64) * width + keys)
+    p_thread, p_key = pairs // width, pairs % width
+    order = np.lexsort((rank[p_key], p_thread))
+    threads["participants"] = _lists(ids[p_key[order]], np.bincount(p_thread, minlength=n_threads))
+
+    threads["start_dt"] = g["dt_utc"].min().array
+    threads["end_dt"] = g["dt_utc"].max().array
+    threads["subject_root"] = g["subject_root"].first().to_numpy()
+    threads["root_email_id"] = g["email_id"].first().to_numpy()
+    by_thread = np.argsort(tcode, kind="stable")
+    threads["email_ids"] = _lists(df["email_id"].to_numpy()[by_thread], np.bincount(tcode, minlength=n_threads))
+    return threads
+
+def build_thread_emails(df, tcode, thread_ids):
+    """ThreadEmails: every thread's emails in date order with the header fields the rendered
+    text needs (bodies stay in the emails dataset / body store). Also returns the row order."""
+    order = df.assign(_t=tcode).sort_values(["_t", "dt_utc"], kind="stable").index.to_numpy()
+    t = tcode[order]
+    counts = np.bincount(t, minlength=len(thread_ids))
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    thread_emails = pd.DataFrame({
+        "thread_id": thread_ids[t],
+        "email_id": df["email_id"].to_numpy()[order],
+        "pos": (np.arange(len(t)) - starts[t]).astype(np.int32),      # 0-based position in the thread
+        "n_emails": counts[t].astype(np.int32),
+        "from_norm": df["from_norm"].to_numpy()[order],
+        "dt_utc": df["dt_utc"].array[order],
+        "subject_root": df["subject_root"].to_numpy()[order],
+    })
+    return thread_emails, order
+
+def build_thread_text(thread_emails, bodies, thread_ids) -> pd.DataFrame:
+    """ThreadText with the rendered body_concat (kept in memory for n_tokens / has_text only)."""
+    thread_text = pd.DataFrame({"thread_id": thread_ids, "body_concat": render_threads(thread_emails, bodies)})
+    thread_text["n_tokens"], thread_text["has_text"] = text_stats(thread_text["body_concat"])
+    return thread_text
+
+def assign_threads(df: pd.DataFrame):
+    """Adds subject_root and thread_id to df; returns the (row, person_key) participant pairs."""
+    # subject normalization at email-level (helps thread grouping)
+    root_codes, roots = subject_roots(df["subject"])
+    df["subject_root"] = roots[root_codes]
+
+    # thread key = hash(subject_root, set of participant keys), computed on int arrays
+    rows, keys = participant_pairs(df)
+    hashes = thread_hashes(root_codes, roots, rows, keys, len(df))
+    uniq, tcode = np.unique(hashes, return_inverse=True)       # hex ids sort like the uint64 values
+    thread_ids = np.array([f"{h:016x}" for h in uniq.tolist()], dtype=object)
+    df["thread_id"] = thread_ids[tcode]
+    return rows, keys
+
+def build_tables(df: pd.DataFrame, person_index, rows=None, keys=None, sentences=SENTENCES) -> dict:
+    """Threads / ThreadEmails / ThreadText / ThreadSentence for the threads in df (thread_id set).
+
+    ThreadText is written without body_concat: the text is rendered from ThreadEmails and the
+    bodies when needed (thread_text.ThreadTextView). ThreadSentence holds references into the
+    email sentence table from nlp_prep.py (thread_sentences.py), not a second copy of the text.
+    """
+    thread_ids, tcode = np.unique(df["thread_id"].to_numpy(dtype=object), return_inverse=True)
+    if rows is None:
+        rows, keys = participant_pairs(df)
+    threads = build_threads(df, tcode, thread_ids, rows, keys, person_index)
+    thread_emails, order = build_thread_emails(df, tcode, thread_ids)
+    thread_text = build_thread_text(thread_emails, df["body_raw"].to_numpy()[order], thread_ids)
+    return {"Threads": threads, "ThreadEmails": thread_emails,
+            "ThreadText": thread_text.drop(columns="body_concat"),
+            "ThreadSentence": build_thread_sentences(thread_emails, sentences)}
+
+# ------------ Incremental mode ------------
+# Threads_*.parquet is the persistent thread index: thread_id (= hex of the 64-bit thread key),
+# member email_ids and start_dt/end_dt. A re-run recomputes the keys for every email (cheap, no
+# bodies), compares them with the index and rebuilds only the threads that gained or lost
+# emails; all other rows of the four tables are copied through unchanged.
+# Thread keys hash person keys, so they are only stable across runs with the persisted
+# PersonIndex: --incremental refuses to run without it, or when emails name people it lacks.
+def changed_threads(index: pa.Table, df: pd.DataFrame) -> list:
+    """Thread ids whose member set differs between the index and the current emails."""
+    lists = index.column("email_ids").combine_chunks()
+    old = pd.DataFrame({
+        "email_id": pc.list_flatten(lists).to_numpy(zero_copy_only=False),
+        "thread_old": index.column("thread_id").to_numpy()[pc.list_parent_indices(lists).to_numpy()],
+    })
+    m = df[["email_id", "thread_id"]].merge(old, on="email_id", how="outer")
+    moved = m["thread_id"].ne(m["thread_old"])                # new, removed or re-assigned emails
+    return sorted(set(m.loc[moved, "thread_id"].dropna()) | set(m.loc[moved, "thread_old"].dropna()))
+
+def replace_threads(path: Path, thread_ids: list, new: pd.DataFrame) -> int:
+    """Rewrites one thread table: rows of thread_ids are dropped and `new` appended (streamed)."""
+    dataset = ds.dataset(path, format="parquet")
+    schema = dataset.schema
+    tmp = path.with_suffix(".tmp.parquet")
+    keep = ~ds.field("thread_id").isin(pa.array(thread_ids, pa.string()))
+    n = 0
+    with pq.ParquetWriter(tmp, schema) as w:
+        for batch in dataset.to_batches(filter=keep):
+            if batch.num_rows:
+                w.write_batch(batch)
+                n += batch.num_rows
+        if len(new):
+            w.write_table(pa.Table.from_pandas(new, schema=schema, preserve_index=False))
+    os.replace(tmp, path)
+    return n + len(new)
+
+def main():
+    ap = argparse.ArgumentParser(description="Group cleaned emails into threads (subject root + participants).")
+    ap.add_argument("--input", default=str(INPUT_CLEAN))
+    ap.add_argument("--all-senders", action="store_true", default=not INTERNAL_ONLY,
+                    help="thread the whole corpus instead of internal senders only")
+    ap.add_argument("--sentences", default=str(SENTENCES),
+                    help="email sentence table from nlp_prep.py (ThreadSentence references it)")
+    ap.add_argument("--incremental", action="store_true",
+                    help="update the existing thread tables: only threads "
+                         "that gained or lost emails are rebuilt")
+    args = ap.parse_args()
+    internal_only = not args.all_senders
+    paths = out_paths(internal_only)
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    incremental = args.incremental and all(p.exists() for p in paths.values())
+    if args.incremental and not incremental:
+        print("No existing thread tables -> full build")
+    elif incremental and pq.read_schema(paths["ThreadSentence"]).names != REF_COLS:
+        print("ThreadSentence predates the sentence references -> full build")
+        incremental = False
+
+    t0 = time.perf_counter()
+    columns = [c for c in EMAIL_COLUMNS if c != "body_raw"] if incremental else EMAIL_COLUMNS
+    df = load_thread_emails(args.input, internal_only, columns=columns)
+    print(f"Loaded {len(df):,} emails" + (" (internal senders only)" if internal_only else " (all senders)"))
+    if incremental and not PERSON_INDEX.exists():
+        raise SystemExit(f"--incremental needs the persisted {PERSON_INDEX} (written by preprocess.py): "
+                         "without it person keys, and with them every thread key, change between runs. "
+                         "Run preprocess.py first, or build without --incremental.")
+    stored = load_person_index(PERSON_INDEX)
+    df, person_index = ensure_keys(df, stored)
+    if incremental and person_index.num_rows != stored.num_rows:
+        raise SystemExit(f"{person_index.num_rows - stored.num_rows:,} addresses are missing from {PERSON_INDEX}, "
+                         "so their person keys would not be stable between runs. Re-run preprocess.py "
+                         "(it extends the index), or build without --incremental.")
+    rows, keys = assign_threads(df)
+
+    if incremental:
+        affected = changed_threads(pq.read_table(paths["Threads"], columns=["thread_id", "email_ids"]), df)
+        df = df[df["thread_id"].isin(affected)].reset_index(drop=True)
+        print(f"Incremental: {len(affected):,} threads changed ({len(df):,} emails to re-render)")
+        df["body_raw"] = load_bodies(df["email_id"], path=args.input)
+        rows = keys = None
+    t_keys = time.perf_counter()
+
+    tables = build_tables(df, person_index, rows, keys, args.sentences)
+    t_text = time.perf_counter()
+    for name, table in tables.items():
+        if incremental:
+            n = replace_threads(paths[name], affected, table)
+            print(f"{paths[name].name}: {n:,} rows ({len(table):,} rebuilt)")
+        else:
+            table.to_parquet(paths[name], index=False)
+            print(f"{paths[name].name}:", table.shape)
+
+    print("\nQA:")
+    print("  Threads built:", len(tables["Threads"]))
+    print("  With text    :", tables["ThreadText"]["has_text"].sum())
+    print("  Thread sentences:", int(tables["ThreadSentence"]["n_sents"].sum()),
+          f"(references into {Path(args.sentences).name})")
+    print(f"  Timing       : load + keys {t_keys - t0:.1f} s | threads + text + sentences {t_text - t_keys:.1f} s")
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# thread_sentences.py
+# Thread sentences as references into the email sentence table. nlp_prep.py already splits
+# every email into Sentence_9902.parquet (sentence_id "<email_id>|s<i>", email_id, sent_idx,
+# sentence_text); a thread's sentences are just its emails' sentences in thread order, so the
+# thread builders write ThreadSentence_*.parquet as one row per (thread, email):
+#
+#   thread_id, email_id, pos, sent_start, sent_end, n_sents, thread_sent_start
+#
+# sent_start / sent_end: the email's sent_idx range [start, end) in the Sentence table;
+# thread_sent_start: index of the email's first sentence in the thread's numbering.
+# Anything keyed by (email_id, sent_idx) -- the sentences themselves or per-sentence model
+# scores -- is lifted to the thread level with expand_thread_sentences(), no re-tokenising
+# and no re-inference.
+#
+#   python emails/data_prep/threads/thread_sentences.py --show <thread_id>
+#   python emails/data_prep/threads/thread_sentences.py --out data/threads/ThreadSentence_text_internal_9902.parquet
+
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+SENTENCES = Path("data/nlp_inputs/Sentence_9902.parquet")      # written by nlp_prep.py
+REF_COLS = ["thread_id", "email_id", "pos", "sent_start", "sent_end", "n_sents", "thread_sent_start"]
+
+def _filter_emails(email_ids):
+    return ds.field("email_id").isin(pa.array(pd.unique(np.asarray(email_ids, dtype=object)), pa.string()))
+
+def load_sentences(email_ids=None, path=SENTENCES, columns=None) -> pd.DataFrame:
+    """Rows of the email sentence table (optionally only those of email_ids, pushed down)."""
+    flt = None if email_ids is None else _filter_emails(email_ids)
+    return ds.dataset(path, format="parquet").to_table(columns=columns, filter=flt).to_pandas()
+
+def build_thread_sentences(thread_emails: pd.DataFrame, sentences=SENTENCES) -> pd.DataFrame:
+    """ThreadSentence references for a ThreadEmails frame.
+
+    sentences: Sentence parquet path or a frame with email_id, sent_idx. Emails without
+    sentences (no text after cleaning) get no row, as empty bodies get no thread text block.
+    """
+    if isinstance(sentences, (str, Path)):
+        if not Path(sentences).exists():
+            raise FileNotFoundError(f"{sentences} not found: run emails/data_prep/nlp_prep.py first")
+        sentences = load_sentences(thread_emails["email_id"], sentences, columns=["email_id", "sent_idx"])
+    g = sentences.groupby("email_id", sort=False)["sent_idx"]
+    spans = pd.DataFrame({"sent_start": g.min(), "sent_end": g.max() + 1, "n_sents": g.size()})
+    refs = thread_emails[["thread_id", "email_id", "pos"]].merge(spans, left_on="email_id",
+                                                                 right_index=True, how="inner")
+    refs = refs.sort_values(["thread_id", "pos"], kind="stable").reset_index(drop=True)
+    refs["thread_sent_start"] = refs.groupby("thread_id", sort=False)["n_sents"].cumsum() - refs["n_sents"]
+    for c in ("pos", "sent_start", "sent_end", "n_sents", "thread_sent_start"):
+        refs[c] = refs[c].astype(np.int32)
+    return refs[REF_COLS]
+
+def expand_thread_sentences(refs: pd.DataFrame, sentences: pd.DataFrame) -> pd.DataFrame:
+    """Email-level rows keyed by (email_id, sent_idx) -> thread-level rows.
+
+    Returns sentence_id ("<thread_id>|s<i>"), thread_id, sent_idx (position in the thread),
+    email_id, email_sent_idx, then the other columns of `sentences` (sentence_text, scores, ...;
+    an email-level sentence_id is kept as email_sentence_id).
+    """
+    s = sentences.rename(columns={"sentence_id": "email_sentence_id", "sent_idx": "email_sent_idx"})
+    m = refs.merge(s, on="email_id", how="inner")
+    m = m[(m["email_sent_idx"] >= m["sent_start"]) & (m["email_sent_idx"] < m["sent_end"])]
+    m = m.sort_values(["thread_id", "pos", "email_sent_idx"], kind="stable").reset_index(drop=True)
+    m["sent_idx"] = (m["thread_sent_start"] + m.groupby(["thread_id", "pos"], sort=False).cumcount()).astype(np.int64)
+    m["sentence_id"] = m["thread_id"].astype(str) + "|s" + m["sent_idx"].astype(str)
+    extra = [c for c in s.columns if c not in ("email_id", "email_sent_idx")]
+    return m[["sentence_id", "thread_id", "sent_idx", "email_id", "email_sent_idx"] + extra]
+
+def load_thread_sentences(refs, thread_ids=None, sentences_path=SENTENCES, columns=None) -> pd.DataFrame:
+    """Thread sentences with their text (or the given Sentence columns), read through the references."""
+    if isinstance(refs, (str, Path)):
+        flt = None if thread_ids is None else ds.field("thread_id").isin(pa.array(list(thread_ids), pa.string()))
+        refs = ds.dataset(refs, format="parquet").to_table(columns=REF_COLS, filter=flt).to_pandas()
+    elif thread_ids is not None:
+        refs = refs[refs["thread_id"].isin(list(thread_ids))]
+    cols = None if columns is None else list(dict.fromkeys(["email_id", "sent_idx"] + list(columns)))
+    return expand_thread_sentences(refs, load_sentences(refs["email_id"], sentences_path, columns=cols))
+
+def main():
+    ap = argparse.ArgumentParser(description="Resolve ThreadSentence references against the email sentence table.")
+    ap.add_argument("--refs", default="data/threads/ThreadSentence_internal_9902.parquet")
+    ap.add_argument("--sentences", default=str(SENTENCES))
+    ap.add_argument("--out", default=None, help="write the thread sentences with their text here")
+    ap.add_argument("--show", default=None, metavar="THREAD_ID", help="print one thread's sentences")
+    args = ap.parse_args()
+
+    refs = pq.read_table(args.refs, columns=REF_COLS).to_pandas()
+    print(f"{refs['thread_id'].nunique():,} threads, {int(refs['n_sents'].sum()):,} sentences in {args.refs}")
+    if args.show:
+        for _, r in load_thread_sentences(refs, [args.show], args.sentences).iterrows():
+            print(f"[{r['sent_idx']}] {r['sentence_text']}")
+    if args.out:
+        out = load_thread_sentences(refs, sentences_path=args.sentences)
+        out.to_parquet(args.out, index=False)
+        print(f"Wrote {len(out):,} thread sentences -> {args.out}")
+
+if __name__ == "__main__":
+    main()
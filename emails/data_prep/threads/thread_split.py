@@ -1,31 +1,67 @@
+import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from pathlib import Path
 
+# Streaming split: only the thread_id / n_emails columns of Threads are read into memory; every
+# table is then scanned batch by batch with thread_id IN (multi-email threads) pushed into the
+# scan and the surviving batches written straight out as row groups, so memory stays flat
+# however large ThreadSentence gets.
+
 # P aths
 OUT_DIR = Path("data/threads")
 OUT_DIR.mkdir(parents=True, exist_ok=True)
 
 THREADS_PATH   = OUT_DIR / ("Threads_internal_9902.parquet")
+EMAILS_PATH    = OUT_DIR / ("ThreadEmails_internal_9902.parquet")
 TEXT_PATH      = OUT_DIR / ("ThreadText_internal_9902.parquet")
 SENT_PATH      = OUT_DIR / ("ThreadSentence_internal_9902.parquet")
 
 OUT_THREADS    = OUT_DIR / ("Threads_internal_multi_9902.parquet")
+OUT_EMAILS     = OUT_DIR / ("ThreadEmails_internal_multi_9902.parquet")
 OUT_TEXT       = OUT_DIR / ("ThreadText_internal_multi_9902.parquet")
 OUT_SENT       = OUT_DIR / ("ThreadSentence_internal_multi_9902.parquet")
 
-def main():
-    # Load threads
-    df_threads = pd.read_parquet(THREADS_PATH)
-    print(f"Loaded Threads: {df_threads.shape}")
+BATCH_ROWS = 64_000     # rows per scanned batch (and at most per written row group)
+READAHEAD  = 2          # batches decoded ahead of the writer; with pre_buffer off this bounds memory
+
+def split_table(src: Path, dst: Path, keep: pa.Array, flags: bool = False) -> int:
+    """Copies the rows of src whose thread_id is in keep to dst (semi-join pushed into the scan)."""
+    dataset = ds.dataset(src, format="parquet")
+    schema = dataset.schema
+    if flags:
+        schema = schema.append(pa.field("is_singleton", pa.bool_())).append(pa.field("has_replies", pa.bool_()))
+    tmp = dst.with_suffix(".tmp.parquet")
+    n = 0
+    with pq.ParquetWriter(tmp, schema) as w:
+        scan = dataset.to_batches(filter=ds.field("thread_id").isin(keep), batch_size=BATCH_ROWS,
+                                  batch_readahead=READAHEAD, fragment_readahead=1,
+                                  fragment_scan_options=ds.ParquetFragmentScanOptions(pre_buffer=False))
+        for batch in scan:
+            if not batch.num_rows:
+                continue
+            if flags:
+                n_emails = batch.column("n_emails")
+                cols = batch.columns + [pc.equal(n_emails, 1), pc.greater_equal(n_emails, 2)]
+                batch = pa.RecordBatch.from_arrays(cols, schema=schema)
+            w.write_batch(batch)
+            n += batch.num_rows
+    os.replace(tmp, dst)
+    return n
 
-    # Flag singletons
-    df_threads["is_singleton"] = df_threads["n_emails"] == 1
-    df_threads["has_replies"]  = df_threads["n_emails"] >= 2
+def main():
+    # Load thread sizes only
+    threads = pq.read_table(THREADS_PATH, columns=["thread_id", "n_emails"])
+    print(f"Loaded Threads: {threads.num_rows:,} thread sizes")
+    n_emails = threads.column("n_emails").to_numpy()
 
     # Stats
-    total = len(df_threads)
-    singletons = df_threads["is_singleton"].sum()
-    multi = df_threads["has_replies"].sum()
+    total = len(n_emails)
+    singletons = int((n_emails == 1).sum())
+    multi = int((n_emails >= 2).sum())
 
     print("\n=== Thread Stats ===")
     print(f"Total threads: {total:,}")
@@ -33,27 +69,26 @@ def main():
     print(f"Multi-email  : {multi:,} ({multi/total:.1%})")
 
     # Distribution
-    dist = df_threads["n_emails"].value_counts().sort_index()
+    dist = pd.Series(n_emails).value_counts().sort_index()
     print("\nThread size distribution (first 20 sizes):")
     print(dist.head(20))
 
     # Keep only multi-email threads
-    multi_threads = df_threads[df_threads["has_replies"]].copy()
-    multi_ids = set(multi_threads["thread_id"])
-
-    df_text = pd.read_parquet(TEXT_PATH)
-    df_sent = pd.read_parquet(SENT_PATH)
-
-    df_text_multi = df_text[df_text["thread_id"].isin(multi_ids)].copy()
-    df_sent_multi = df_sent[df_sent["thread_id"].isin(multi_ids)].copy()
+    multi_ids = threads.filter(pc.greater_equal(threads.column("n_emails"), 2)).column("thread_id").combine_chunks()
+    del threads
 
-    multi_threads.to_parquet(OUT_THREADS, index=False)
-    df_text_multi.to_parquet(OUT_TEXT, index=False)
-    df_sent_multi.to_parquet(OUT_SENT, index=False)
+    saved = {"multi-email threads": split_table(THREADS_PATH, OUT_THREADS, multi_ids, flags=True)}
+    for label, src, dst in (("ThreadEmails_multi", EMAILS_PATH, OUT_EMAILS),
+                            ("ThreadText_multi", TEXT_PATH, OUT_TEXT),
+                            ("ThreadSentence_multi", SENT_PATH, OUT_SENT)):
+        if src.exists():
+            saved[label] = split_table(src, dst, multi_ids)
+        else:
+            print(f"Skipping {src.name} (not found)")
 
-    print(f"\nSaved multi-email threads: {len(multi_threads):,}")
-    print(f"Saved ThreadText_multi   : {len(df_text_multi):,}")
-    print(f"Saved ThreadSentence_multi: {len(df_sent_multi):,}")
+    print()
+    for label, n in saved.items():
+        print(f"Saved {label:<20}: {n:,}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,133 @@
+# thread_text.py
+# Thread text without a stored copy of the bodies. The thread builders write
+# ThreadEmails_*.parquet (thread_id, email_id, pos, n_emails, from_norm, dt_utc, subject_root:
+# each thread's emails in date order with their header fields) and ThreadTextView renders the
+# "--- EMAIL i/n ---" text from it on demand, fetching bodies from the body store.
+#
+#   view = ThreadTextView("data/threads/ThreadEmails_internal_multi_9902.parquet")
+#   view["3f2a..."]                                   # one thread's body_concat
+#   for batch in view.iter_batches(batch_size=500):    # DataFrames of thread_id, body_concat
+#       ...
+#
+# For tools that need the old ThreadText file with body_concat (the Colab notebooks), write one:
+#   python emails/data_prep/threads/thread_text.py --thread-emails data/threads/ThreadEmails_internal_multi_9902.parquet \
+#          --out data/threads/ThreadText_full_internal_multi_9902.parquet
+
+import sys, argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))          # emails/data_prep
+from emails_dataset import load_bodies
+
+INPUT_CLEAN = Path("data/Emails_clean_9902.parquet")    # where bodies come from (its BodyStore if built)
+BATCH_THREADS = 1000
+THREAD_EMAIL_COLS = ["thread_id", "email_id", "pos", "n_emails", "from_norm", "dt_utc", "subject_root"]
+TEXT_SCHEMA = pa.schema([("thread_id", pa.string()), ("body_concat", pa.string()),
+                         ("n_tokens", pa.int64()), ("has_text", pa.bool_())])
+
+def render_blocks(pos, n, frm, dt, subj, bodies) -> str:
+    """One thread's text: a header + body block per email (date order), empty bodies skipped."""
+    blocks = []
+    for i, k, f, d, s, body in zip(pos, n, frm, dt, subj, bodies):
+        if body and body.strip():
+            blocks.append(f"\n--- EMAIL {i+1}/{k} ---\n"
+                          f"From: {f}\n"
+                          f"Date: {d}\n"
+                          f"Subject: {s}\n\n" + body)
+    return "\n\n".join(blocks).strip()
+
+def thread_bounds(thread_ids: np.ndarray):
+    """Rows sorted by thread_id -> (distinct thread_ids, start row, end row)."""
+    if not len(thread_ids):
+        return thread_ids[:0], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, thread_ids[1:] != thread_ids[:-1]])
+    return thread_ids[starts], starts, np.r_[starts[1:], len(thread_ids)]
+
+def render_threads(thread_emails: pd.DataFrame, bodies) -> list:
+    """body_concat for every thread of a ThreadEmails frame (rows grouped by thread, in pos order)."""
+    cols = [thread_emails[c].to_numpy() if c != "dt_utc" else thread_emails[c].array
+            for c in ("pos", "n_emails", "from_norm", "dt_utc", "subject_root")]
+    bodies = list(bodies)
+    _, starts, ends = thread_bounds(thread_emails["thread_id"].to_numpy(dtype=object))
+    return [render_blocks(*(c[a:b] for c in cols), bodies[a:b]) for a, b in zip(starts, ends)]
+
+def text_stats(texts) -> tuple:
+    n_tokens = np.array([len(t.split()) for t in texts], dtype=np.int64)
+    return n_tokens, n_tokens > 0
+
+class ThreadTextView:
+    """ThreadText rendered on demand from ThreadEmails + the email bodies."""
+
+    def __init__(self, thread_emails, bodies=None, input_path=INPUT_CLEAN):
+        """thread_emails: ThreadEmails parquet path or DataFrame.
+        bodies: callable(list of email_ids) -> list of bodies; default load_bodies() on input_path
+                (the body store next to it when built, else a filtered scan).
+        """
+        te = pd.read_parquet(thread_emails, columns=THREAD_EMAIL_COLS) \
+            if isinstance(thread_emails, (str, Path)) else thread_emails
+        self.emails = te.sort_values(["thread_id", "pos"], kind="stable").reset_index(drop=True)
+        self._bodies = bodies or (lambda ids: load_bodies(ids, path=input_path))
+        tids, starts, ends = thread_bounds(self.emails["thread_id"].to_numpy(dtype=object))
+        self._span = dict(zip(tids.tolist(), zip(starts.tolist(), ends.tolist())))
+
+    @property
+    def thread_ids(self) -> list:
+        return list(self._span)
+
+    def __len__(self):
+        return len(self._span)
+
+    def __contains__(self, thread_id):
+        return thread_id in self._span
+
+    def _render(self, thread_ids) -> list:
+        rows = np.concatenate([np.arange(*self._span[t]) for t in thread_ids]) if thread_ids else np.zeros(0, int)
+        sub = self.emails.iloc[rows]
+        return render_threads(sub, self._bodies(sub["email_id"].tolist()))
+
+    def __getitem__(self, thread_id) -> str:
+        if thread_id not in self._span:
+            raise KeyError(thread_id)
+        return self._render([thread_id])[0]
+
+    def iter_batches(self, thread_ids=None, batch_size=BATCH_THREADS):
+        """Yields DataFrames (thread_id, body_concat, n_tokens, has_text), batch_size threads at a time."""
+        ids = self.thread_ids if thread_ids is None else [t for t in thread_ids if t in self._span]
+        for i in range(0, len(ids), batch_size):
+            chunk = ids[i:i + batch_size]
+            texts = self._render(chunk)
+            n_tokens, has_text = text_stats(texts)
+            yield pd.DataFrame({"thread_id": chunk, "body_concat": texts,
+                                "n_tokens": n_tokens, "has_text": has_text})
+
+    def to_parquet(self, path, thread_ids=None, batch_size=BATCH_THREADS) -> int:
+        """Materialises the old ThreadText layout (with body_concat), streamed batch by batch."""
+        n = 0
+        with pq.ParquetWriter(path, TEXT_SCHEMA) as w:
+            for batch in self.iter_batches(thread_ids, batch_size):
+                w.write_table(pa.Table.from_pandas(batch, schema=TEXT_SCHEMA, preserve_index=False))
+                n += len(batch)
+        return n
+
+def main():
+    ap = argparse.ArgumentParser(description="Render thread text from ThreadEmails + the body store.")
+    ap.add_argument("--thread-emails", default="data/threads/ThreadEmails_internal_multi_9902.parquet")
+    ap.add_argument("--input", default=str(INPUT_CLEAN), help="cleaned emails (bodies / BodyStore)")
+    ap.add_argument("--out", default=None, help="write a ThreadText parquet with body_concat here")
+    ap.add_argument("--show", default=None, metavar="THREAD_ID", help="print one thread's text")
+    args = ap.parse_args()
+
+    view = ThreadTextView(args.thread_emails, input_path=args.input)
+    print(f"{len(view):,} threads, {len(view.emails):,} emails in {args.thread_emails}")
+    if args.show:
+        print(view[args.show])
+    if args.out:
+        n = view.to_parquet(args.out)
+        print(f"Wrote {n:,} threads -> {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -20,36 +20,40 @@ def sanitize(path: str) -> str:
         parts.append(seg)
     return os.path.join(*parts) if parts else ""
 
-# clean target if it exists
-if os.path.isdir(DST):
-    shutil.rmtree(DST)
-os.makedirs(DST, exist_ok=True)
-
-count = 0
-with tarfile.open(SRC, "r:gz") as tf:
-    for m in tf.getmembers():
-        if not m.name.startswith("maildir/"):
-            continue
-        clean_rel = sanitize(m.name)
-        if not clean_rel:
-            continue
-        out_path = os.path.join(DST, clean_rel)
-
-        if m.isdir():
-            os.makedirs(out_path, exist_ok=True)
-            continue
-
-        # ensure parent dir exists
-        os.makedirs(os.path.dirname(out_path), exist_ok=True)
-
-        # extract file content safely
-        f = tf.extractfile(m)
-        if f is None:
-            continue
-        with open(out_path, "wb") as w:
-            w.write(f.read())
-        count += 1
-        if count % 10000 == 0:
-            print(f"Extracted {count} files...")
-
-print(f"Done. Extracted {count} files into {DST}")
+def main():
+    # clean target if it exists
+    if os.path.isdir(DST):
+        shutil.rmtree(DST)
+    os.makedirs(DST, exist_ok=True)
+
+    count = 0
+    with tarfile.open(SRC, "r:gz") as tf:
+        for m in tf.getmembers():
+            if not m.name.startswith("maildir/"):
+                continue
+            clean_rel = sanitize(m.name)
+            if not clean_rel:
+                continue
+            out_path = os.path.join(DST, clean_rel)
+
+            if m.isdir():
+                os.makedirs(out_path, exist_ok=True)
+                continue
+
+            # ensure parent dir exists
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+            # extract file content safely
+            f = tf.extractfile(m)
+            if f is None:
+                continue
+            with open(out_path, "wb") as w:
+                w.write(f.read())
+            count += 1
+            if count % 10000 == 0:
+                print(f"Extracted {count} files...")
+
+    print(f"Done. Extracted {count} files into {DST}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# bench_onnx.py
+# Compares the int8-quantised ONNX Runtime backend (onnx_backend.py) with the PyTorch path on a
+# fixed random sample of TextBase emails, per model: throughput (rows/s on CPU), how often the
+# top label agrees, and the largest difference in its probability/score.
+#
+#   python emails/nlp/bench_onnx.py --input TextBase.parquet [--sample 2000] [--models sentiment emotion]
+#   python emails/nlp/bench_onnx.py --models zeroshot --taxonomy emails/nlp/risk/risk_taxonomy.json
+#
+# Models are exported (and quantised) under --onnx-root on first use. The sentiment/emotion models
+# are run as in Thread+Email_SentimentScores+Text.py (padded to --max-len), the zero-shot model
+# through risk_zeroshot_engine.ZeroShotEngine (dynamic padding, the taxonomy's categories).
+
+import sys, json, time, argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch, torch.nn.functional as F
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+from onnx_backend import ONNX_ROOT, load_onnx, onnx_dir_for
+sys.path.append(str(Path(__file__).resolve().parent / "risk"))
+from risk_zeroshot_engine import ZeroShotEngine, MODEL_NAME as ZEROSHOT_MODEL
+
+SENTIMENT_MODEL = "cardiffnlp/twitter-roberta-base-sentiment-latest"
+EMOTION_MODEL   = "j-hartmann/emotion-english-distilroberta-base"
+TAXONOMY        = Path(__file__).resolve().parent / "risk" / "risk_taxonomy.json"
+SEED            = 42
+
+# ------------ sample ------------
+def load_sample(path, n: int) -> list:
+    df = pd.read_parquet(path)
+    subj = df["subject_norm"].fillna("") if "subject_norm" in df.columns else ""
+    text = (subj + " " + df["body_clean"].fillna("")).str.strip()
+    text = text[text != ""]
+    return text.sample(min(n, len(text)), random_state=SEED).tolist()
+
+def load_categories(path) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        tax = json.load(f)
+    return [c["name"] if isinstance(c, dict) else c for c in tax.get("categories", [])]
+
+# ------------ runners ------------
+@torch.inference_mode()
+def run_classifier(tok, mdl, texts: list, max_len: int, batch: int):
+    """(top label ids, top probabilities, seconds) with the sentiment script's tokenisation."""
+    enc = tok(texts[:batch], truncation=True, padding="max_length", max_length=max_len, return_tensors="pt")
+    mdl(**enc)                                               # warm-up, not timed
+    ids, probs = [], []
+    t0 = time.perf_counter()
+    for i in range(0, len(texts), batch):
+        enc = tok(texts[i:i + batch], truncation=True, padding="max_length", max_length=max_len, return_tensors="pt")
+        conf, idx = F.softmax(mdl(**enc).logits.float(), dim=-1).max(dim=-1)
+        ids += idx.tolist()
+        probs += conf.tolist()
+    return np.array(ids), np.array(probs), time.perf_counter() - t0
+
+def run_zeroshot(engine: ZeroShotEngine, texts: list, labels: list):
+    engine.classify(texts[:4], labels)                       # warm-up, not timed
+    t0 = time.perf_counter()
+    top_label, top_score = engine.classify(texts, labels)
+    return np.array(top_label, dtype=object), np.array(top_score, dtype=float), time.perf_counter() - t0
+
+def bench_classifier(name: str, texts: list, args) -> dict:
+    tok = AutoTokenizer.from_pretrained(name, use_fast=True)
+    mdl = AutoModelForSequenceClassification.from_pretrained(name).eval()
+    pt = run_classifier(tok, mdl, texts, args.max_len, args.batch)
+    o_tok, o_mdl = load_onnx(name, args.onnx_root)
+    ox = run_classifier(o_tok, o_mdl, texts, args.max_len, args.batch)
+    return summarise(name, pt, ox, len(texts), mdl, args.onnx_root)
+
+def bench_zeroshot(name: str, texts: list, args) -> dict:
+    labels = load_categories(args.taxonomy)
+    pt_engine = ZeroShotEngine(name, device="cpu")
+    pt = run_zeroshot(pt_engine, texts, labels)
+    ox = run_zeroshot(ZeroShotEngine(name, device="cpu", backend="onnx", onnx_root=args.onnx_root), texts, labels)
+    return summarise(name, pt, ox, len(texts), pt_engine.model, args.onnx_root)
+
+def summarise(name, pt, ox, n, torch_model, onnx_root) -> dict:
+    (pt_lab, pt_p, pt_s), (ox_lab, ox_p, ox_s) = pt, ox
+    int8 = onnx_dir_for(name, onnx_root) / "model.int8.onnx"
+    return {"model": name, "rows": n,
+            "torch_rows_s": n / max(pt_s, 1e-9), "onnx_rows_s": n / max(ox_s, 1e-9),
+            "speedup": pt_s / max(ox_s, 1e-9),
+            "agreement": float(np.mean(pt_lab == ox_lab)),
+            "max_prob_diff": float(np.max(np.abs(pt_p - ox_p))) if n else 0.0,
+            "torch_mb": sum(p.numel() * p.element_size() for p in torch_model.parameters()) / 1e6,
+            "onnx_mb": int8.stat().st_size / 1e6}
+
+def main():
+    ap = argparse.ArgumentParser(description="PyTorch vs int8 ONNX Runtime: throughput and label agreement.")
+    ap.add_argument("--input", default="TextBase.parquet", help="TextBase parquet (subject_norm, body_clean)")
+    ap.add_argument("--sample", type=int, default=2000, help=f"emails sampled (random_state={SEED})")
+    ap.add_argument("--models", nargs="+", default=["zeroshot", "sentiment", "emotion"],
+                    choices=["zeroshot", "sentiment", "emotion"])
+    ap.add_argument("--zeroshot-model", default=ZEROSHOT_MODEL)
+    ap.add_argument("--sentiment-model", default=SENTIMENT_MODEL)
+    ap.add_argument("--emotion-model", default=EMOTION_MODEL)
+    ap.add_argument("--taxonomy", default=str(TAXONOMY), help="categories for the zero-shot model")
+    ap.add_argument("--max-len", type=int, default=128, help="sentiment/emotion max_length")
+    ap.add_argument("--batch", type=int, default=64, help="sentiment/emotion batch size")
+    ap.add_argument("--zeroshot-sample", type=int, default=200, help="zero-shot runs on the first N sampled emails")
+    ap.add_argument("--onnx-root", default=str(ONNX_ROOT))
+    ap.add_argument("--threads", type=int, default=None, help="torch intra-op threads (ONNX Runtime uses all cores)")
+    args = ap.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    texts = load_sample(args.input, args.sample)
+    print(f"Sampled {len(texts):,} emails from {args.input} (random_state={SEED})")
+
+    results = []
+    for m in args.models:
+        if m == "zeroshot":
+            results.append(bench_zeroshot(args.zeroshot_model, texts[:args.zeroshot_sample], args))
+        else:
+            results.append(bench_classifier(getattr(args, f"{m}_model"), texts, args))
+
+    print(f"\n{'model':50s} {'rows':>6s} {'torch/s':>8s} {'onnx/s':>8s} {'speed-up':>8s} "
+          f"{'agree':>7s} {'max Δp':>7s} {'MB fp32→int8':>13s}")
+    for r in results:
+        print(f"{r['model'][-50:]:50s} {r['rows']:6,d} {r['torch_rows_s']:8,.1f} {r['onnx_rows_s']:8,.1f} "
+              f"{r['speedup']:7.2f}x {r['agreement']:7.2%} {r['max_prob_diff']:7.4f} "
+              f"{r['torch_mb']:6,.1f}→{r['onnx_mb']:<6,.1f}")
+
+if __name__ == "__main__":
+    main()
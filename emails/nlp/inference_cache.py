@@ -0,0 +1,116 @@
+# inference_cache.py
+# Persistent result cache for the model-inference stages (zero-shot risk, sentiment, emotion).
+# The same text reaches the models many times (folder copies, mass mails, forwards, reruns after
+# unrelated pipeline changes); a cache hit skips the forward pass. One sqlite file holds all models:
+#
+#   results(ns, key, label, score)     ns  = hash of (model, revision, labels, max_len)
+#                                      key = hash of the model input text
+#   timing(ns, rows, seconds)          measured inference cost, used to estimate the time saved
+#
+# The key is taken over the text exactly as the model receives it, i.e. after each stage's own
+# normalisation (body_clean / subject + body joining, strip). Nothing more is folded: the BPE
+# tokenizers see whitespace and Unicode forms, so a hit returns exactly what inference would.
+# Empty texts and failed rows (label None) are never stored.
+#
+#   cache = InferenceCache(OUT_DIR / "InferenceCache.sqlite")
+#   scope = cache.scope(MODEL_NAME, revision, labels=categories, max_len=1024)
+#   labels, scores = scope.lookup(texts, lambda miss: engine.classify(miss, categories))
+#   print(cache.report())
+
+import json, time, sqlite3, hashlib
+from pathlib import Path
+
+def text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def model_revision(model) -> str:
+    """Hub commit hash of a loaded transformers model ("local" for a model loaded from disk)."""
+    return getattr(model.config, "_commit_hash", None) or "local"
+
+class InferenceCache:
+    """One sqlite file of cached (label, score) results, split into per-model scopes."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (ns TEXT, key BLOB, label TEXT, score REAL, "
+                        "PRIMARY KEY (ns, key)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS timing (ns TEXT PRIMARY KEY, rows INTEGER, seconds REAL)")
+        self.db.commit()
+        self.scopes = []
+
+    def scope(self, model: str, revision: str, labels=None, max_len: int | None = None) -> "CacheScope":
+        s = CacheScope(self, {"model": model, "revision": revision,
+                              "labels": list(labels) if labels is not None else None, "max_len": max_len})
+        self.scopes.append(s)
+        return s
+
+    def report(self) -> str:
+        lines = [f"Inference cache {self.path.name}:"]
+        for s in self.scopes:
+            lines.append("  " + s.report())
+        return "\n".join(lines)
+
+    def close(self):
+        self.db.close()
+
+class CacheScope:
+    """Results of one (model, revision, labels, max_len); lookup() counts hits and time saved."""
+
+    def __init__(self, cache: InferenceCache, params: dict):
+        self.cache, self.params = cache, params
+        self.ns = hashlib.blake2b(json.dumps(params, sort_keys=True).encode("utf-8"), digest_size=8).hexdigest()
+        self.hits = self.misses = 0
+        self.infer_rows, self.infer_s = 0, 0.0
+
+    def _get(self, keys: list) -> dict:
+        out = {}
+        for i in range(0, len(keys), 500):                 # sqlite host-parameter limit
+            chunk = keys[i:i + 500]
+            q = f"SELECT key, label, score FROM results WHERE ns = ? AND key IN ({','.join('?' * len(chunk))})"
+            out.update({k: (l, s) for k, l, s in self.cache.db.execute(q, [self.ns, *chunk])})
+        return out
+
+    def lookup(self, texts: list, infer):
+        """(labels, scores) for texts; infer(list of texts) -> (labels, scores) runs on the misses
+        only (each distinct text once, also within texts) and its results are stored."""
+        keys = [text_key(t) if t else None for t in texts]
+        found = self._get(list({k for k in keys if k is not None}))
+        todo = {}                                              # key -> first text with it
+        for k, t in zip(keys, texts):
+            if k is None or k not in found:
+                todo.setdefault(k if k is not None else id(t), t)
+        self.hits += len(texts) - len(todo)                    # served without a forward pass
+        self.misses += len(todo)
+
+        if todo:
+            t0 = time.perf_counter()
+            labels, scores = infer(list(todo.values()))
+            elapsed = time.perf_counter() - t0
+            self.infer_rows += len(todo)
+            self.infer_s += elapsed
+            new = dict(zip(todo, zip(labels, scores)))
+            rows = [(self.ns, k, l, float(s)) for k, (l, s) in new.items() if isinstance(k, bytes) and l is not None]
+            with self.cache.db:
+                self.cache.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+                self.cache.db.execute("INSERT INTO timing VALUES (?, ?, ?) ON CONFLICT(ns) DO UPDATE SET "
+                                      "rows = rows + excluded.rows, seconds = seconds + excluded.seconds",
+                                      (self.ns, len(todo), elapsed))
+            found.update(new)
+
+        res = [found[k if k is not None else id(t)] for k, t in zip(keys, texts)]
+        return [r[0] for r in res], [r[1] for r in res]
+
+    def seconds_per_row(self) -> float:
+        row = self.cache.db.execute("SELECT rows, seconds FROM timing WHERE ns = ?", (self.ns,)).fetchone()
+        return row[1] / row[0] if row and row[0] else 0.0
+
+    def report(self) -> str:
+        n = self.hits + self.misses
+        rate = self.hits / n if n else 0.0
+        saved = self.hits * self.seconds_per_row()
+        return (f"{self.params['model']} (max_len={self.params['max_len']}): {self.hits:,}/{n:,} hits "
+                f"({rate:.1%}), ~{saved:,.1f} s of inference saved")
@@ -0,0 +1,99 @@
+# inference_checkpoint.py
+# Append-only checkpointing for the long model-inference runs (zero-shot risk, sentiment/emotion).
+# Instead of rebuilding every finished row into a DataFrame and rewriting the whole output every
+# few hundred rows, each finished batch is written once, as a small shard next to the output:
+#
+#   RiskScores_zeroshot_flagged.parts/
+#       manifest.json          id column + the run settings (model, labels, ...) the shards belong to
+#       part-00000.parquet     one shard per finished batch (written to a temp file, then renamed,
+#       part-00001.parquet     so a crash never leaves a half-written shard)
+#
+# The ids inside the shards are the completed ids: a restarted run skips them and only scores the
+# rest. compact() concatenates the shards into the final parquet (and CSV) and removes the folder;
+# with order= it keeps only the ids still in the input (a resumed run whose input changed, e.g.
+# a smaller flagged set, must not carry rows over from the shards).
+# Shards written with other settings (a different model or label set) are discarded on start.
+#
+#   ckpt = ShardCheckpoint(OUT_PARQ, "email_id", settings={"model": MODEL_NAME, "labels": categories})
+#   todo = df[~df["email_id"].isin(ckpt.done_ids())]
+#   for batch_rows in ...: ckpt.append(pd.DataFrame(batch_rows))
+#   out_df = ckpt.compact(order=df["email_id"], out_csv=OUT_CSV)
+
+import os, json, shutil
+from pathlib import Path
+import pandas as pd
+import pyarrow.parquet as pq
+
+class ShardCheckpoint:
+    """Finished-batch shards for one output file, with resume and compaction."""
+
+    def __init__(self, out_path, id_col: str, settings: dict | None = None):
+        self.out_path = Path(out_path)
+        self.id_col = id_col
+        self.dir = self.out_path.with_name(self.out_path.stem + ".parts")
+        manifest = {"id_col": id_col, "settings": settings or {}}
+        mf = self.dir / "manifest.json"
+        if mf.exists():
+            with open(mf, "r", encoding="utf-8") as f:
+                old = json.load(f)
+            if old == json.loads(json.dumps(manifest)):
+                parts = self._parts()
+                self.n_parts = int(parts[-1].stem.split("-")[1]) + 1 if parts else 0
+                return
+            print(f"Checkpoint {self.dir.name} was written with other settings, starting over.")
+            shutil.rmtree(self.dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with open(mf, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1, ensure_ascii=False)
+        self.n_parts = 0
+
+    def _parts(self) -> list:
+        return sorted(self.dir.glob("part-*.parquet"))
+
+    def done_ids(self) -> set:
+        """Ids already in a shard (empty for a fresh run)."""
+        parts = self._parts()
+        if not parts:
+            return set()
+        ids = set()
+        for p in parts:
+            ids.update(pq.read_table(p, columns=[self.id_col]).column(self.id_col).to_pylist())
+        print(f"Resuming from {self.dir.name}: {len(ids):,} ids already done in {len(parts)} shards.")
+        return ids
+
+    def append(self, df: pd.DataFrame):
+        """Writes one finished batch as the next shard."""
+        if df.empty:
+            return
+        path = self.dir / f"part-{self.n_parts:05d}.parquet"
+        tmp = path.with_suffix(".tmp")
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+        self.n_parts += 1
+
+    def compact(self, order=None, transform=None, out_csv=None, keep_parts: bool = False) -> pd.DataFrame:
+        """All shards -> one DataFrame (only the ids in order, in that order, if given; then
+        transform(df), if given), saved to the output parquet (and out_csv); the shard folder
+        is removed afterwards."""
+        parts = self._parts()
+        if parts:
+            df = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+        else:
+            df = pd.DataFrame(columns=[self.id_col])
+        df = df.drop_duplicates(self.id_col, keep="last")
+        if order is not None:
+            pos = pd.Series(range(len(order)), index=pd.Index(order)).groupby(level=0).first()
+            stale = ~df[self.id_col].isin(pos.index)
+            if stale.any():
+                print(f"Dropping {int(stale.sum()):,} shard rows whose {self.id_col} is no longer in the input.")
+                df = df[~stale]
+            df = df.sort_values(self.id_col, key=lambda s: s.map(pos), kind="stable").reset_index(drop=True)
+        if transform is not None:
+            df = transform(df)
+        df.to_parquet(self.out_path, index=False)
+        if out_csv is not None:
+            df.to_csv(out_csv, index=False)
+        if not keep_parts:
+            shutil.rmtree(self.dir)
+        print(f"Compacted {len(parts)} shards -> {self.out_path} ({len(df):,} rows)")
+        return df
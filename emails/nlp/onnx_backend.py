@@ -0,0 +1,108 @@
+# onnx_backend.py
+# ONNX Runtime CPU backend for the transformer models (BART-MNLI zero-shot, Cardiff sentiment
+# RoBERTa, emotion DistilRoBERTa). Each model is exported once to ONNX and its weights quantised
+# to int8 (onnxruntime.quantization.quantize_dynamic); the scripts then run it through an
+# InferenceSession instead of PyTorch (int8 weights are ~1/4 of the fp32 size).
+#
+#   onnx_models/<model name>/
+#       model.onnx            fp32 export (logits only, dynamic batch and sequence axes)
+#       model.int8.onnx       dynamically quantised weights (what the scripts load)
+#       export.json           source model, hub revision, quantisation
+#       tokenizer + config    copied from the source model
+#
+#   tok, mdl = load_onnx("cardiffnlp/twitter-roberta-base-sentiment-latest")   # exports if missing
+#   logits = mdl(**tok(texts, return_tensors="pt", padding=True)).logits    # same call as PyTorch
+#
+# The model object mirrors what the scripts use of a transformers model (.config, .to(), .eval(),
+# mdl(**enc).logits as a torch tensor), so risk_zeroshot_engine.ZeroShotEngine and the sentiment
+# script swap backends with one constant. Its config revision is tagged "+onnx-int8", which keeps
+# quantised results apart from fp32 ones in the inference cache. bench_onnx.py compares both paths.
+
+import os, json, inspect
+from pathlib import Path
+from types import SimpleNamespace
+import numpy as np
+import torch
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSequenceClassification
+
+ONNX_ROOT = Path("onnx_models")
+OPSET     = 17
+
+def onnx_dir_for(model_name: str, root=ONNX_ROOT) -> Path:
+    return Path(root) / model_name.strip("/").replace("/", "__")
+
+class _LogitsOnly(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+def export_onnx(model_name: str, out_dir=None, quantize: bool = True) -> Path:
+    """Exports model_name to out_dir/model.onnx (+ model.int8.onnx); returns out_dir."""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    out_dir = Path(out_dir or onnx_dir_for(model_name))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tok = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+
+    sample = tok(["An example sentence to trace.", "Another, slightly longer example sentence."],
+                 padding=True, return_tensors="pt")
+    axes = {"input_ids": {0: "batch", 1: "seq"}, "attention_mask": {0: "batch", 1: "seq"}, "logits": {0: "batch"}}
+    legacy = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.inference_mode():
+        torch.onnx.export(_LogitsOnly(model), (sample["input_ids"], sample["attention_mask"]),
+                          str(out_dir / "model.onnx"), input_names=["input_ids", "attention_mask"],
+                          output_names=["logits"], dynamic_axes=axes, opset_version=OPSET, **legacy)
+    if quantize:
+        quantize_dynamic(str(out_dir / "model.onnx"), str(out_dir / "model.int8.onnx"), weight_type=QuantType.QInt8)
+
+    tok.save_pretrained(out_dir)
+    model.config.save_pretrained(out_dir)
+    with open(out_dir / "export.json", "w", encoding="utf-8") as f:
+        json.dump({"model": model_name, "revision": getattr(model.config, "_commit_hash", None),
+                   "quantized": quantize, "opset": OPSET}, f, indent=1)
+    print(f"Exported {model_name} -> {out_dir}")
+    return out_dir
+
+class OnnxSequenceClassifier:
+    """InferenceSession with the slice of the transformers model API the scripts use."""
+
+    def __init__(self, model_dir, quantized: bool = True, threads: int | None = None):
+        import onnxruntime as ort
+
+        model_dir = Path(model_dir)
+        with open(model_dir / "export.json", "r", encoding="utf-8") as f:
+            info = json.load(f)
+        self.config = AutoConfig.from_pretrained(model_dir)
+        self.config._name_or_path = info["model"]
+        tag = "+onnx-int8" if quantized else "+onnx"
+        self.config._commit_hash = (info.get("revision") or "local") + tag
+
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = threads or os.cpu_count() or 1
+        path = model_dir / ("model.int8.onnx" if quantized else "model.onnx")
+        self.session = ort.InferenceSession(str(path), opts, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def to(self, device):
+        if str(device) != "cpu":
+            raise ValueError("the ONNX backend runs on CPU only")
+        return self
+
+    def eval(self):
+        return self
+
+    def __call__(self, **enc):
+        feed = {k: np.ascontiguousarray(enc[k].cpu().numpy(), dtype=np.int64) for k in self.input_names}
+        logits = self.session.run(["logits"], feed)[0]
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+def load_onnx(model_name: str, root=ONNX_ROOT, quantized: bool = True):
+    """(tokenizer, OnnxSequenceClassifier) for model_name, exporting it first if needed."""
+    d = onnx_dir_for(model_name, root)
+    if not (d / ("model.int8.onnx" if quantized else "model.onnx")).exists():
+        export_onnx(model_name, d, quantize=quantized)
+    return AutoTokenizer.from_pretrained(d), OnnxSequenceClassifier(d, quantized=quantized)
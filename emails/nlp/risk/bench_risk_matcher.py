@@ -0,0 +1,84 @@
+# bench_risk_matcher.py
+# Times RiskMatcher (risk_matcher.py, one scan per document) against the per-pattern findall
+# loop it replaced in risk_hybrid.py / risk_hybrid_threads.py, on ThreadText, and checks the
+# per-category counts and matched terms are identical.
+#
+#   python emails/nlp/risk/bench_risk_matcher.py [--limit 5000]
+#   python emails/nlp/risk/bench_risk_matcher.py --thread-emails data/threads/ThreadEmails_internal_multi_9902.parquet
+#
+# ThreadText files written by the thread builders no longer carry body_concat; --thread-emails
+# renders the text from ThreadEmails + the body store instead (thread_text.py).
+
+import sys, time, argparse
+from pathlib import Path
+import pandas as pd
+
+from risk_hybrid import IN_THREADTEXT, IN_TAXON, load_taxonomy, prepare_thread_text
+from risk_matcher import RiskMatcher
+
+TAXONOMY = IN_TAXON if IN_TAXON.exists() else Path(__file__).resolve().parent / "risk_taxonomy.json"
+
+# ------------ previous implementation (baseline) ------------
+def old_keyword_score(text: str, compiled_patterns: dict):
+    counts = {}
+    hits_terms = {}
+    for cat, pats in compiled_patterns.items():
+        total = 0
+        terms = []
+        for pat in pats:
+            found = pat.findall(text)
+            if found:
+                total += len(found)
+                terms.append(pat.pattern)
+        counts[cat] = total
+        hits_terms[cat] = terms
+    return counts, hits_terms
+
+def load_thread_texts(args) -> list:
+    if args.thread_emails:
+        sys.path.append(str(Path(__file__).resolve().parents[2] / "data_prep" / "threads"))
+        from thread_text import ThreadTextView
+        view = ThreadTextView(args.thread_emails)
+        ids = view.thread_ids[:args.limit] if args.limit else None
+        df = pd.concat(list(view.iter_batches(ids)), ignore_index=True)
+    else:
+        df = pd.read_parquet(args.input)
+        if "body_concat" not in df.columns:
+            raise SystemExit(f"{args.input} has no body_concat: pass --thread-emails, or write one with "
+                             "emails/data_prep/threads/thread_text.py --out")
+        df = df.head(args.limit) if args.limit else df
+    return prepare_thread_text(df)["__text__"].fillna("").tolist()
+
+def timed(fn):
+    t0 = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - t0
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--input", default=str(IN_THREADTEXT), help="ThreadText parquet with body_concat")
+    ap.add_argument("--thread-emails", default=None, help="render the text from this ThreadEmails parquet")
+    ap.add_argument("--taxonomy", default=str(TAXONOMY))
+    ap.add_argument("--limit", type=int, default=None, help="only the first N threads")
+    args = ap.parse_args()
+
+    texts = load_thread_texts(args)
+    mb = sum(len(t) for t in texts) / 1e6
+    print(f"Loaded {len(texts):,} thread texts ({mb:,.1f} MB)")
+
+    _, compiled = load_taxonomy(Path(args.taxonomy))
+    matcher, t_build = timed(lambda: RiskMatcher(compiled))
+    print(f"{len(matcher.patterns)} patterns -> {len(matcher.literals)} literals "
+          f"({len(matcher.always)} patterns without one), built in {t_build * 1000:.1f} ms")
+
+    old, t_old = timed(lambda: [old_keyword_score(t, compiled) for t in texts])
+    new, t_new = timed(lambda: [matcher.score(t) for t in texts])
+    assert old == new, "keyword_score mismatch"
+
+    print(f"{'':22s} {'s':>8s} {'threads/s':>10s} {'MB/s':>7s}")
+    for name, t in (("per-pattern findall", t_old), ("RiskMatcher", t_new)):
+        print(f"{name:22s} {t:8.2f} {len(texts) / max(t, 1e-9):10,.0f} {mb / max(t, 1e-9):7.1f}")
+    print(f"speed-up {t_old / max(t_new, 1e-9):.1f}x (counts and matched terms identical)")
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,19 @@ Keyword/Rules Risk Scoring (emails + threads)
 - Inputs (all in the same folder as this file):
     TextBase.parquet              (emails, from Week 1)
     ThreadText.parquet            (Hai’s thread data)
+    ThreadEmails.parquet          (thread builders' output: the thread text is rendered from it
+                                   + the email bodies when ThreadText has no body_concat)
     RiskTaxonomy.json             (my keyword taxonomy)
     LabeledSeed.parquet           (manual seed labels)
+- Chunked + parallel: both inputs are streamed in chunks through a process pool (each worker
+  compiles the taxonomy once), emails and threads at the same time, and the scores are
+  appended to the parquet outputs as chunks finish.
+    python risk_hybrid.py [--workers N] [--chunk-rows 2000]
+- --incremental: after editing the taxonomy, only documents that can match an added, removed
+  or reordered pattern are re-scored (risk_index.py term index, written by every full run).
+- Keyword evidence is stored as character spans (hit_spans: category id, pattern id, start, end
+  into subject + " " + body), with the taxonomy in the parquet metadata; risk_spans.py turns
+  them into highlighted snippets. TopRisk*.csv keep the readable matched_terms_json.
 - Outputs (saved under ./risk_outputs):
     RiskScores.parquet
     TopRisk.csv
@@ -13,20 +24,37 @@ Keyword/Rules Risk Scoring (emails + threads)
     TopRisk_threads.csv
 """
 
-import os, re, json
+import os, re, sys, json, time, argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from risk_matcher import RiskMatcher   # whole taxonomy in one scan per document
+from risk_index import (TermIndex, TermIndexBuilder, chunk_tokens, fingerprint, load_meta, save_meta,
+                        taxonomy_snapshot, taxonomy_diff)
+from risk_spans import SPAN_TYPE, spans_array, with_taxonomy, read_taxonomy, remap_spans, terms_json
 
 # ----------------- paths -----------------
 BASE_DIR = Path(__file__).resolve().parent
 IN_TEXTBASE = BASE_DIR / "TextBase.parquet"
 IN_THREADTEXT = BASE_DIR / "ThreadText.parquet"
+IN_THREADEMAILS = BASE_DIR / "ThreadEmails.parquet"
+IN_EMAILS = BASE_DIR / "Emails_clean_9902.parquet"    # bodies for the thread text (its BodyStore if built)
 IN_TAXON = BASE_DIR / "RiskTaxonomy.json"
 IN_SEED = BASE_DIR / "LabeledSeed.parquet"
 
 OUT_DIR = BASE_DIR / "risk_outputs"
 OUT_DIR.mkdir(parents=True, exist_ok=True)
 
+WORKERS    = os.cpu_count() or 1
+CHUNK_ROWS = 2000         # documents per chunk handed to a worker
+TEXT_COLUMNS = [("subject_norm", "subject"), ("body_clean", "body_raw", "body_concat")]  # first present is used
+
 # ----------------- load taxonomy -----------------
 def load_taxonomy(tax_path: Path):
     """Loads my taxonomy JSON and compiles all regex patterns (handles both nested and flat)."""
@@ -54,36 +82,33 @@ def load_taxonomy(tax_path: Path):
 # ----------------- prep text fields -----------------
 def prepare_email_text(df: pd.DataFrame) -> pd.DataFrame:
     """Joins subject and body together for scanning."""
-    subj = df["subject_norm"] if "subject_norm" in df.columns else df.get("subject", "")
-    body = df["body_clean"] if "body_clean" in df.columns else df.get("body_raw", "")
+    subj = df["subject_norm"] if "subject_norm" in df.columns else df.get("subject", pd.Series("", index=df.index))
+    body = df["body_clean"] if "body_clean" in df.columns else df.get("body_raw", pd.Series("", index=df.index))
     df = df.copy()
     df["__text__"] = (subj.fillna("") + " " + body.fillna("")).str.strip()
     return df
 
 def prepare_thread_text(df: pd.DataFrame) -> pd.DataFrame:
-    """Does the same for thread-level data (subject + concatenated body)."""
-    subj = df["subject_norm"] if "subject_norm" in df.columns else ""
-    body = df["body_concat"] if "body_concat" in df.columns else ""
+    """Does the same for thread-level data (subject + concatenated body; see thread_source)."""
+    subj = df["subject_norm"] if "subject_norm" in df.columns else pd.Series("", index=df.index)
     df = df.copy()
-    df["__text__"] = (subj.fillna("") + " " + body.fillna("")).str.strip()
+    df["__text__"] = (subj.fillna("") + " " + df["body_concat"].fillna("")).str.strip()
     return df
 
-# ----------------- keyword matching -----------------
-def keyword_score(text: str, compiled_patterns: dict):
-    """Counts matches per category and stores the matching terms."""
-    counts = {}
-    hits_terms = {}
-    for cat, pats in compiled_patterns.items():
-        total = 0
-        terms = []
-        for pat in pats:
-            found = pat.findall(text)
-            if found:
-                total += len(found)
-                terms.append(pat.pattern)
-        counts[cat] = total
-        hits_terms[cat] = terms
-    return counts, hits_terms
+def thread_source(thread_text: Path, thread_emails: Path, emails: Path = IN_EMAILS):
+    """(in_path, view) for the threads block: ThreadText itself while it still has body_concat,
+    else a thread_text.ThreadTextView over ThreadEmails (text rendered from the email bodies).
+    None if neither file exists."""
+    if thread_text.exists() and "body_concat" in pq.read_schema(thread_text).names:
+        return thread_text, None
+    if thread_emails.exists():
+        sys.path.append(str(Path(__file__).resolve().parents[2] / "data_prep" / "threads"))
+        from thread_text import ThreadTextView
+        return thread_emails, ThreadTextView(thread_emails, input_path=emails)
+    if thread_text.exists():
+        raise SystemExit(f"{thread_text} has no body_concat: pass --thread-emails, or write one with "
+                         "emails/data_prep/threads/thread_text.py --out")
+    return None
 
 # ----------------- label + scoring logic -----------------
 def decide_label(counts: dict, seed_label: str | None = None):
@@ -98,51 +123,203 @@ def decide_label(counts: dict, seed_label: str | None = None):
     final_score = (by_cat / total) if total > 0 else 0.0
     return label, total, final_score
 
+# ----------------- worker state -----------------
+# Each worker process compiles the taxonomy once (pool initializer) and then scores chunks.
+_MATCHER = None
+_SEED_MAP = {}
+
+def init_worker(tax_path, seed_map: dict | None):
+    global _MATCHER, _SEED_MAP
+    _, compiled_patterns = load_taxonomy(Path(tax_path))
+    _MATCHER = RiskMatcher(compiled_patterns)
+    _SEED_MAP = seed_map or {}
+
+def score_schema(id_col: str, categories: list) -> pa.Schema:
+    return pa.schema([(id_col, pa.string()), ("risk_label", pa.string()), ("hits_total", pa.int64()),
+                      ("final_score", pa.float64()), ("hit_spans", SPAN_TYPE)]
+                     + [(f"hits_{c}", pa.int64()) for c in categories])
+
+def score_chunk(batch: pa.RecordBatch, id_col: str, prep_fn, use_seed: bool, with_tokens: bool = False):
+    """One chunk of documents -> its RiskScores rows (runs in the worker processes); with_tokens:
+    also the chunk's term-index postings (risk_index.chunk_tokens)."""
+    df = prep_fn(batch.to_pandas())
+    cats = _MATCHER.categories
+    cols = {id_col: [], "risk_label": [], "hits_total": [], "final_score": []}
+    spans = []
+    hits = {cat: [] for cat in cats}
+    for rid, txt in zip(df[id_col].tolist(), df["__text__"].tolist()):
+        counts, _, doc_spans = _MATCHER.match(txt or "")
+        seed_lbl = _SEED_MAP.get(rid) if use_seed else None
+        risk_label, hits_total, final_score = decide_label(counts, seed_lbl)
+
+        cols[id_col].append(rid)
+        cols["risk_label"].append(risk_label)
+        cols["hits_total"].append(hits_total)
+        cols["final_score"].append(round(float(final_score), 4))
+        spans.append(doc_spans)
+        for cat in cats:
+            hits[cat].append(counts.get(cat, 0))
+    cols["hit_spans"] = spans_array(spans)
+    cols.update({f"hits_{cat}": v for cat, v in hits.items()})
+    table = pa.table(cols, schema=score_schema(id_col, cats))
+    return (table, chunk_tokens(df["__text__"].tolist())) if with_tokens else table
+
+def iter_results(batches, fn, ex, workers: int):
+    """Yields fn(batch) in input order, keeping at most 2*workers batches in flight (ex None: inline)."""
+    if ex is None:
+        for b in batches:
+            yield fn(b)
+        return
+    pending = deque()
+    for b in batches:
+        pending.append(ex.submit(fn, b))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
 # ----------------- main scoring function -----------------
+def output_names(id_col: str):
+    csv_name = "TopRisk.csv" if id_col == "email_id" else "TopRisk_threads.csv"
+    pq_name  = "RiskScores.parquet" if id_col == "email_id" else "RiskScores_threads.parquet"
+    return pq_name, csv_name
+
+def input_batches(in_path: Path, id_col: str, chunk_rows: int, view=None, ids=None):
+    """RecordBatches of id_col + the text columns, chunk_rows at a time (ids: only these);
+    view: rendered from a ThreadTextView instead of read from in_path."""
+    if view is not None:
+        return (pa.RecordBatch.from_pandas(b[[id_col, "body_concat"]], preserve_index=False)
+                for b in view.iter_batches(None if ids is None else sorted(ids), batch_size=chunk_rows))
+    dataset = ds.dataset(in_path, format="parquet")
+    filt = None if ids is None else ds.field(id_col).isin(pa.array(sorted(ids), pa.string()))
+    return dataset.to_batches(columns=read_columns(dataset, id_col), batch_size=chunk_rows, filter=filt)
+
+def read_columns(dataset, id_col: str) -> list:
+    names = dataset.schema.names
+    return [id_col] + [next(c for c in group if c in names)
+                       for group in TEXT_COLUMNS if any(c in names for c in group)]
+
+def write_top_risk(out_dir: Path, id_col: str):
+    """TopRisk CSV from the scores parquet; the spans are rendered back to matched_terms_json."""
+    pq_name, csv_name = output_names(id_col)
+    table = pq.read_table(out_dir / pq_name)
+    spans = table.column("hit_spans").combine_chunks()
+    table = table.set_column(table.schema.get_field_index("hit_spans"), "matched_terms_json",
+                             pa.array(terms_json(spans, read_taxonomy(out_dir / pq_name)), pa.string()))
+    out_df = table.to_pandas()
+    out_df.sort_values(["final_score", id_col], ascending=[False, True]).to_csv(out_dir / csv_name, index=False)
+    print(f"Saved: {out_dir / csv_name}")
+
 def run_block(label: str,
               in_path: Path,
               id_col: str,
               prep_fn,
-              compiled_patterns: dict,
-              seed_map: dict | None):
-    print(f"\n--- Processing {label} ---")
-    df = pd.read_parquet(in_path)
-    df = prep_fn(df)
-
-    rows = []
-    for _, r in df.iterrows():
-        rid = r[id_col]
-        txt = r["__text__"] or ""
-        counts, terms = keyword_score(txt, compiled_patterns)
-        seed_lbl = seed_map.get(rid) if seed_map else None
-        risk_label, hits_total, final_score = decide_label(counts, seed_lbl)
+              categories: list,
+              use_seed: bool,
+              taxonomy: dict,
+              seed_map: dict | None = None,
+              ex=None,
+              workers: int = 1,
+              chunk_rows: int = CHUNK_ROWS,
+              out_dir: Path = OUT_DIR,
+              incremental: bool = False,
+              view=None):
+    """Streams in_path chunk by chunk through the workers and appends each chunk's scores
+    to the RiskScores parquet as it comes back; TopRisk is sorted from that file at the end.
+    Also writes the block's term index. incremental: re-score only what a taxonomy change
+    can affect (falls back to a full run if the index or the previous scores are unusable).
+    view: a ThreadTextView rendering the documents (in_path is then its ThreadEmails file)."""
+    index_dir = out_dir / "TermIndex"
+    meta = {"input": fingerprint(in_path), "taxonomy": taxonomy, "seed": seed_map if use_seed else {}}
+    if incremental:
+        old = load_meta(index_dir, label)
+        changed = taxonomy_diff(old["taxonomy"], taxonomy) if old else None
+        if old is None:
+            print(f"--- {label}: no term index yet -> full run ---")
+        elif old["input"] != meta["input"]:
+            print(f"--- {label}: {in_path.name} changed since the last run -> full run ---")
+        elif not (out_dir / output_names(id_col)[0]).exists():
+            print(f"--- {label}: no previous scores -> full run ---")
+        elif not pq.read_schema(out_dir / output_names(id_col)[0]).equals(score_schema(id_col, categories)):
+            print(f"--- {label}: previous scores have another layout -> full run ---")
+        elif changed is None:
+            print(f"--- {label}: taxonomy categories changed -> full run ---")
+        else:
+            return rescore_block(label, in_path, id_col, prep_fn, use_seed, categories, changed, old, meta,
+                                 ex, workers, chunk_rows, out_dir, view)
 
-        matched_terms_json = {k: v for k, v in terms.items() if v}
+    n_rows = len(view) if view is not None else ds.dataset(in_path, format="parquet").count_rows()
+    print(f"--- Processing {label}: {n_rows:,} rows from {in_path.name} ---")
 
-        out = {
-            id_col: rid,
-            "risk_label": risk_label,
-            "hits_total": hits_total,
-            "final_score": round(float(final_score), 4),
-            "matched_terms_json": json.dumps(matched_terms_json, ensure_ascii=False)
-        }
-        for cat in compiled_patterns.keys():
-            out[f"hits_{cat}"] = counts.get(cat, 0)
-        rows.append(out)
+    pq_name, _ = output_names(id_col)
+    fn = partial(score_chunk, id_col=id_col, prep_fn=prep_fn, use_seed=use_seed, with_tokens=True)
+    index = TermIndexBuilder()
+    t0 = time.perf_counter()
+    n = 0
+    with pq.ParquetWriter(out_dir / pq_name, with_taxonomy(score_schema(id_col, categories), taxonomy)) as w:
+        batches = input_batches(in_path, id_col, chunk_rows, view)
+        for table, postings in iter_results(batches, fn, ex, workers):
+            w.write_table(table)
+            index.add(table.column(id_col).to_pylist(), *postings)
+            n += table.num_rows
+    elapsed = time.perf_counter() - t0
+    index.write(index_dir, label, meta)
 
-    out_df = pd.DataFrame(rows)
+    print(f"Saved: {out_dir / pq_name} ({n:,} {label}, {n / max(elapsed, 1e-9):,.0f}/s)")
+    print(f"Saved: {index_dir / label}_terms.parquet ({len(index.vocab):,} terms)")
+    write_top_risk(out_dir, id_col)
+    return n
 
-    csv_name = "TopRisk.csv" if id_col == "email_id" else "TopRisk_threads.csv"
-    pq_name  = "RiskScores.parquet" if id_col == "email_id" else "RiskScores_threads.parquet"
-    out_df.sort_values(["final_score", id_col], ascending=[False, True]).to_csv(OUT_DIR / csv_name, index=False)
-    out_df.to_parquet(OUT_DIR / pq_name, index=False)
+def rescore_block(label, in_path, id_col, prep_fn, use_seed, categories, changed, old_meta, meta,
+                  ex, workers, chunk_rows, out_dir, view=None):
+    """Re-scores the documents the changed patterns (or changed seed labels) can touch and
+    swaps their rows in RiskScores; all other rows are copied through unchanged."""
+    t0 = time.perf_counter()
+    index = TermIndex(out_dir / "TermIndex", label)
+    ids = set(index.candidate_ids([(p, re.compile(p, re.IGNORECASE).flags) for p in changed]).tolist())
+    old_seed, new_seed = old_meta.get("seed", {}), meta["seed"]
+    ids |= {k for k in old_seed.keys() | new_seed.keys() if old_seed.get(k) != new_seed.get(k)}
+    print(f"--- Re-scoring {label}: {len(changed)} changed patterns -> {len(ids):,} of "
+          f"{len(index.doc_ids):,} documents ---")
+
+    pq_name, _ = output_names(id_col)
+    if ids:
+        keep = pa.array(sorted(ids), pa.string())
+        batches = input_batches(in_path, id_col, chunk_rows, view, ids)
+        fn = partial(score_chunk, id_col=id_col, prep_fn=prep_fn, use_seed=use_seed)
+        new = list(iter_results(batches, fn, ex, workers))
 
-    print(f"Saved: {OUT_DIR / pq_name}")
-    print(f"Saved: {OUT_DIR / csv_name}")
-    return out_df
+        path = out_dir / pq_name
+        tmp = path.with_suffix(".tmp.parquet")
+        scores = ds.dataset(path, format="parquet")
+        old_tax = read_taxonomy(path)
+        spans_i = scores.schema.get_field_index("hit_spans")
+        with pq.ParquetWriter(tmp, with_taxonomy(score_schema(id_col, categories), meta["taxonomy"])) as w:
+            for batch in scores.to_batches(filter=~ds.field(id_col).isin(keep)):
+                if batch.num_rows:       # pattern ids follow the edited taxonomy's order
+                    spans = remap_spans(batch.column(spans_i), old_tax, meta["taxonomy"])
+                    w.write_batch(batch.set_column(spans_i, "hit_spans", spans))
+            for table in new:
+                w.write_table(table)
+        os.replace(tmp, path)
+        print(f"Saved: {path} ({sum(t.num_rows for t in new):,} rows re-scored in {time.perf_counter() - t0:.1f} s)")
+        write_top_risk(out_dir, id_col)
+    save_meta(out_dir / "TermIndex", label, meta)
+    return len(ids)
 
 # ----------------- main entry -----------------
 def main():
+    ap = argparse.ArgumentParser(description="Keyword/rules risk scoring for emails and threads.")
+    ap.add_argument("--workers", type=int, default=WORKERS)
+    ap.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    ap.add_argument("--incremental", action="store_true",
+                    help="after a taxonomy edit: re-score only the documents the changed patterns "
+                         "can match (looked up in risk_outputs/TermIndex)")
+    ap.add_argument("--thread-emails", default=str(IN_THREADEMAILS),
+                    help="render the thread text from this ThreadEmails parquet when ThreadText has no body_concat")
+    ap.add_argument("--emails", default=str(IN_EMAILS), help="cleaned emails the thread bodies come from")
+    args = ap.parse_args()
+
     assert IN_TEXTBASE.exists(), f"Missing {IN_TEXTBASE}"
     assert IN_TAXON.exists(), f"Missing {IN_TAXON}"
 
@@ -156,28 +333,29 @@ def main():
             seed_map = dict(zip(seed_df["email_id"], seed_df["risk_label"].astype(str)))
             print(f"Loaded seed labels: {len(seed_map)} items")
 
-    # Run scoring for emails
-    run_block(
-        label="emails",
-        in_path=IN_TEXTBASE,
-        id_col="email_id",
-        prep_fn=prepare_email_text,
-        compiled_patterns=compiled_patterns,
-        seed_map=seed_map
-    )
-
-    # Run scoring for threads if available
-    if IN_THREADTEXT.exists():
-        run_block(
-            label="threads",
-            in_path=IN_THREADTEXT,
-            id_col="thread_id",
-            prep_fn=prepare_thread_text,
-            compiled_patterns=compiled_patterns,
-            seed_map=None
-        )
+    # Emails and (if available) threads, both streamed through one worker pool at the same time
+    blocks = [dict(label="emails", in_path=IN_TEXTBASE, id_col="email_id",
+                   prep_fn=prepare_email_text, use_seed=True)]
+    threads = thread_source(IN_THREADTEXT, Path(args.thread_emails), Path(args.emails))
+    if threads:
+        blocks.append(dict(label="threads", in_path=threads[0], view=threads[1], id_col="thread_id",
+                           prep_fn=prepare_thread_text, use_seed=False))
+    else:
+        print("\n(No ThreadText.parquet / ThreadEmails.parquet found — skipping threads block.)")
+
+    print(f"Scoring with {args.workers} workers, {args.chunk_rows:,} rows/chunk")
+    common = dict(categories=categories, taxonomy=taxonomy_snapshot(compiled_patterns), seed_map=seed_map,
+                  workers=args.workers, chunk_rows=args.chunk_rows, incremental=args.incremental)
+    if args.workers <= 1:
+        init_worker(IN_TAXON, seed_map)
+        for b in blocks:
+            run_block(**b, **common)
     else:
-        print("\n(No ThreadText.parquet found — skipping threads block.)")
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                 initargs=(str(IN_TAXON), seed_map)) as ex, \
+             ThreadPoolExecutor(max_workers=len(blocks)) as feeders:
+            for f in [feeders.submit(run_block, **b, ex=ex, **common) for b in blocks]:
+                f.result()
 
     print("\nDone.")
 
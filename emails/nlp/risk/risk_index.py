@@ -0,0 +1,179 @@
+# risk_index.py
+# Inverted term index for incremental hybrid risk scoring. A full risk_hybrid.py run also
+# writes, per block (emails / threads), under risk_outputs/TermIndex/:
+#   <block>_terms.parquet   token (sorted) -> docs (list<int32> of row numbers)
+#   <block>_docs.parquet    row number -> document id
+#   <block>_meta.json       input fingerprint + the taxonomy (and seed labels) the scores used
+# Tokens are the \w+ runs of the case-folded text the matcher scans (risk_matcher.fold).
+#
+# When risk_taxonomy.json changes, taxonomy_diff() lists the patterns that were added, removed
+# or reordered; every match of a pattern contains its literal runs, so candidate_rows() looks
+# those runs up in the index (exact token, token prefix/suffix or substring, depending on what
+# the pattern pins down) and only the candidate documents need re-scoring. No other document's
+# counts or matched terms can change.
+
+import re, json
+from pathlib import Path
+from bisect import bisect_left
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from risk_matcher import fold
+try:
+    import re._parser as sre_parse          # Python 3.11+
+    from re._constants import LITERAL, AT, AT_BOUNDARY
+except ImportError:
+    import sre_parse
+    from sre_constants import LITERAL, AT, AT_BOUNDARY
+
+TOKEN = re.compile(r"\w+")
+
+# ------------ Tokens ------------
+def chunk_tokens(texts):
+    """Distinct tokens of each text -> (chunk vocabulary, token index per pair, text row per pair)."""
+    vocab, tok, row = {}, [], []
+    for i, t in enumerate(texts):
+        for w in set(TOKEN.findall(fold(t))) if t else ():
+            tok.append(vocab.setdefault(w, len(vocab)))
+            row.append(i)
+    return list(vocab), np.array(tok, dtype=np.int32), np.array(row, dtype=np.int32)
+
+class TermIndexBuilder:
+    """Collects chunk_tokens() output chunk by chunk (rows numbered in arrival order)."""
+
+    def __init__(self):
+        self.vocab, self.toks, self.rows, self.ids = {}, [], [], []
+        self.n = 0
+
+    def add(self, ids, vocab, tok, row):
+        remap = np.array([self.vocab.setdefault(w, len(self.vocab)) for w in vocab], dtype=np.int32)
+        self.toks.append(remap[tok] if len(tok) else tok)
+        self.rows.append(row + self.n)
+        self.ids.extend(ids)
+        self.n += len(ids)
+
+    def write(self, index_dir: Path, block: str, meta: dict):
+        index_dir.mkdir(parents=True, exist_ok=True)
+        words = np.array(list(self.vocab), dtype=object)
+        rank = np.empty(len(words), dtype=np.int64)
+        rank[np.argsort(words, kind="stable")] = np.arange(len(words))
+        toks = rank[np.concatenate(self.toks)] if self.toks else np.zeros(0, np.int64)
+        rows = np.concatenate(self.rows) if self.rows else np.zeros(0, np.int32)
+        order = np.lexsort((rows, toks))
+        offsets = np.r_[0, np.cumsum(np.bincount(toks, minlength=len(words)))].astype(np.int32)
+        docs = pa.ListArray.from_arrays(pa.array(offsets), pa.array(rows[order], pa.int32()))
+        pq.write_table(pa.table({"token": pa.array(np.sort(words), pa.string()), "docs": docs}),
+                       index_dir / f"{block}_terms.parquet")
+        pq.write_table(pa.table({"doc_id": pa.array(self.ids, pa.string())}), index_dir / f"{block}_docs.parquet")
+        save_meta(index_dir, block, meta)
+
+def save_meta(index_dir: Path, block: str, meta: dict):
+    with open(index_dir / f"{block}_meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=1, ensure_ascii=False)
+
+def load_meta(index_dir: Path, block: str) -> dict | None:
+    p = index_dir / f"{block}_meta.json"
+    if not p.exists() or not (index_dir / f"{block}_terms.parquet").exists():
+        return None
+    with open(p, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def fingerprint(path: Path) -> dict:
+    st = Path(path).stat()
+    return {"path": str(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+# ------------ Pattern -> index query ------------
+def literal_runs(pattern: str, flags: int = 0) -> list:
+    """(literal, \\b right before?, \\b right after?) for each run of plain characters in the
+    top level of pattern; every match of the pattern contains every run."""
+    runs, run, before = [], [], False
+    items = list(sre_parse.parse(pattern, flags))
+    for k, (op, arg) in enumerate(items + [(None, None)]):
+        if op is LITERAL:
+            if not run:
+                before = k > 0 and items[k - 1] == (AT, AT_BOUNDARY)
+            run.append(chr(arg))
+            continue
+        if run:
+            runs.append(("".join(run).lower(), before, (op, arg) == (AT, AT_BOUNDARY)))
+        run = []
+    return runs
+
+def token_queries(pattern: str, flags: int = 0) -> list:
+    """(piece, mode) lookups whose documents are a superset of the pattern's matches;
+    mode: "exact", "prefix", "suffix" or "substring" (how the piece sits in a token)."""
+    unicode_b = not flags & re.ASCII                 # \b must agree with the \w+ tokenizer
+    queries = []
+    for lit, b_before, b_after in literal_runs(pattern, flags):
+        pieces = TOKEN.findall(lit)
+        starts_w, ends_w = bool(TOKEN.match(lit)), bool(re.search(r"\w$", lit))
+        for i, piece in enumerate(pieces):
+            if not piece.isascii():
+                continue
+            start = i > 0 or not starts_w or (b_before and unicode_b)
+            end = i < len(pieces) - 1 or not ends_w or (b_after and unicode_b)
+            mode = {(True, True): "exact", (True, False): "prefix",
+                    (False, True): "suffix", (False, False): "substring"}[start, end]
+            queries.append((piece, mode))
+    return queries
+
+class TermIndex:
+    """A block's index loaded from risk_outputs/TermIndex."""
+
+    def __init__(self, index_dir: Path, block: str):
+        terms = pq.read_table(index_dir / f"{block}_terms.parquet")
+        self.tokens = terms.column("token").to_pylist()
+        self.docs = terms.column("docs").combine_chunks()
+        self.doc_ids = pq.read_table(index_dir / f"{block}_docs.parquet").column("doc_id").to_numpy(zero_copy_only=False)
+
+    def _token_rows(self, piece: str, mode: str) -> np.ndarray:
+        if mode == "exact":
+            i = bisect_left(self.tokens, piece)
+            return np.array([i] if i < len(self.tokens) and self.tokens[i] == piece else [], dtype=np.int64)
+        if mode == "prefix":
+            lo = bisect_left(self.tokens, piece)
+            hi = bisect_left(self.tokens, piece[:-1] + chr(ord(piece[-1]) + 1))
+            return np.arange(lo, hi, dtype=np.int64)
+        test = str.endswith if mode == "suffix" else str.__contains__
+        return np.array([i for i, t in enumerate(self.tokens) if test(t, piece)], dtype=np.int64)
+
+    def rows_for(self, pattern: str, flags: int = 0) -> np.ndarray | None:
+        """Rows that may match pattern (None: the pattern has no usable literal, any row may)."""
+        rows = None
+        for piece, mode in token_queries(pattern, flags):
+            tr = self._token_rows(piece, mode)
+            found = np.unique(pc.list_flatten(self.docs.take(pa.array(tr))).to_numpy()) if len(tr) else np.zeros(0, np.int32)
+            rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+        return rows
+
+    def candidate_ids(self, patterns) -> np.ndarray:
+        """Document ids that may match any of patterns ((pattern, flags) pairs)."""
+        hit = np.zeros(len(self.doc_ids), dtype=bool)
+        for pattern, flags in patterns:
+            rows = self.rows_for(pattern, flags)
+            if rows is None:
+                return self.doc_ids
+            hit[rows] = True
+        return self.doc_ids[hit]
+
+# ------------ Taxonomy diff ------------
+def taxonomy_snapshot(compiled_patterns: dict) -> dict:
+    return {cat: [p.pattern for p in pats] for cat, pats in compiled_patterns.items()}
+
+def taxonomy_diff(old: dict, new: dict) -> list | None:
+    """Patterns whose presence or position changed between two snapshots ({category: [pattern]}).
+    None if the categories themselves changed (the output columns differ: full re-run)."""
+    if list(old) != list(new):
+        return None
+    changed = []
+    for cat in new:
+        o, n = old[cat], new[cat]
+        common_o = [p for p in o if p in set(n)]
+        common_n = [p for p in n if p in set(o)]
+        if common_o != common_n:            # reordered: matched-term order can change
+            changed.extend(dict.fromkeys(o + n))
+        else:
+            changed.extend([p for p in n if p not in set(o)] + [p for p in o if p not in set(n)])
+    return list(dict.fromkeys(changed))
@@ -0,0 +1,130 @@
+# risk_matcher.py
+# One-pass keyword matching for the hybrid risk scorers. keyword_score() in risk_hybrid.py /
+# risk_hybrid_threads.py ran pat.findall(text) for every pattern of every category, so each
+# document was scanned ~120 times. RiskMatcher compiles the whole taxonomy into one alternation
+# of the patterns' required literals and scans the document once; only patterns whose literal
+# occurs are then run (usually none or a handful), so counts and matched terms are exactly those
+# of the per-pattern findall loop. The literals are merged into a prefix trie ("br(?:each|ibe)")
+# so the regex engine follows one path per position instead of trying ~120 alternatives.
+#
+#   matcher = RiskMatcher(compiled_patterns)       # {category: [compiled regex]} from load_taxonomy()
+#   counts, hits_terms = matcher.score(text)       # same output as keyword_score(text, compiled_patterns)
+#   counts, hits_terms, spans = matcher.match(text)
+#       spans: (category index, pattern index within the category, start, end) of every match,
+#       in text order -- the evidence risk_spans.py stores and highlights without re-running regexes
+#
+# Required literal: the longest run of plain characters every match of the pattern must contain
+# ("\bmoney laund(er|ering)\b" -> "money laund"). A pattern without one (e.g. "\b(a|b)\b") is
+# simply always run (as is one whose literal is not ASCII). The scan runs case-sensitively over a
+# case-folded copy of the text and never misses a pattern: it finds the longest literal at every
+# position where one starts (positions inside a hit are probed separately, hits are rare), and a
+# literal implies every literal it contains.
+
+import re
+try:
+    import re._parser as sre_parse          # Python 3.11+
+    from re._constants import LITERAL
+except ImportError:
+    import sre_parse
+    from sre_constants import LITERAL
+
+def required_literal(pattern: str, flags: int = 0) -> str | None:
+    """Longest literal substring every match of pattern contains (lowercased), or None."""
+    best, run = "", []
+    for op, arg in list(sre_parse.parse(pattern, flags)) + [(None, None)]:
+        if op is LITERAL:
+            run.append(chr(arg))
+            continue
+        if len(run) > len(best):
+            best = "".join(run)
+        run = []
+    return best.lower() or None
+
+# Non-ASCII characters re.IGNORECASE matches to an ASCII letter although their lower() is not
+# that letter; U+0130 is also the only character whose lower() is two characters long.
+_FOLD = str.maketrans({"\u0130": "i", "\u0131": "i", "\u017f": "s"})
+
+def fold(text: str) -> str:
+    """Case-folded text in which each ASCII literal occurs wherever it matches under re.I."""
+    return text.lower() if text.isascii() else text.translate(_FOLD).lower()
+
+def trie_regex(words) -> str:
+    """Regex matching any of words, factored on common prefixes; prefers the longest word."""
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}                       # end of a word
+
+    def build(node) -> str:
+        alts = [re.escape(ch) + build(node[ch]) for ch in sorted(k for k in node if k)]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body
+    return build(trie)
+
+class RiskMatcher:
+    """Whole-taxonomy matcher built from {category: [compiled regex]}."""
+
+    def __init__(self, compiled_patterns: dict):
+        self.categories = list(compiled_patterns)
+        self.patterns = []          # flat (category index, compiled regex)
+        self._pj = []               # flat -> pattern index within its category
+        for ci, cat in enumerate(self.categories):
+            self.patterns.extend((ci, p) for p in compiled_patterns[cat])
+            self._pj.extend(range(len(compiled_patterns[cat])))
+
+        lits = [required_literal(p.pattern, p.flags) for _, p in self.patterns]
+        lits = [l if l and l.isascii() else None for l in lits]
+        self.literals = sorted({l for l in lits if l}, key=lambda l: (-len(l), l))
+        lit_idx = {l: i for i, l in enumerate(self.literals)}
+        self.always = [j for j, l in enumerate(lits) if not l]             # no literal: always run
+        by_lit = [[] for _ in self.literals]
+        for j, l in enumerate(lits):
+            if l:
+                by_lit[lit_idx[l]].append(j)
+        # a literal found implies the patterns of every literal it contains
+        self._implied = [sorted({j for m in self.literals if m in l for j in by_lit[lit_idx[m]]})
+                         for l in self.literals]
+
+        self._lit_idx = lit_idx
+        self._scan = re.compile(trie_regex(self.literals)) if self.literals else None
+
+    def candidates(self, text: str) -> list:
+        """Indices into self.patterns whose required literal occurs in text (plus literal-free ones)."""
+        out = set(self.always)
+        if self._scan is not None and text:
+            folded = fold(text)
+            found = set()
+            for m in self._scan.finditer(folded):
+                found.add(m.group())
+                for i in range(m.start() + 1, m.end()):      # literals starting inside this one
+                    inner = self._scan.match(folded, i)
+                    if inner:
+                        found.add(inner.group())
+            for l in found:
+                out.update(self._implied[self._lit_idx[l]])
+        return sorted(out)
+
+    def match(self, text: str):
+        """-> (counts per category, matched patterns per category, spans sorted by position)."""
+        counts = dict.fromkeys(self.categories, 0)
+        hits_terms = {cat: [] for cat in self.categories}
+        spans = []
+        for j in self.candidates(text):
+            ci, pat = self.patterns[j]
+            found = [(ci, self._pj[j], m.start(), m.end()) for m in pat.finditer(text)]
+            if found:
+                cat = self.categories[ci]
+                counts[cat] += len(found)
+                hits_terms[cat].append(pat.pattern)
+                spans.extend(found)
+        spans.sort(key=lambda s: (s[2], s[3], s[0], s[1]))
+        return counts, hits_terms, spans
+
+    def score(self, text: str):
+        """-> (counts per category, matched patterns per category), as keyword_score()."""
+        counts, hits_terms, _ = self.match(text)
+        return counts, hits_terms
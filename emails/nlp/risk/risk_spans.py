@@ -0,0 +1,178 @@
+# risk_spans.py
+# Keyword evidence for the hybrid risk scores. risk_hybrid.py stores, per document, every keyword
+# match RiskMatcher found as a compact span list instead of pattern-name JSON:
+#   hit_spans: list<struct<cat: int16, pattern: int16, start: int32, end: int32>>
+#       cat      index into the taxonomy's categories
+#       pattern  index of the regex within that category
+#       start/end character offsets into the scanned text ("__text__": subject + " " + body,
+#                stripped -- prepare_email_text() / prepare_thread_text() in risk_hybrid.py)
+# The taxonomy the ids refer to ({category: [pattern]}) travels in the parquet's schema metadata,
+# so a RiskScores file is self-describing. Highlighting or snippets then need only the text and
+# the spans -- no regex is re-run by the dashboard or by reviewers.
+#
+#   taxonomy = read_taxonomy("risk_outputs/RiskScores.parquet")
+#   highlight(text, spans)                          # "... a [bribe] was paid ..."
+#   snippets(text, spans, taxonomy, width=60)       # one context window per match
+#
+#   python emails/nlp/risk/risk_spans.py --id <email_id> [--threads] [--width 60]
+
+import json, argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+SPAN_TYPE = pa.list_(pa.struct([("cat", pa.int16()), ("pattern", pa.int16()),
+                                ("start", pa.int32()), ("end", pa.int32())]))
+TAXONOMY_KEY = b"risk_taxonomy"
+
+# ------------ Arrow encoding ------------
+def spans_array(rows: list) -> pa.Array:
+    """Per-document lists of (cat, pattern, start, end) tuples -> a SPAN_TYPE array."""
+    offsets = np.zeros(len(rows) + 1, dtype=np.int32)
+    np.cumsum([len(r) for r in rows], out=offsets[1:])
+    flat = np.array([s for r in rows for s in r], dtype=np.int64).reshape(-1, 4)
+    fields = SPAN_TYPE.value_type
+    values = pa.StructArray.from_arrays(
+        [pa.array(flat[:, k], fields[k].type) for k in range(4)], fields=list(fields))
+    return pa.ListArray.from_arrays(pa.array(offsets), values, type=SPAN_TYPE)
+
+def with_taxonomy(schema: pa.Schema, taxonomy: dict) -> pa.Schema:
+    return schema.with_metadata({TAXONOMY_KEY: json.dumps(taxonomy, ensure_ascii=False)})
+
+def read_taxonomy(path) -> dict:
+    """{category: [pattern]} the span ids of a RiskScores file refer to."""
+    meta = pq.read_schema(path).metadata or {}
+    if TAXONOMY_KEY not in meta:
+        raise ValueError(f"{path} carries no taxonomy metadata (written before hit_spans?)")
+    return json.loads(meta[TAXONOMY_KEY])
+
+def remap_spans(spans: pa.Array, old: dict, new: dict) -> pa.Array:
+    """Re-points pattern ids from taxonomy snapshot old to new (same categories); a pattern
+    that occurs k times in a category maps to its k-th occurrence in the new one."""
+    lookup = []
+    for cat in new:
+        where = {}
+        for j, p in enumerate(new[cat]):
+            where.setdefault(p, []).append(j)
+        seen = {}
+        ids = []
+        for p in old[cat]:
+            k = seen[p] = seen.get(p, -1) + 1
+            ids.append(where[p][k] if k < len(where.get(p, ())) else -1)
+        lookup.append(np.array(ids or [-1], dtype=np.int16))
+    if all(np.array_equal(l, np.arange(len(l))) for l in lookup):
+        return spans
+    values = spans.flatten()
+    cat = values.field("cat").to_numpy()
+    pat = values.field("pattern").to_numpy().copy()
+    for ci, l in enumerate(lookup):
+        m = cat == ci
+        pat[m] = l[pat[m]]
+    if (pat < 0).any():
+        raise ValueError("spans refer to a pattern missing from the new taxonomy")
+    fields = SPAN_TYPE.value_type
+    values = pa.StructArray.from_arrays([values.field("cat"), pa.array(pat, pa.int16()),
+                                         values.field("start"), values.field("end")], fields=list(fields))
+    offsets = pc.subtract(spans.offsets, spans.offsets[0])           # spans may be a slice
+    return pa.ListArray.from_arrays(offsets, values, type=SPAN_TYPE)
+
+def terms_json(spans: pa.Array, taxonomy: dict) -> list:
+    """matched_terms_json strings ({category: [matched pattern]}, taxonomy order) from spans."""
+    cats = list(taxonomy)
+    out = ["{}"] * len(spans)
+    values = spans.flatten()
+    if len(values) == 0:
+        return out
+    parent = pc.list_parent_indices(spans).to_numpy().astype(np.int64)
+    key = np.unique((parent << 32) | (values.field("cat").to_numpy().astype(np.int64) << 16)
+                    | values.field("pattern").to_numpy().astype(np.int64))
+    rows, cat, pat = key >> 32, (key >> 16) & 0xFFFF, key & 0xFFFF
+    bounds = np.flatnonzero(np.diff(rows)) + 1
+    for r, c, p in zip(np.split(rows, bounds), np.split(cat, bounds), np.split(pat, bounds)):
+        found = {}
+        for ci, pj in zip(c.tolist(), p.tolist()):
+            found.setdefault(cats[ci], []).append(taxonomy[cats[ci]][pj])
+        out[int(r[0])] = json.dumps(found, ensure_ascii=False)
+    return out
+
+# ------------ Highlighting ------------
+def _as_tuples(spans) -> list:
+    """Accepts tuples or the dicts pyarrow's to_pylist() gives for SPAN_TYPE rows."""
+    return [(s["cat"], s["pattern"], s["start"], s["end"]) if isinstance(s, dict) else tuple(s)
+            for s in (spans or ())]
+
+def merged_ranges(spans, lo: int = 0, hi: int | None = None) -> list:
+    """Non-empty (start, end) ranges of spans clipped to [lo, hi), overlaps merged."""
+    out = []
+    for _, _, s, e in sorted(_as_tuples(spans), key=lambda t: (t[2], t[3])):
+        s, e = max(s, lo), e if hi is None else min(e, hi)
+        if e <= s:
+            continue
+        if out and s <= out[-1][1]:
+            out[-1][1] = max(out[-1][1], e)
+        else:
+            out.append([s, e])
+    return out
+
+def highlight(text: str, spans, mark=("[", "]"), lo: int = 0, hi: int | None = None) -> str:
+    """text[lo:hi] with every matched range wrapped in mark."""
+    hi = len(text) if hi is None else hi
+    parts, pos = [], lo
+    for s, e in merged_ranges(spans, lo, hi):
+        parts += [text[pos:s], mark[0], text[s:e], mark[1]]
+        pos = e
+    parts.append(text[pos:hi])
+    return "".join(parts)
+
+def snippets(text: str, spans, taxonomy: dict, width: int = 60, mark=("[", "]"), limit: int | None = None) -> list:
+    """One context window per match: {category, pattern, start, end, snippet}; every match
+    inside a window is highlighted, whitespace is collapsed."""
+    cats = list(taxonomy)
+    out = []
+    for ci, pj, s, e in _as_tuples(spans)[:limit]:
+        lo, hi = max(0, s - width), min(len(text), e + width)
+        body = " ".join(highlight(text, spans, mark, lo, hi).split())
+        out.append({"category": cats[ci], "pattern": taxonomy[cats[ci]][pj], "start": s, "end": e,
+                    "snippet": ("…" if lo > 0 else "") + body + ("…" if hi < len(text) else "")})
+    return out
+
+# ------------ Reading back ------------
+def load_spans(scores_path, ids: list, id_col: str = "email_id") -> dict:
+    """{document id: spans (list of dicts)} for ids, read with a pushed-down id filter."""
+    t = ds.dataset(scores_path, format="parquet").to_table(
+        columns=[id_col, "hit_spans"], filter=ds.field(id_col).isin(pa.array(ids, pa.string())))
+    return dict(zip(t.column(id_col).to_pylist(), t.column("hit_spans").to_pylist()))
+
+def main():
+    from risk_hybrid import (OUT_DIR, IN_TEXTBASE, IN_THREADTEXT, prepare_email_text, prepare_thread_text,
+                             read_columns, output_names)
+    ap = argparse.ArgumentParser(description="Highlighted keyword evidence for scored emails/threads.")
+    ap.add_argument("--id", action="append", required=True, help="email_id (or thread_id with --threads); repeatable")
+    ap.add_argument("--threads", action="store_true")
+    ap.add_argument("--width", type=int, default=60, help="characters of context either side")
+    ap.add_argument("--limit", type=int, default=10, help="snippets per document")
+    args = ap.parse_args()
+
+    id_col, in_path, prep_fn = (("thread_id", IN_THREADTEXT, prepare_thread_text) if args.threads
+                                else ("email_id", IN_TEXTBASE, prepare_email_text))
+    scores_path = OUT_DIR / output_names(id_col)[0]
+    taxonomy = read_taxonomy(scores_path)
+    spans = load_spans(scores_path, args.id, id_col)
+
+    dataset = ds.dataset(in_path, format="parquet")
+    docs = dataset.to_table(columns=read_columns(dataset, id_col),
+                            filter=ds.field(id_col).isin(pa.array(args.id, pa.string()))).to_pandas()
+    texts = dict(zip(docs[id_col], prep_fn(docs)["__text__"].fillna("")))
+
+    for rid in args.id:
+        if rid not in spans:
+            print(f"\n{rid}: not in {scores_path.name}")
+            continue
+        print(f"\n{rid}: {len(spans[rid])} keyword hits")
+        for sn in snippets(texts.get(rid, ""), spans[rid], taxonomy, args.width, limit=args.limit):
+            print(f"  [{sn['category']}] {sn['pattern']}\n      {sn['snippet']}")
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,8 @@ from pathlib import Path
 import json, re
 import pandas as pd
 
+from risk_matcher import RiskMatcher   # one scan per email, match spans reused below
+
 # -------- File setup (Downloads folder) --------
 DL = Path.home() / "Downloads"
 TEXTBASE = DL / "TextBase.parquet"           # this file should already exist
@@ -63,11 +65,13 @@ tb = tb[tb["text_len_tokens"].fillna(0) >= 3].copy()
 tb["body_clean"] = tb["body_clean"].fillna("")
 
 # -------- Count keyword hits for each risk category --------
-def count_hits(text: str, patterns):
-    return sum(bool(re.search(p, text, flags=re.IGNORECASE)) for p in patterns)
+# Matched patterns per category, from one RiskMatcher pass (reused for matched_terms_json below)
+matcher = RiskMatcher({cat: [re.compile(p, re.IGNORECASE) for p in pats]
+                       for cat, pats in taxonomy["keywords"].items()})
+tb["__terms__"] = tb["body_clean"].map(lambda t: matcher.match(t)[1])
 
-for cat, patterns in taxonomy["keywords"].items():
-    tb[f"hits_{cat}"] = tb["body_clean"].apply(lambda t: count_hits(t, patterns))
+for cat in taxonomy["keywords"]:
+    tb[f"hits_{cat}"] = tb["__terms__"].map(lambda terms: len(terms[cat]))
 
 # Total hit count across all categories
 hit_cols = [c for c in tb.columns if c.startswith("hits_")]
@@ -97,15 +101,10 @@ seed_df["severity"]   = ""     # pick one of taxonomy["severity_levels"]
 seed_df["notes"]      = ""     # optional notes during labelling
 
 # -------- Record which patterns matched (for reviewer reference) --------
-def matched_json(row):
-    found = {}
-    for cat, pats in taxonomy["keywords"].items():
-        found_terms = [p for p in pats if re.search(p, row["body_clean"], re.IGNORECASE)]
-        if found_terms:
-            found[cat] = found_terms
-    return json.dumps(found)
-
-seed_df["matched_terms_json"] = seed_df.apply(matched_json, axis=1)
+def matched_json(terms):
+    return json.dumps({cat: found for cat, found in terms.items() if found})
+
+seed_df["matched_terms_json"] = seed_df["__terms__"].map(matched_json)
 
 # Final order for the output columns
 out_cols = [
@@ -4,12 +4,26 @@ Zero-Shot Risk Classification on flagged emails only
 Uses facebook/bart-large-mnli to predict the main risk label
 Runs only on emails where hits_total > 0 (from the hybrid model)
 This version points to my local OneDrive maildir.
+Batched: premise/hypothesis pairs of many emails are length-sorted and run together
+(risk_zeroshot_engine.py) — same labels and confidences as the per-email pipeline calls.
+Each finished window is appended as a shard under risk_outputs/RiskScores_zeroshot_flagged.parts/;
+a rerun after a crash skips the emails already done, and the shards are compacted into the
+final parquet/CSV at the end (emails/nlp/inference_checkpoint.py).
+Results are cached by content hash in risk_outputs/InferenceCache.sqlite (emails/nlp/inference_cache.py):
+texts seen before with the same model and categories are not re-run; hit rate and time saved
+are printed at the end.
+BACKEND = "onnx" runs an int8-quantised ONNX export of the model through ONNX Runtime on CPU
+(emails/nlp/onnx_backend.py; exported to risk_outputs/onnx_models/ on first use).
 """
 
-import pandas as pd, json, time
+import sys, pandas as pd, json, time
 from pathlib import Path
 from tqdm import tqdm
-from transformers import pipeline
+
+from risk_zeroshot_engine import ZeroShotEngine, MODEL_NAME
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from inference_checkpoint import ShardCheckpoint
+from inference_cache import InferenceCache, model_revision
 
 # -------------------- Paths --------------------
 BASE_DIR = Path("C:/Users/petermak11/OneDrive - Swinburne University/Documents/Master of IT/2025 Semester 2/COS70008 - Technology Innovation Research and Project/enron_mail_20150507.tar/enron_mail_20150507/maildir")
@@ -23,6 +37,10 @@ OUT_DIR.mkdir(parents=True, exist_ok=True)
 
 OUT_PARQ = OUT_DIR / "RiskScores_zeroshot_flagged.parquet"
 OUT_CSV  = OUT_DIR / "RiskScores_zeroshot_flagged.csv"
+CACHE_PATH = OUT_DIR / "InferenceCache.sqlite"   # shared by the email and thread runs
+ONNX_DIR   = OUT_DIR / "onnx_models"
+
+BACKEND = "torch"    # "onnx": int8-quantised ONNX Runtime on CPU
 
 # -------------------- Load text + hybrid data --------------------
 print("\nLoading text data and hybrid keyword results...")
@@ -37,6 +55,21 @@ df = text_df[text_df["email_id"].isin(flagged_ids)].copy()
 df["__text__"] = (df["subject_norm"].fillna("") + " " + df["body_clean"].fillna("")).str.strip()
 print(f"Loaded {len(df)} flagged emails for zero-shot classification.")
 
+# Near-duplicates (dup_cluster_id from preprocess.py): classify one email per cluster and
+# copy the result to the other flagged copies when saving
+members = None
+if "dup_cluster_id" in df.columns:
+    members = df[["email_id", "dup_cluster_id"]].copy()
+    df = df.drop_duplicates("dup_cluster_id").copy()
+    print(f"{len(df)} near-duplicate clusters to classify ({len(members) - len(df)} copies reuse a result).")
+
+def expand_clusters(out: pd.DataFrame) -> pd.DataFrame:
+    """Gives every flagged copy in a near-duplicate cluster its representative's result."""
+    if members is None or out.empty:
+        return out
+    res = out.merge(df[["email_id", "dup_cluster_id"]], on="email_id").drop(columns="email_id")
+    return members.merge(res, on="dup_cluster_id").drop(columns="dup_cluster_id")
+
 # -------------------- Load taxonomy --------------------
 with open(TAX_PATH, "r", encoding="utf-8") as f:
     tax = json.load(f)
@@ -46,43 +79,42 @@ categories = [c["name"] if isinstance(c, dict) else c for c in tax.get("categori
 print("Categories:", categories)
 
 # -------------------- Load model --------------------
-print("\nLoading zero-shot classification model (facebook/bart-large-mnli)...")
-classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli", device=-1)  # runs on CPU
-print("Model loaded — starting inference...\n")
+print(f"\nLoading zero-shot classification model ({MODEL_NAME})...")
+engine = ZeroShotEngine(MODEL_NAME, device="cpu", backend=BACKEND, onnx_root=ONNX_DIR)  # runs on CPU
+print(f"Model loaded ({BACKEND}) — starting inference...\n")
 
 # -------------------- Run classification --------------------
-rows = []
+# Append-only checkpoint: emails already in a shard (from an interrupted run) are skipped
+ckpt = ShardCheckpoint(OUT_PARQ, "email_id", settings={"model": MODEL_NAME, "labels": categories,
+                                                       "backend": BACKEND})
+todo = df[~df["email_id"].isin(ckpt.done_ids())]
+
+n_done = 0
 start = time.time()
-total = len(df)
-
-for i, (_, row) in enumerate(tqdm(df.iterrows(), total=total, desc="Processing emails")):
-    text = row["__text__"]
-    email_id = row["email_id"]
-
-    try:
-        res = classifier(text, candidate_labels=categories, multi_label=False)
-        label = res["labels"][0]
-        score = round(float(res["scores"][0]), 4)
-    except Exception as e:
-        label, score = None, 0.0
-        print(f"⚠️ {email_id}: {e}")
-
-    rows.append({
-        "email_id": email_id,
-        "risk_label_zeroshot": label,
-        "model_confidence": score
-    })
-
-    # Quick progress checkpoints (5%, 50%, 100%)
-    pct = int(((i + 1) / total) * 100)
-    if pct in [5, 50, 100]:
-        print(f"{pct}% done ({i+1}/{total})")
-        pd.DataFrame(rows).to_parquet(OUT_PARQ, index=False)
-        pd.DataFrame(rows).to_csv(OUT_CSV, index=False)
+total = len(todo)
+email_ids = todo["email_id"].tolist()
+
+# Content-hash result cache: texts already classified with this model + label set are not re-run
+cache = InferenceCache(CACHE_PATH)
+scope = cache.scope(MODEL_NAME, model_revision(engine.model), labels=categories, max_len=engine.max_len)
+
+with tqdm(total=total, desc="Processing emails", unit="email") as bar:
+    for lo, labels, scores in engine.iter_classify(todo["__text__"].tolist(), categories, cache=scope):
+        ckpt.append(pd.DataFrame({
+            "email_id": email_ids[lo:lo + len(labels)],
+            "risk_label_zeroshot": labels,
+            "model_confidence": scores
+        }))
+        n_done += len(labels)
+        bar.update(len(labels))
+        bar.set_postfix(rows_s=f"{engine.rows_per_s:.1f}")
+        print(f"{int(n_done / total * 100)}% done ({n_done}/{total}, {engine.rows_per_s:.1f} rows/s)")
 
 # -------------------- Final save --------------------
-pd.DataFrame(rows).to_parquet(OUT_PARQ, index=False)
-pd.DataFrame(rows).to_csv(OUT_CSV, index=False)
+out_df = ckpt.compact(order=df["email_id"], transform=expand_clusters, out_csv=OUT_CSV)
 
-print(f"\nProcessed {len(rows)} flagged emails in {round(time.time() - start, 2)} seconds.")
+elapsed = time.time() - start
+print(f"\nProcessed {n_done} flagged emails (saved {len(out_df)} rows) in {round(elapsed, 2)} seconds "
+      f"({n_done / max(elapsed, 1e-9):.1f} rows/s).")
+print(cache.report())
 print(f"Outputs saved to:\n  {OUT_PARQ}\n  {OUT_CSV}")
@@ -0,0 +1,127 @@
+# risk_zeroshot_engine.py
+# Batched zero-shot (NLI) risk classification for risk_zeroshot.py / risk_zeroshot_thread.py.
+# The transformers zero-shot pipeline, called once per document, runs one small forward pass per
+# document (its len(categories) premise/hypothesis pairs, padded to the longest). Here:
+#   - all premise/hypothesis pairs of a window of documents are tokenized in one batched call,
+#     truncated as the pipeline does (only_first, to the model's max length), unpadded;
+#   - the pairs are then sorted by length and cut into batches under a
+#     padded-token budget, so each batch is padded only to its own longest pair (dynamic
+#     padding) and pairs of different documents share a forward pass;
+#   - the entailment logits are gathered back per document and soft-maxed across the labels,
+#     giving the pipeline's top label and score (multi_label=False).
+#
+#   engine = ZeroShotEngine("facebook/bart-large-mnli", device="cpu")
+#   for lo, labels, scores in engine.iter_classify(texts, categories):
+#       ...   # top label / confidence of texts[lo:lo + len(labels)]
+#
+# iter_classify(..., cache=scope) serves repeated texts from an inference_cache.CacheScope and
+# runs the model on the misses only. backend="onnx" runs the int8-quantised ONNX export through
+# ONNX Runtime on CPU instead (emails/nlp/onnx_backend.py, which must be importable).
+
+import time
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+MODEL_NAME       = "facebook/bart-large-mnli"
+HYPOTHESIS       = "This example is {}."   # the pipeline's default hypothesis_template
+MAX_BATCH_TOKENS = 16_384                  # padded tokens per forward pass
+MAX_BATCH_PAIRS  = 64
+SORT_WINDOW      = 2_048                   # documents whose pairs are length-sorted together
+
+def make_batches(lengths, max_tokens: int = MAX_BATCH_TOKENS, max_pairs: int = MAX_BATCH_PAIRS) -> list:
+    """Pair indices sorted by length, cut so that len(batch) * longest <= max_tokens."""
+    batches, cur = [], []
+    for i in np.argsort(lengths, kind="stable"):
+        if cur and ((len(cur) + 1) * lengths[i] > max_tokens or len(cur) >= max_pairs):
+            batches.append(cur)
+            cur = []
+        cur.append(int(i))
+    if cur:
+        batches.append(cur)
+    return batches
+
+class ZeroShotEngine:
+    """NLI model + tokenizer with the zero-shot pipeline's scoring, batched across documents."""
+
+    def __init__(self, model_name: str = MODEL_NAME, device: str = "cpu",
+                 max_tokens: int = MAX_BATCH_TOKENS, max_pairs: int = MAX_BATCH_PAIRS,
+                 backend: str = "torch", onnx_root=None):
+        if backend == "onnx":
+            from onnx_backend import load_onnx, ONNX_ROOT
+            self.tokenizer, self.model = load_onnx(model_name, onnx_root or ONNX_ROOT)
+        elif backend == "torch":
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        else:
+            raise ValueError(f"unknown backend {backend!r} (torch or onnx)")
+        self.model = self.model.to(device).eval()
+        self.device = device
+        self.max_tokens, self.max_pairs = max_tokens, max_pairs
+        # same lookup as ZeroShotClassificationPipeline.entailment_id; contradiction is index 0
+        self.entail_id = next((i for l, i in self.model.config.label2id.items()
+                               if l.lower().startswith("entail")), -1)
+        self.max_len = self.tokenizer.model_max_length
+        n_pos = getattr(self.model.config, "max_position_embeddings", None)
+        if n_pos and self.max_len > n_pos:
+            self.max_len = n_pos
+        self.rows_per_s = 0.0
+
+    def _pairs(self, texts: list, labels: list) -> list:
+        """Model inputs for every (text, label) pair, text-major (pair k = text k // n, label k % n)."""
+        hyps = [HYPOTHESIS.format(l) for l in labels]
+        enc = self.tokenizer([t for t in texts for _ in hyps], hyps * len(texts),
+                             truncation="only_first", max_length=self.max_len)
+        return [dict(zip(enc.keys(), f)) for f in zip(*enc.values())]
+
+    @torch.inference_mode()
+    def _logits(self, pairs: list) -> np.ndarray:
+        """(n_pairs, 2) [contradiction, entailment] logits, NaN for pairs of a failed batch."""
+        out = np.full((len(pairs), 2), np.nan, dtype=np.float32)
+        lengths = np.array([len(f["input_ids"]) for f in pairs])
+        for batch in make_batches(lengths, self.max_tokens, self.max_pairs):
+            try:
+                enc = self.tokenizer.pad([pairs[i] for i in batch], return_tensors="pt")
+                logits = self.model(**{k: v.to(self.device) for k, v in enc.items()}).logits
+                out[batch] = logits[:, [0, self.entail_id]].float().cpu().numpy()
+            except Exception as e:
+                print(f"⚠️ batch of {len(batch)} pairs failed: {e}")
+        return out
+
+    def classify(self, texts: list, labels: list):
+        """-> (top label, rounded score) per text; (None, 0.0) for empty texts (the pipeline
+        rejects them) and where inference failed."""
+        keep = [i for i, t in enumerate(texts) if t]
+        n = len(labels)
+        logits = np.full((len(texts), n, 2), np.nan, dtype=np.float32)
+        if keep:
+            logits[keep] = self._logits(self._pairs([texts[i] for i in keep], labels)).reshape(len(keep), n, 2)
+        if n == 1:      # single label: entailment vs contradiction, as the pipeline does
+            e = np.exp(logits)
+            scores = e[..., 1] / e.sum(-1)
+        else:
+            e = np.exp(logits[..., 1])
+            scores = e / e.sum(-1, keepdims=True)
+        top_label, top_score = [], []
+        for s in scores:
+            if np.isnan(s).any():
+                top_label.append(None)
+                top_score.append(0.0)
+                continue
+            j = s.argsort()[::-1][0]                     # the pipeline's ordering of ties
+            top_label.append(labels[j])
+            top_score.append(round(float(s[j]), 4))
+        return top_label, top_score
+
+    def iter_classify(self, texts: list, labels: list, window: int = SORT_WINDOW, cache=None):
+        """Yields (start, labels, scores) window by window; rows_per_s is kept up to date.
+        cache: a CacheScope for (this model, labels, max_len); only its misses are inferred."""
+        t0, done = time.perf_counter(), 0
+        for lo in range(0, len(texts), window):
+            if cache is None:
+                top_label, top_score = self.classify(texts[lo:lo + window], labels)
+            else:
+                top_label, top_score = cache.lookup(texts[lo:lo + window], lambda miss: self.classify(miss, labels))
+            done += len(top_label)
+            self.rows_per_s = done / max(time.perf_counter() - t0, 1e-9)
+            yield lo, top_label, top_score
@@ -2,8 +2,19 @@
 """
 Zero-Shot Risk Classification (Threads Only - Flagged)
 Runs facebook/bart-large-mnli on threads already flagged by the hybrid model.
+Batched: premise/hypothesis pairs of many threads are length-sorted and run together
+(risk_zeroshot_engine.py) — same labels and confidences as the per-thread pipeline calls.
+Finished windows are appended as shards (risk_outputs/RiskScores_zeroshot_threads.parts/), a
+rerun resumes after the threads already done, and the shards are compacted into the outputs
+below at the end (emails/nlp/inference_checkpoint.py).
+Results are cached by content hash in risk_outputs/InferenceCache.sqlite (emails/nlp/inference_cache.py);
+hit rate and time saved are printed at the end.
+BACKEND = "onnx" runs an int8-quantised ONNX export of the model through ONNX Runtime on CPU
+(emails/nlp/onnx_backend.py; exported to risk_outputs/onnx_models/ on first use).
 Inputs:
-    ThreadText.parquet
+    ThreadText.parquet         (with body_concat), or else
+    ThreadEmails.parquet       (thread builders' output) + Emails_clean_9902.parquet: the flagged
+                               threads' text is rendered from the email bodies (thread_text.py)
     RiskTaxonomy.json
     risk_outputs/RiskScores_threads.parquet   (flagged threads only)
 Outputs:
@@ -11,36 +22,60 @@ Outputs:
     risk_outputs/RiskScores_zeroshot_threads.csv
 """
 
-import pandas as pd, json, time
+import sys, pandas as pd, json, time
+import pyarrow.parquet as pq
 from pathlib import Path
+import torch
 from tqdm import tqdm
-from transformers import pipeline
+
+from risk_zeroshot_engine import ZeroShotEngine, MODEL_NAME
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from inference_checkpoint import ShardCheckpoint
+from inference_cache import InferenceCache, model_revision
+sys.path.append(str(Path(__file__).resolve().parents[2] / "data_prep" / "threads"))
+from thread_text import ThreadTextView
 
 # -------------------- Paths --------------------
 BASE_DIR = Path("/content/drive/MyDrive/maildir")
 THREAD_PATH = BASE_DIR / "ThreadText.parquet"
+THREAD_EMAILS_PATH = BASE_DIR / "ThreadEmails.parquet"
+EMAILS_PATH = BASE_DIR / "Emails_clean_9902.parquet"    # bodies for the thread text (its BodyStore if built)
 TAX_PATH = BASE_DIR / "RiskTaxonomy.json"
 HYBRID_PATH = BASE_DIR / "risk_outputs" / "RiskScores_threads.parquet"
 
 OUT_PARQ = BASE_DIR / "risk_outputs" / "RiskScores_zeroshot_threads.parquet"
 OUT_CSV  = BASE_DIR / "risk_outputs" / "RiskScores_zeroshot_threads.csv"
+CACHE_PATH = BASE_DIR / "risk_outputs" / "InferenceCache.sqlite"   # shared by the email and thread runs
+ONNX_DIR   = BASE_DIR / "risk_outputs" / "onnx_models"
+
+BACKEND = "torch"    # "onnx": int8-quantised ONNX Runtime on CPU (no GPU needed)
 OUT_PARQ.parent.mkdir(parents=True, exist_ok=True)
 
 # -------------------- Load data --------------------
 print("\nLoading thread data and flagged hybrid results...")
 
-threads_df = pd.read_parquet(THREAD_PATH)
 hybrid_df = pd.read_parquet(HYBRID_PATH)
 
 # Keep only threads that had hits_total > 0
-flagged_ids = set(hybrid_df.loc[hybrid_df["hits_total"] > 0, "thread_id"])
-df = threads_df[threads_df["thread_id"].isin(flagged_ids)].copy()
+flagged_ids = hybrid_df.loc[hybrid_df["hits_total"] > 0, "thread_id"].tolist()
+
+# Thread text: ThreadText's body_concat if it still has one, else rendered for the flagged
+# threads from ThreadEmails + the email bodies
+if THREAD_PATH.exists() and "body_concat" in pq.read_schema(THREAD_PATH).names:
+    threads_df = pd.read_parquet(THREAD_PATH)
+    df = threads_df[threads_df["thread_id"].isin(set(flagged_ids))].copy()
+elif THREAD_EMAILS_PATH.exists():
+    view = ThreadTextView(THREAD_EMAILS_PATH, input_path=EMAILS_PATH)
+    df = pd.concat(list(view.iter_batches(flagged_ids)) or [pd.DataFrame(columns=["thread_id", "body_concat"])],
+                   ignore_index=True)
+else:
+    raise SystemExit(f"{THREAD_PATH} has no body_concat: upload {THREAD_EMAILS_PATH.name}, or write one with "
+                     "emails/data_prep/threads/thread_text.py --out")
 print(f"Loaded {len(df)} flagged threads for zero-shot classification.")
 
 # Combine subject and body text for inference
-subj = df["subject_norm"] if "subject_norm" in df.columns else ""
-body = df["body_concat"] if "body_concat" in df.columns else ""
-df["__text__"] = (subj.fillna("") + " " + body.fillna("")).str.strip()
+subj = df["subject_norm"].fillna("") if "subject_norm" in df.columns else ""
+df["__text__"] = (subj + " " + df["body_concat"].fillna("")).str.strip()
 
 # -------------------- Load taxonomy --------------------
 with open(TAX_PATH, "r", encoding="utf-8") as f:
@@ -56,48 +91,47 @@ for c in tax.get("categories", []):
 print("Categories:", categories)
 
 # -------------------- Load model --------------------
-print("\nLoading zero-shot classification model (facebook/bart-large-mnli)...")
-classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
-device = classifier.device
+print(f"\nLoading zero-shot classification model ({MODEL_NAME})...")
+device = "cuda" if torch.cuda.is_available() and BACKEND == "torch" else "cpu"
+engine = ZeroShotEngine(MODEL_NAME, device=device, backend=BACKEND, onnx_root=ONNX_DIR)
 print(f"Model loaded on {device} — starting inference...\n")
 
 # -------------------- Run classification --------------------
-rows, start = [], time.time()
-total = len(df)
+# Append-only checkpoint: threads already in a shard (from an interrupted run) are skipped
+ckpt = ShardCheckpoint(OUT_PARQ, "thread_id", settings={"model": MODEL_NAME, "labels": categories,
+                                                        "backend": BACKEND})
+todo = df[~df["thread_id"].isin(ckpt.done_ids())]
+
+n_done, start = 0, time.time()
+total = len(todo)
 
 print("Columns in df right before inference:", list(df.columns)[:10])
 print("First few rows:")
 print(df.head(3)[["thread_id", "__text__"]].to_string())
 
-for i, (_, row) in enumerate(tqdm(df.iterrows(), total=total, desc="Processing threads")):
-    text = row["__text__"]
-    thread_id = row["thread_id"]
-
-    try:
-        res = classifier(text, candidate_labels=categories, multi_label=False)
-        label = res["labels"][0]
-        score = round(float(res["scores"][0]), 4)
-    except Exception as e:
-        label, score = None, 0.0
-        print(f"Error on {thread_id}: {e}")
-
-    rows.append({
-        "thread_id": thread_id,
-        "risk_label_zeroshot": label,
-        "model_confidence": score
-    })
-
-    # Save progress periodically
-    if (i + 1) % 100 == 0:
-        pd.DataFrame(rows).to_parquet(OUT_PARQ, index=False)
-        pd.DataFrame(rows).to_csv(OUT_CSV, index=False)
-        percent = ((i + 1) / total) * 100
-        if int(percent) % 10 == 0:
-            print(f"{int(percent)}% done ({i+1}/{total})")
+thread_ids = todo["thread_id"].tolist()
+
+# Content-hash result cache: texts already classified with this model + label set are not re-run
+cache = InferenceCache(CACHE_PATH)
+scope = cache.scope(MODEL_NAME, model_revision(engine.model), labels=categories, max_len=engine.max_len)
+
+with tqdm(total=total, desc="Processing threads", unit="thread") as bar:
+    for lo, labels, scores in engine.iter_classify(todo["__text__"].tolist(), categories, cache=scope):
+        ckpt.append(pd.DataFrame({
+            "thread_id": thread_ids[lo:lo + len(labels)],
+            "risk_label_zeroshot": labels,
+            "model_confidence": scores
+        }))
+        n_done += len(labels)
+        bar.update(len(labels))
+        bar.set_postfix(rows_s=f"{engine.rows_per_s:.1f}")
+        print(f"{int(n_done / total * 100)}% done ({n_done}/{total}, {engine.rows_per_s:.1f} rows/s)")
 
 # -------------------- Final save --------------------
-pd.DataFrame(rows).to_parquet(OUT_PARQ, index=False)
-pd.DataFrame(rows).to_csv(OUT_CSV, index=False)
+out_df = ckpt.compact(order=df["thread_id"], out_csv=OUT_CSV)
 
-print(f"\nProcessed {len(rows)} threads in {round(time.time() - start, 2)} seconds.")
+elapsed = time.time() - start
+print(f"\nProcessed {n_done} threads (saved {len(out_df)} rows) in {round(elapsed, 2)} seconds "
+      f"({n_done / max(elapsed, 1e-9):.1f} rows/s).")
+print(cache.report())
 print(f"Outputs saved to:\n  {OUT_PARQ}\n  {OUT_CSV}")
@@ -2,11 +2,19 @@
 # Two outputs, both models
 # 1) EmailScores_both.parquet   (email_id + real email text)
 # 2) ThreadScores_both.parquet  (thread_id + concatenated thread text)
+# Finished batches are appended as shards (EmailScores_both.parts/, ThreadScores_both.parts/,
+# see emails/nlp/inference_checkpoint.py): re-running after a disconnect skips the ids already
+# scored, and the shards are compacted into the two outputs at the end.
+# Both models' results are cached by content hash in InferenceCache.sqlite
+# (emails/nlp/inference_cache.py): a text scored before is not run again (hit rates and time
+# saved are printed at the end). Keep the file next to the parquets between sessions.
+# BACKEND = "onnx" runs both models as int8-quantised ONNX exports through ONNX Runtime on CPU
+# (emails/nlp/onnx_backend.py; exported to onnx_models/ on first use) -- for runtimes without a GPU.
 # ==========================
 
-!pip -q install pandas pyarrow tqdm transformers torch
+!pip -q install pandas pyarrow tqdm transformers torch onnx onnxruntime
 
-import os, time, re
+import os, sys, time, re
 import pandas as pd
 import pyarrow.parquet as pq
 import torch, torch.nn.functional as F
@@ -26,17 +34,37 @@ MAXLEN_EMAIL  = 128
 MAXLEN_THREAD = 256
 LIMIT = None                  
 
-# Upload if missing
-need_upload = not (os.path.exists("TextBase.parquet") and os.path.exists("ThreadText.parquet"))
+# Backend: "torch" (GPU if available) or "onnx" (int8-quantised ONNX Runtime, CPU)
+BACKEND = "torch"
+
+# Upload if missing (body_clean.py is the shared cleaner from emails/data_prep,
+# inference_checkpoint.py / inference_cache.py the checkpoint and result cache from emails/nlp)
+sys.path.append("emails/data_prep")
+sys.path.append("emails/nlp")
+need_upload = not (os.path.exists("TextBase.parquet")
+                   and (os.path.exists("ThreadText.parquet") or os.path.exists("ThreadEmails.parquet"))
+                   and (os.path.exists("body_clean.py") or os.path.exists("emails/data_prep/body_clean.py"))
+                   and (os.path.exists("inference_checkpoint.py") or os.path.exists("emails/nlp/inference_checkpoint.py"))
+                   and (os.path.exists("inference_cache.py") or os.path.exists("emails/nlp/inference_cache.py"))
+                   and (BACKEND != "onnx" or os.path.exists("onnx_backend.py")
+                        or os.path.exists("emails/nlp/onnx_backend.py")))
 if need_upload:
-    print("Please upload TextBase.parquet and ThreadText.parquet …")
+    print("Please upload TextBase.parquet, ThreadEmails.parquet (or a per-email ThreadText.parquet), "
+          "body_clean.py, inference_checkpoint.py, inference_cache.py (and onnx_backend.py for BACKEND = 'onnx') …")
     files.upload()
+from body_clean import clean_join_batch
+from inference_checkpoint import ShardCheckpoint
+from inference_cache import InferenceCache, model_revision
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
+device = "cuda" if torch.cuda.is_available() and BACKEND == "torch" else "cpu"
 
 def load_pipe(model_name):
-    tok = AutoTokenizer.from_pretrained(model_name, use_fast=True)
-    mdl = AutoModelForSequenceClassification.from_pretrained(model_name).to(device)
+    if BACKEND == "onnx":
+        from onnx_backend import load_onnx
+        tok, mdl = load_onnx(model_name)
+    else:
+        tok = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        mdl = AutoModelForSequenceClassification.from_pretrained(model_name).to(device)
     id2label = getattr(mdl.config, "id2label", {})
     return tok, mdl, id2label
 
@@ -60,36 +88,47 @@ def _softmax_top(logits, id2label):
     return labels, conf
 
 @torch.inference_mode()
-def _score_texts(texts, tok, mdl, max_len):
+def _infer_texts(texts, tok, mdl, max_len):
     enc = tok(texts, truncation=True, padding="max_length", max_length=max_len, return_tensors="pt")
     enc = {k: v.to(device, non_blocking=True) for k, v in enc.items()}
     logits = mdl(**enc).logits
     labels, conf = _softmax_top(logits, getattr(mdl.config, "id2label", {}))
     return labels, conf.tolist()
 
+# Content-hash result cache: one scope per (model, max_len), only misses reach the model
+CACHE = InferenceCache("InferenceCache.sqlite")
+_cache_scopes = {}
+
+def _score_texts(texts, tok, mdl, max_len):
+    key = (id(mdl), max_len)
+    if key not in _cache_scopes:
+        id2label = getattr(mdl.config, "id2label", {})
+        _cache_scopes[key] = CACHE.scope(mdl.config._name_or_path, model_revision(mdl),
+                                         labels=[id2label[i] for i in sorted(id2label)], max_len=max_len)
+    return _cache_scopes[key].lookup(texts, lambda miss: _infer_texts(miss, tok, mdl, max_len))
+
 def _token_lengths(texts, tok, max_len):
     return tok(texts, truncation=True, max_length=max_len, return_length=True, padding=False)["length"]
 
-def _clean_join(a, b=None):
-    if b is None or b == "":
-        t = str(a)
-    else:
-        t = f"{a}. {b}"
-    return re.sub(r"\s+", " ", str(t)).strip()
-
-def _iter_parquet(path, id_col, text_cols, max_rows=None):
+def _iter_parquet(path, id_col, text_cols, max_rows=None, keep_ids=None, skip_ids=None):
     pf = pq.ParquetFile(path)
     remaining = pf.metadata.num_rows if max_rows is None else min(pf.metadata.num_rows, max_rows)
     seen = 0
     for batch in pf.iter_batches(batch_size=BATCH_SIZE, columns=[id_col] + text_cols):
         df = batch.to_pandas()
+        if keep_ids is not None:
+            df = df[df[id_col].isin(keep_ids)]
+        if skip_ids:
+            df = df[~df[id_col].isin(skip_ids)]
+        if df.empty:
+            continue
         df[text_cols] = df[text_cols].fillna("")
-        texts = [_clean_join(row[text_cols[0]], row[text_cols[1]] if len(text_cols) > 1 else "")
-                 for _, row in df.iterrows()]
+        texts = clean_join_batch(df[text_cols[0]], df[text_cols[1]] if len(text_cols) > 1 else None).to_pylist()
         ids = df[id_col].tolist()
         if max_rows is not None and seen + len(ids) > max_rows:
             cut = max_rows - seen
-            yield ids[:cut], texts[:cut]
+            if cut > 0:
+                yield ids[:cut], texts[:cut]
             break
         else:
             yield ids, texts
@@ -103,8 +142,24 @@ def score_emails():
     subj_col, body_col = _pick_text_cols("TextBase.parquet")
     text_cols = [c for c in [subj_col, body_col] if c is not None]
 
-    rows, seen, t0 = [], 0, time.time()
-    for ids, texts in _iter_parquet("TextBase.parquet", "email_id", text_cols, max_rows=LIMIT):
+    # Near-duplicate clusters (dup_cluster_id from preprocess.py): score one email per cluster
+    members, keep_ids = None, None
+    if "dup_cluster_id" in pq.ParquetFile("TextBase.parquet").schema.names:
+        members = pd.read_parquet("TextBase.parquet", columns=["email_id", "dup_cluster_id"])
+        reps = members.drop_duplicates("dup_cluster_id")
+        keep_ids = set(reps["email_id"])
+        print(f"Scoring {len(keep_ids):,} cluster representatives for {len(members):,} emails")
+
+    # Resume: emails already in a shard are skipped
+    ckpt = ShardCheckpoint("EmailScores_both.parquet", "email_id",
+                           settings={"sentiment_model": SENTIMENT_MODEL, "emotion_model": EMOTION_MODEL,
+                                     "max_len": MAXLEN_EMAIL, "backend": BACKEND})
+    done_ids = ckpt.done_ids()
+
+    seen, t0 = 0, time.time()
+    max_rows = None if LIMIT is None else max(LIMIT - len(done_ids), 0)
+    for ids, texts in _iter_parquet("TextBase.parquet", "email_id", text_cols, max_rows=max_rows,
+                                    keep_ids=keep_ids, skip_ids=done_ids):
         # sentiment
         s_labels, s_scores = _score_texts(texts, sent_tok, sent_mdl, MAXLEN_EMAIL)
         # emotion
@@ -112,6 +167,7 @@ def score_emails():
         # lengths
         lens = _token_lengths(texts, sent_tok, MAXLEN_EMAIL)
 
+        rows = []
         for pid, st, ss, et, es, L, txt in zip(ids, s_labels, s_scores, e_labels, e_scores, lens, texts):
             rows.append({
                 "email_id": pid,
@@ -124,37 +180,74 @@ def score_emails():
                 "sentiment_model": SENTIMENT_MODEL,
                 "emotion_model": EMOTION_MODEL,
             })
+        ckpt.append(pd.DataFrame(rows))
         seen += len(ids)
         rps = seen / max(time.time() - t0, 1e-6)
         print(f"Email   [{seen}] | {rps:.1f} rows/s")
 
-    df = pd.DataFrame(rows)
-    df.to_parquet("EmailScores_both.parquet", index=False)
+    def expand_clusters(df):
+        if members is None or df.empty:
+            return df
+        # copy each representative's scores to the rest of its cluster; email_text and
+        # text_len_tokens stay each email's own
+        own_cols = ["email_text", "text_len_tokens"]
+        res = reps.merge(df.drop(columns=own_cols), on="email_id").drop(columns="email_id")
+        out = members.merge(res, on="dup_cluster_id").drop(columns="dup_cluster_id")
+        own = [df.set_index("email_id")[own_cols]]
+        copies = set(out["email_id"]) - set(df["email_id"])
+        for ids, texts in _iter_parquet("TextBase.parquet", "email_id", text_cols, keep_ids=copies):
+            own.append(pd.DataFrame({"email_text": texts,
+                                     "text_len_tokens": _token_lengths(texts, sent_tok, MAXLEN_EMAIL)}, index=ids))
+        return out.join(pd.concat(own), on="email_id")[list(df.columns)]
+
+    df = ckpt.compact(transform=expand_clusters)
     print(f"Saved EmailScores_both.parquet with {len(df):,} rows")
     return df
 
 # 2) THREADS (concatenate messages per thread)
+def _thread_emails():
+    """One row per email of a thread (thread_id, subject_norm, body_clean) in date order: a per-email
+    ThreadText if uploaded, else ThreadEmails (the thread builders' output) joined to TextBase."""
+    per_email = {"subject_norm", "body_clean"}
+    if os.path.exists("ThreadText.parquet") and per_email <= set(pq.ParquetFile("ThreadText.parquet").schema.names):
+        tt = pd.read_parquet("ThreadText.parquet").fillna("")
+        return tt.sort_values(["thread_id","date"] if "date" in tt.columns else ["thread_id"])
+    if os.path.exists("ThreadEmails.parquet"):
+        te = pd.read_parquet("ThreadEmails.parquet", columns=["thread_id", "email_id", "pos"])
+        tb = pd.read_parquet("TextBase.parquet", columns=["email_id", "subject_norm", "body_clean"])
+        tt = te.merge(tb, on="email_id", how="left").fillna("")
+        return tt.sort_values(["thread_id", "pos"], kind="stable")
+    if os.path.exists("ThreadText.parquet"):
+        raise SystemExit("ThreadText.parquet has no per-email subject_norm/body_clean (the thread builders "
+                         "no longer store the text): upload ThreadEmails.parquet instead")
+    return None
+
 def score_threads():
-    if not os.path.exists("ThreadText.parquet"):
-        print("ThreadText.parquet not found, skipping threads")
+    tt = _thread_emails()
+    if tt is None:
+        print("ThreadText.parquet / ThreadEmails.parquet not found, skipping threads")
         return None
-    tt = pd.read_parquet("ThreadText.parquet").fillna("")
-    if "date" in tt.columns:
-        tt = tt.sort_values(["thread_id","date"])
-    else:
-        tt = tt.sort_values(["thread_id"])
 
     # Build one text per thread
     joined = (tt["subject_norm"].astype(str) + ". " + tt["body_clean"].astype(str)).str.replace(r"\s+"," ", regex=True)
     thread_text = tt.assign(_text=joined).groupby("thread_id")["_text"].agg(" [SEP] ".join).reset_index()
     thread_text = thread_text.rename(columns={"_text":"thread_text"})
 
+    # Resume: threads already in a shard are skipped
+    ckpt = ShardCheckpoint("ThreadScores_both.parquet", "thread_id",
+                           settings={"sentiment_model": SENTIMENT_MODEL, "emotion_model": EMOTION_MODEL,
+                                     "max_len": MAXLEN_THREAD, "backend": BACKEND})
+    done_ids = ckpt.done_ids()
+    if done_ids:
+        thread_text = thread_text[~thread_text["thread_id"].isin(done_ids)]
+
     # Score in chunks
     ids_all = thread_text["thread_id"].tolist()
     texts_all = thread_text["thread_text"].tolist()
+    limit = None if LIMIT is None else max(LIMIT - len(done_ids), 0)
 
-    rows, t0 = [], time.time()
-    for i in range(0, len(ids_all), BATCH_SIZE):
+    t0 = time.time()
+    for i in range(0, len(ids_all) if limit is None else min(len(ids_all), limit), BATCH_SIZE):
         ids = ids_all[i:i+BATCH_SIZE]
         texts = texts_all[i:i+BATCH_SIZE]
 
@@ -165,6 +258,7 @@ def score_threads():
         # lengths
         lens = _token_lengths(texts, sent_tok, MAXLEN_THREAD)
 
+        rows = []
         for pid, st, ss, et, es, L, txt in zip(ids, s_labels, s_scores, e_labels, e_scores, lens, texts):
             rows.append({
                 "thread_id": pid,
@@ -178,18 +272,18 @@ def score_threads():
                 "emotion_model": EMOTION_MODEL,
             })
 
+        if limit is not None:
+            rows = rows[:max(limit - i, 0)]
+        ckpt.append(pd.DataFrame(rows))
+
         done = min(i + BATCH_SIZE, len(ids_all))
         rps = done / max(time.time() - t0, 1e-6)
         print(f"Thread  [{done}/{len(ids_all)}] | {rps:.1f} rows/s")
 
-        if LIMIT is not None and done >= LIMIT:
-            rows = rows[:LIMIT]
-            break
-
-    df = pd.DataFrame(rows)
-    df.to_parquet("ThreadScores_both.parquet", index=False)
+    df = ckpt.compact()
     print(f"Saved ThreadScores_both.parquet with {len(df):,} rows")
     return df
 
 emails_df = score_emails()
 threads_df = score_threads()
+print(CACHE.report())
@@ -10,12 +10,16 @@ Reads TextBase.parquet and writes EmailSentiment.parquet with:
 
 import argparse
 import re
+import sys
 from pathlib import Path
 
 import pandas as pd
 from tqdm import tqdm
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
+sys.path.append(str(Path(__file__).resolve().parents[2] / "data_prep"))
+from body_clean import clean_email_text  # noqa: E402  (shared cleaner, same output as before)
+
 
 TEXT_CANDIDATES = [
     "body_clean", "body_norm", "body_text",
@@ -56,18 +60,6 @@ def simple_tokenise(s: str):
     return [t for t in re.split(r"[^A-Za-z0-9']+", s.lower()) if t]
 
 
-def clean_email_text(text: str) -> str:
-    if not isinstance(text, str):
-        text = "" if pd.isna(text) else str(text)
-
-    # Remove common quoted header lines and long footers
-    text = re.sub(r"-{2,}\s*original message\s*-{2,}.*", "", text,
-                  flags=re.I | re.S)
-    text = re.sub(r"from:.*?\n|\bsubject:.*?\n|\bdate:.*?\n|\bto:.*?\n",
-                  "", text, flags=re.I)
-    return text.strip()
-
-
 def main():
     parser = argparse.ArgumentParser(
         description="Sentiment Pipeline Prototype"
@@ -36,21 +36,24 @@ for year in FOLDERS:
                 .rename(columns={"a":"src_person_id","b":"dst_person_id","w":"weight"}))
         edges["directed"] = False
 
+    # Work on int person keys when the inputs carry them (see data_prep/person_index.py)
+    KEY = "person_key" if "person_key" in node_index.columns and "src_person_key" in edges.columns else "person_id"
+    SRC, DST = f"src_{KEY}", f"dst_{KEY}"
+
     if INTERNAL_ONLY:
-        keep = set(node_index.loc[node_index.internal, "person_id"])
-        edges = edges[edges["src_person_id"].isin(keep) & edges["dst_person_id"].isin(keep)]
+        keep = node_index.loc[node_index.internal, KEY].unique()
+        edges = edges[edges[SRC].isin(keep) & edges[DST].isin(keep)]
 
     edges["weight"] = edges["weight"].astype(float)
     edges = edges[edges["weight"] > MIN_EDGE_WEIGHT]
-    edges = edges[edges["src_person_id"] != edges["dst_person_id"]]  # no self-loops
-    edges = edges.dropna(subset=["src_person_id","dst_person_id","weight"])
+    edges = edges[edges[SRC] != edges[DST]]  # no self-loops
+    edges = edges.dropna(subset=[SRC,DST,"weight"])
     edges = edges.reset_index(drop=True)
 
     G = nx.Graph()
-    nodes = set(edges["src_person_id"]).union(set(edges["dst_person_id"]))
+    nodes = set(edges[SRC].tolist()).union(set(edges[DST].tolist()))
     G.add_nodes_from(nodes)
-    for r in edges.itertuples(index=False):
-        G.add_edge(r.src_person_id, r.dst_person_id, weight=float(r.weight))
+    G.add_weighted_edges_from(zip(edges[SRC].tolist(), edges[DST].tolist(), edges["weight"].tolist()))
 
     print(f"Graph: {G.number_of_nodes():,} nodes, {G.number_of_edges():,} edges")
 
@@ -71,9 +74,13 @@ for year in FOLDERS:
         algo_used = "greedy_modularity"
 
     comm_df = pd.DataFrame({
-        "person_id": list(partition.keys()),
+        KEY: list(partition.keys()),
         "community_id": list(partition.values())
     })
+    if KEY == "person_key":
+        # decode back to person_id strings for export, key kept alongside
+        ids = node_index.drop_duplicates("person_key").set_index("person_key")["person_id"]
+        comm_df.insert(0, "person_id", comm_df["person_key"].map(ids))
 
     sizes = comm_df.groupby("community_id").size().rename("community_size")
     comm_df = comm_df.merge(sizes, on="community_id", how="left")
@@ -3,97 +3,146 @@
 # ===============================================================
 
 from pathlib import Path
+import sys
 import pandas as pd
 import numpy as np
 import networkx as nx
 import re, ast
 
+sys.path.append(str(Path(__file__).resolve().parents[1] / "data_prep"))
+from person_index import load_person_index, extend_person_index, encode_lists, encode
+from emails_dataset import load_emails
+
 # Base folders
 BASE_DIR = Path("data")
 FOLDERS = ["all", "1999", "2000", "2001", "2002"]
-INPUT_CLEAN = Path("data/Emails_clean_9902.parquet")
+INPUT_CLEAN = None   # None: data/Emails_clean (year=/month= dataset) if present, else data/Emails_clean_9902.parquet
+# Only the metadata columns the graph needs; *_keys / person_key are skipped if the input predates them
+EMAIL_COLUMNS = ["email_id", "person_id", "dt_utc", "to_norm", "cc_norm", "bcc_norm",
+                 "person_key", "to_keys", "cc_keys", "bcc_keys"]
+PERSON_INDEX = Path("data/PersonIndex.parquet")      # written by preprocess.py; moves to data/ with Emails_clean
+
+# Helper to normalize recipient lists (only needed for files without the *_keys columns)
+def to_list_clean(x):
+    if x is None:
+        return []
+    if hasattr(x, "as_py"):
+        x = x.as_py()
+    if hasattr(x, "to_pylist"):
+        x = x.to_pylist()
+    if isinstance(x, (list, tuple, set)):
+        lst = list(x)
+    elif isinstance(x, np.ndarray):
+        lst = x.tolist()
+    elif isinstance(x, str):
+        s = x.strip()
+        if not s:
+            return []
+        if (s.startswith("[") and s.endswith("]")) or (s.startswith("(") and s.endswith(")")):
+            try:
+                v = ast.literal_eval(s)
+                lst = list(v) if isinstance(v, (list, tuple, set, np.ndarray)) else [str(v)]
+            except Exception:
+                lst = [p.strip() for p in re.split(r"[;,]", s) if p.strip()]
+        else:
+            lst = [p.strip() for p in re.split(r"[;,]", s) if p.strip()]
+    else:
+        if pd.isna(x):
+            return []
+        lst = [str(x).strip()]
+    return [str(v).strip().lower() for v in lst if str(v).strip()]
+
+def ensure_keys(emails, person_index):
+    """Adds person_key / to_keys / cc_keys / bcc_keys when the input predates them."""
+    if {"person_key", "to_keys", "cc_keys", "bcc_keys"} <= set(emails.columns):
+        return emails, person_index
+    import pyarrow as pa
+    lists = {}
+    for col in ["to_norm", "cc_norm", "bcc_norm"]:
+        if col not in emails.columns:
+            emails[col] = [[]] * len(emails)
+        lists[col] = pa.array(emails[col].apply(to_list_clean).tolist(), pa.list_(pa.string()))
+    senders = pa.array(emails["person_id"].fillna("").tolist(), pa.string())
+    person_index = extend_person_index(person_index, pa.concat_arrays([senders] + [l.flatten() for l in lists.values()]))
+    emails["person_key"] = encode(senders, person_index).to_numpy(zero_copy_only=False)
+    for col, arr in lists.items():
+        emails[col.replace("_norm", "_keys")] = encode_lists(arr, person_index).to_pandas().values
+    return emails, person_index
+
+def explode_keys(emails, cols):
+    """Flattens list<int> key columns -> (row position, key) arrays, in to+cc+bcc order per email."""
+    rows, keys = [], []
+    for col in cols:
+        lens = emails[col].map(len).to_numpy()
+        if lens.sum():
+            rows.append(np.repeat(np.arange(len(emails)), lens))
+            keys.append(np.concatenate([np.asarray(v) for v in emails[col].values if len(v)]))
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rows, keys = np.concatenate(rows), np.concatenate(keys).astype(np.int64)
+    order = np.argsort(rows, kind="stable")
+    return rows[order], keys[order]
+
+def check_keys(emails, person_index):
+    """Every person key in the emails must be a row of the index (else it is missing or older)."""
+    keys = np.concatenate([emails["person_key"].dropna().to_numpy(dtype=np.int64),
+                           explode_keys(emails, ["to_keys", "cc_keys", "bcc_keys"])[1]])
+    if len(keys) and keys.max() >= person_index.num_rows:
+        state = "missing" if not PERSON_INDEX.exists() else f"stale ({person_index.num_rows:,} people)"
+        raise SystemExit(f"{PERSON_INDEX} is {state}: the emails use person keys up to {keys.max():,}. "
+                         "Copy the PersonIndex.parquet preprocess.py wrote next to Emails_clean into data/.")
 
 for year in FOLDERS:
     OUT_DIR = Path("data") / str(year)
     OUT_DIR.mkdir(parents=True, exist_ok=True)
     print(f"Loading emails: {year}")
-    emails = pd.read_parquet(INPUT_CLEAN, engine="pyarrow", memory_map=False)
-    if(year != "all"):
-        emails = emails[emails["year"] == int(year)]
+    emails = load_emails(years=None if year == "all" else [int(year)], columns=EMAIL_COLUMNS, path=INPUT_CLEAN)
     print(f"Loaded {len(emails):,} emails")
 
-    # Helper to normalize recipient lists
-    def to_list_clean(x):
-        if x is None:
-            return []
-        if hasattr(x, "as_py"):
-            x = x.as_py()
-        if hasattr(x, "to_pylist"):
-            x = x.to_pylist()
-        if isinstance(x, (list, tuple, set)):
-            lst = list(x)
-        elif isinstance(x, np.ndarray):
-            lst = x.tolist()
-        elif isinstance(x, str):
-            s = x.strip()
-            if not s:
-                return []
-            if (s.startswith("[") and s.endswith("]")) or (s.startswith("(") and s.endswith(")")):
-                try:
-                    v = ast.literal_eval(s)
-                    lst = list(v) if isinstance(v, (list, tuple, set, np.ndarray)) else [str(v)]
-                except Exception:
-                    lst = [p.strip() for p in re.split(r"[;,]", s) if p.strip()]
-            else:
-                lst = [p.strip() for p in re.split(r"[;,]", s) if p.strip()]
-        else:
-            if pd.isna(x):
-                return []
-            lst = [str(x).strip()]
-        return [str(v).strip().lower() for v in lst if str(v).strip()]
+    # Everything below runs on int person keys; strings only come back at export (decode)
+    emails, person_index = ensure_keys(emails, load_person_index(PERSON_INDEX))
+    check_keys(emails, person_index)
+    ids = person_index["person_id"].to_numpy()
+    is_internal = np.char.endswith(ids.astype(str), "@enron.com") if len(ids) else np.zeros(0, bool)
+    str_rank = np.argsort(np.argsort(ids.astype(str), kind="stable"))   # keeps string ordering for a/b
+    decode = lambda k: ids[np.asarray(k, dtype=np.int64)]
 
-    # Normalize recipient columns
-    for col in ["to_norm", "cc_norm", "bcc_norm"]:
-        if col not in emails.columns:
-            emails[col] = [[]] * len(emails)
-        emails[col] = emails[col].apply(to_list_clean)
-
-    # Compute year & filter to internal Enron emails 
+    # Compute year & filter to internal Enron emails
     emails["dt_utc"] = pd.to_datetime(emails["dt_utc"], errors="coerce")
     emails["year"] = emails["dt_utc"].dt.year
-    emails = emails[emails["person_id"].str.endswith("@enron.com", na=False)].copy()
+    sender = emails["person_key"].fillna(-1).to_numpy().astype(np.int64)
+    emails = emails[(sender >= 0) & is_internal[np.maximum(sender, 0)]].copy()
+    emails["person_key"] = emails["person_key"].astype(np.int64)
     print(f"Filtered to {len(emails):,} internal sender emails")
 
     # Recipient explosion
     emails["recipient_count"] = (
-        emails["to_norm"].str.len()
-        + emails["cc_norm"].str.len()
-        + emails["bcc_norm"].str.len()
+        emails["to_keys"].map(len)
+        + emails["cc_keys"].map(len)
+        + emails["bcc_keys"].map(len)
     ).astype("int32")
 
-    edges = emails[["email_id", "person_id", "dt_utc", "year", "recipient_count"]].copy()
-    edges["recipient"] = emails["to_norm"] + emails["cc_norm"] + emails["bcc_norm"]
-    edges = edges.explode("recipient", ignore_index=True)
-    edges = edges.rename(columns={"person_id": "src_person_id", "recipient": "dst_person_id"})
-
-    # Drop empty or self-loops
-    edges["dst_person_id"] = edges["dst_person_id"].astype(str).str.lower()
-    edges = edges.dropna(subset=["dst_person_id"])
-    edges = edges[edges["dst_person_id"].str.len() > 0]
-    edges = edges[edges["src_person_id"] != edges["dst_person_id"]]
-
-    # Filter destination to internal Enron as well
-
-    edges = edges[edges["dst_person_id"].str.endswith("@enron.com", na=False)]
+    pos, dst = explode_keys(emails, ["to_keys", "cc_keys", "bcc_keys"])
+    edges = pd.DataFrame({
+        "email_id": emails["email_id"].to_numpy()[pos],
+        "src_key": emails["person_key"].to_numpy()[pos],
+        "dst_key": dst,
+        "dt_utc": emails["dt_utc"].array.take(pos),
+        "year": emails["year"].to_numpy()[pos],
+        "recipient_count": emails["recipient_count"].to_numpy()[pos],
+    })
+
+    # Drop self-loops and keep internal Enron destinations only
+    edges = edges[(edges["src_key"] != edges["dst_key"]) & is_internal[edges["dst_key"].to_numpy()]]
     print(f"Remaining internal edges: {len(edges):,}")
 
     # Weight edges
     edges["weight_unit"] = 1.0
     edges["weight_mass"] = 1.0 / (1.0 + edges["recipient_count"].fillna(0).astype(float))
 
-    # Temporal aggregation per directed pair 
+    # Temporal aggregation per directed pair
     edges_agg = (
-        edges.groupby(["src_person_id", "dst_person_id"])
+        edges.groupby(["src_key", "dst_key"])
             .agg(
                 weight=("weight_unit", "sum"),
                 first_date=("dt_utc", "min"),
@@ -105,85 +154,94 @@ for year in FOLDERS:
     edges_agg["directed"] = True
 
 
-    # Reciprocal (active two-way actors only) -- Ensuring A <-> B 
+    # Reciprocal (active two-way actors only) -- Ensuring A <-> B
     print(f"Before reciprocity filter: {len(edges_agg):,} directed pairs")
 
-    pairs = set(zip(edges_agg["src_person_id"], edges_agg["dst_person_id"]))
-    rev_pairs = set(zip(edges_agg["dst_person_id"], edges_agg["src_person_id"]))
-    mutual_pairs = pairs & rev_pairs
+    n_keys = np.int64(max(len(ids), 1))
+    pair_code = edges_agg["src_key"].to_numpy(np.int64) * n_keys + edges_agg["dst_key"].to_numpy(np.int64)
+    rev_code  = edges_agg["dst_key"].to_numpy(np.int64) * n_keys + edges_agg["src_key"].to_numpy(np.int64)
+    mutual_codes = pair_code[np.isin(pair_code, rev_code)]
 
-    edges_agg = edges_agg[edges_agg.apply(
-        lambda r: (r["src_person_id"], r["dst_person_id"]) in mutual_pairs, axis=1
-    )].copy()
+    edges_agg = edges_agg[np.isin(pair_code, mutual_codes)].copy()
 
     print(f"After reciprocity filter: {len(edges_agg):,} directed pairs (mutual only)")
 
-    active_nodes = set(edges_agg["src_person_id"]) | set(edges_agg["dst_person_id"])
+    active_nodes = np.union1d(edges_agg["src_key"].to_numpy(), edges_agg["dst_key"].to_numpy())
     edges_agg = edges_agg[
-        edges_agg["src_person_id"].isin(active_nodes)
-        & edges_agg["dst_person_id"].isin(active_nodes)
+        edges_agg["src_key"].isin(active_nodes)
+        & edges_agg["dst_key"].isin(active_nodes)
     ]
     print(f"After stricter filter: {len(edges_agg):,} directed pairs (mutual only)")
     print(f"Filtering raw edges to reciprocal pairs...")
-    edges = edges[
-        edges.apply(lambda r: (r["src_person_id"], r["dst_person_id"]) in mutual_pairs, axis=1)
-    ].copy()
+    raw_code = edges["src_key"].to_numpy(np.int64) * n_keys + edges["dst_key"].to_numpy(np.int64)
+    edges = edges[np.isin(raw_code, mutual_codes)].copy()
     print(f"Remaining raw reciprocal edges: {len(edges):,}")
 
 
 
     # Save detailed edge list (each message)
-    edges_out = edges[["email_id", "src_person_id", "dst_person_id", "dt_utc", "year"]].copy()
-    edges_out["weight"] = edges["weight_unit"].astype("float32")
+    edges_out = pd.DataFrame({
+        "email_id": edges["email_id"].to_numpy(),
+        "src_person_id": decode(edges["src_key"]),
+        "dst_person_id": decode(edges["dst_key"]),
+        "dt_utc": edges["dt_utc"].array,
+        "year": edges["year"].to_numpy(),
+    })
+    edges_out["weight"] = edges["weight_unit"].to_numpy().astype("float32")
     edges_out["directed"] = True
+    edges_out["src_person_key"] = edges["src_key"].to_numpy().astype("int32")
+    edges_out["dst_person_key"] = edges["dst_key"].to_numpy().astype("int32")
     edges_out.to_parquet(OUT_DIR / "Edges_internal.parquet", index=False)
 
     print(f"Saved detailed edges: {len(edges_out):,}")
     print(f"Aggregated edges: {len(edges_agg):,}")
 
-    # Build undirected aggregation (for clustering) 
-    u = edges[["src_person_id", "dst_person_id", "weight_mass"]].copy()
-    u["a"] = np.where(u["src_person_id"] < u["dst_person_id"], u["src_person_id"], u["dst_person_id"])
-    u["b"] = np.where(u["src_person_id"] < u["dst_person_id"], u["dst_person_id"], u["src_person_id"])
+    # Build undirected aggregation (for clustering)
+    u = edges[["src_key", "dst_key", "weight_mass"]].copy()
+    src_first = str_rank[u["src_key"].to_numpy()] < str_rank[u["dst_key"].to_numpy()]
+    u["a"] = np.where(src_first, u["src_key"], u["dst_key"])
+    u["b"] = np.where(src_first, u["dst_key"], u["src_key"])
     edges_undir = (
         u.groupby(["a", "b"])
         .agg(weight=("weight_mass", "sum"))
         .reset_index()
-        .rename(columns={"a": "src_person_id", "b": "dst_person_id"})
+        .rename(columns={"a": "src_key", "b": "dst_key"})
     )
     edges_undir["directed"] = False
 
-    edges_agg.to_parquet(OUT_DIR / "Edges_directed_agg_internal.parquet", index=False)
-    edges_undir.to_parquet(OUT_DIR / "Edges_undirected_agg_internal.parquet", index=False)
+    def export_pairs(df):
+        """int pair columns -> src/dst_person_id strings first, keys kept at the end."""
+        out = df.drop(columns=["src_key", "dst_key"])
+        out.insert(0, "src_person_id", decode(df["src_key"]))
+        out.insert(1, "dst_person_id", decode(df["dst_key"]))
+        out["src_person_key"] = df["src_key"].to_numpy().astype("int32")
+        out["dst_person_key"] = df["dst_key"].to_numpy().astype("int32")
+        return out
+
+    export_pairs(edges_agg).to_parquet(OUT_DIR / "Edges_directed_agg_internal.parquet", index=False)
+    export_pairs(edges_undir).to_parquet(OUT_DIR / "Edges_undirected_agg_internal.parquet", index=False)
 
-    print(f"Unique internal nodes: {len(pd.unique(pd.concat([edges['src_person_id'], edges['dst_person_id']])))})")
+    print(f"Unique internal nodes: {len(np.union1d(edges['src_key'], edges['dst_key']))})")
     print(f"Directed edges: {len(edges_agg)} | Undirected edges: {len(edges_undir)}")
     print("Year range:", emails['year'].min(), "-", emails['year'].max())
 
-    # Build Node Index (re-added section) 
+    # Build Node Index (re-added section)
     print("Building Node Index...")
-    senders = emails[["person_id"]].drop_duplicates().rename(columns={"person_id": "email_norm"})
-    senders["domain"] = senders["email_norm"].str.extract(r'@(.+)$')[0].str.lower()
-    senders["internal"] = senders["domain"].eq("enron.com")
-    senders["person_id"] = senders["email_norm"]
-
-    recips = edges[["dst_person_id"]].drop_duplicates().rename(columns={"dst_person_id": "person_id"})
-    recips["email_norm"] = recips["person_id"]
-    recips["domain"] = recips["email_norm"].str.extract(r'@(.+)$')[0].str.lower()
-    recips["internal"] = recips["domain"].eq("enron.com")
-
-    node_index = pd.concat([senders[["person_id", "email_norm", "internal", "domain"]],
-                            recips[["person_id", "email_norm", "internal", "domain"]]],
-                        ignore_index=True).drop_duplicates("person_id")
+    node_keys = pd.unique(np.concatenate([emails["person_key"].to_numpy(), edges["dst_key"].to_numpy()]))
+    node_index = pd.DataFrame({"person_id": decode(node_keys)})
+    node_index["email_norm"] = node_index["person_id"]
+    node_index["internal"] = is_internal[node_keys]
+    node_index["domain"] = node_index["email_norm"].str.extract(r'@(.+)$')[0].str.lower()
+    node_index["person_key"] = node_keys.astype("int32")
 
     node_index.to_parquet(OUT_DIR / "NodeIndex_internal.parquet", index=False)
     print(f"Saved NodeIndex_internal.parquet with {len(node_index):,} unique nodes")
 
     # Directed graph
     Gd = nx.DiGraph()
-    Gd.add_nodes_from(node_index["person_id"])
-    for r in edges_agg.itertuples(index=False):
-        Gd.add_edge(r.src_person_id, r.dst_person_id, weight=float(r.weight))
+    Gd.add_nodes_from(node_keys.tolist())
+    Gd.add_weighted_edges_from(zip(edges_agg["src_key"].tolist(), edges_agg["dst_key"].tolist(),
+                                   edges_agg["weight"].astype(float).tolist()))
 
     in_deg = dict(Gd.in_degree())
     out_deg = dict(Gd.out_degree())
@@ -192,9 +250,9 @@ for year in FOLDERS:
 
     # Undirected graph
     Gu = nx.Graph()
-    Gu.add_nodes_from(node_index["person_id"])
-    for r in edges_undir.itertuples(index=False):
-        Gu.add_edge(r.src_person_id, r.dst_person_id, weight=float(r.weight))
+    Gu.add_nodes_from(node_keys.tolist())
+    Gu.add_weighted_edges_from(zip(edges_undir["src_key"].tolist(), edges_undir["dst_key"].tolist(),
+                                   edges_undir["weight"].astype(float).tolist()))
 
     clust = nx.clustering(Gu) if Gu.number_of_edges() else {n: 0.0 for n in Gu.nodes()}
     try:
@@ -203,24 +261,23 @@ for year in FOLDERS:
         core = {n: 0 for n in Gu.nodes()}
 
     # Weighted degree
-    wdeg = {n: 0.0 for n in node_index["person_id"]}
-    for r in edges_undir.itertuples(index=False):
-        wdeg[r.src_person_id] += float(r.weight)
-        wdeg[r.dst_person_id] += float(r.weight)
-
-    # Node metrics dataframe 
-    nm = pd.DataFrame({"person_id": node_index["person_id"]})
-    nm["degree"] = nm["person_id"].map(deg).fillna(0).astype("int32")
-    nm["in_degree"] = nm["person_id"].map(in_deg).fillna(0).astype("int32")
-    nm["out_degree"] = nm["person_id"].map(out_deg).fillna(0).astype("int32")
-    nm["w_degree"] = nm["person_id"].map(wdeg).fillna(0).astype("float32")
-    nm["pagerank"] = nm["person_id"].map(pagerank).fillna(0).astype("float32")
-    nm["clustering_coef"] = nm["person_id"].map(clust).fillna(0).astype("float32")
-    nm["kcore"] = nm["person_id"].map(core).fillna(0).astype("int32")
+    wdeg = (pd.concat([edges_undir[["src_key", "weight"]].rename(columns={"src_key": "k"}),
+                       edges_undir[["dst_key", "weight"]].rename(columns={"dst_key": "k"})])
+              .groupby("k")["weight"].sum())
+
+    # Node metrics dataframe
+    nm = pd.DataFrame({"person_key": node_keys})
+    nm["degree"] = nm["person_key"].map(deg).fillna(0).astype("int32")
+    nm["in_degree"] = nm["person_key"].map(in_deg).fillna(0).astype("int32")
+    nm["out_degree"] = nm["person_key"].map(out_deg).fillna(0).astype("int32")
+    nm["w_degree"] = nm["person_key"].map(wdeg).fillna(0).astype("float32")
+    nm["pagerank"] = nm["person_key"].map(pagerank).fillna(0).astype("float32")
+    nm["clustering_coef"] = nm["person_key"].map(clust).fillna(0).astype("float32")
+    nm["kcore"] = nm["person_key"].map(core).fillna(0).astype("int32")
 
     # Add temporal coverage per node
     temporal = (
-        edges.groupby("src_person_id")
+        edges.groupby("src_key")
             .agg(
                 first_date=("dt_utc", "min"),
                 last_date=("dt_utc", "max"),
@@ -228,7 +285,9 @@ for year in FOLDERS:
             )
             .reset_index()
     )
-    nm = nm.merge(temporal, left_on="person_id", right_on="src_person_id", how="left").drop(columns=["src_person_id"])
+    nm = nm.merge(temporal, left_on="person_key", right_on="src_key", how="left").drop(columns=["src_key"])
+    nm.insert(0, "person_id", decode(nm["person_key"]))
+    nm["person_key"] = nm["person_key"].astype("int32")
 
     # Save
     nm.to_parquet(OUT_DIR / "NodeMetrics_internal.parquet", index=False)